@@ -0,0 +1,49 @@
+"""Benchmark :py:func:`pndniworkflows.images.histogram_percentiles` against :py:func:`numpy.percentile`.
+
+The 2nd and 98th percentiles (those used by :py:class:`pndniworkflows.interfaces.images.PercentileNormalize`
+with its default range) are computed for synthetic volumes: a T1-like volume with a zero background,
+the same volume restricted to a mask, and uniformly distributed integer values.
+
+Example::
+
+    python benchmarks/histogram_percentiles.py --size 256 > bench_output.txt
+"""
+import argparse
+import time
+import numpy as np
+from pndniworkflows.images import histogram_percentiles
+
+
+def best_time(func, repeats):
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--size', type=int, default=256, help='Size of each axis of the volume')
+    parser.add_argument('--repeats', type=int, default=5)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    rng = np.random.default_rng(args.seed)
+    n = args.size ** 3
+    head = rng.gamma(2.0, 200.0, size=n).astype(np.float32)
+    mask = rng.random(n) > 0.3
+    volumes = {'background': np.where(mask, head, 0),
+               'masked': head[mask],
+               'uniform': rng.integers(0, 4000, size=n).astype(np.float32)}
+    p = [2, 98]
+    print('volume\tnumpy_s\thistogram_s\tspeedup')
+    for name, data in volumes.items():
+        assert np.allclose(histogram_percentiles(data, p), np.percentile(data, p))
+        t_numpy = best_time(lambda: np.percentile(data, p), args.repeats)
+        t_hist = best_time(lambda: histogram_percentiles(data, p), args.repeats)
+        print('{}\t{:.3f}\t{:.3f}\t{:.2f}'.format(name, t_numpy, t_hist, t_numpy / t_hist))
+
+
+if __name__ == '__main__':
+    main()
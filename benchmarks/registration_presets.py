@@ -0,0 +1,144 @@
+"""Benchmark the registration presets on synthetic data.
+
+A smooth synthetic "model" image is generated along with a "T1" image related to it
+by a known random affine transform. The model is registered to the T1 with each preset,
+and the runtime and landmark error (the distance between landmarks transformed with the
+estimated and the true transform) are reported. Requires ANTs.
+
+With --warm-start, a second "session" T1 is generated, related to the first by a small
+additional transform, and registered both from scratch and warm started from the transform
+estimated for the first session (see :py:data:`pndniworkflows.registration.WARM_START_LEVELS`),
+so the two rows of each preset show the speedup and any loss of accuracy.
+
+Example::
+
+    python benchmarks/registration_presets.py --repeats 3 --warm-start > bench_output.txt
+"""
+import argparse
+import tempfile
+import time
+from pathlib import Path
+import numpy as np
+import nibabel
+from nipype.utils.filemanip import indirectory
+from pndniworkflows.registration import ants_registration_affine_node, REGISTRATION_PRESETS
+from pndniworkflows.utils import read_itk_affine
+
+
+def random_affine(rng, rotation=0.15, scale=0.05, translation=5.0):
+    """Random RAS affine close to the identity (rotation in radians, translation in mm)"""
+    angles = rng.uniform(-rotation, rotation, size=3)
+    cx, cy, cz = np.cos(angles)
+    sx, sy, sz = np.sin(angles)
+    rot = (np.array([[1, 0, 0], [0, cx, -sx], [0, sx, cx]]) @
+           np.array([[cy, 0, sy], [0, 1, 0], [-sy, 0, cy]]) @
+           np.array([[cz, -sz, 0], [sz, cz, 0], [0, 0, 1]]))
+    aff = np.eye(4)
+    aff[:3, :3] = rot @ np.diag(1.0 + rng.uniform(-scale, scale, size=3))
+    aff[:3, 3] = rng.uniform(-translation, translation, size=3)
+    return aff
+
+
+def phantom(world, centres, widths, weights):
+    """Sum of Gaussian blobs inside an ellipsoidal "head", evaluated at world coordinates (..., 3)"""
+    head = np.sum((world / np.array([70.0, 85.0, 75.0])) ** 2, axis=-1) < 1.0
+    out = 100.0 * head
+    for c, w, a in zip(centres, widths, weights):
+        out += a * np.exp(-np.sum((world - c) ** 2, axis=-1) / (2 * w ** 2))
+    return out
+
+
+def make_images(outdir, rng, shape, voxel_size, nblobs=40):
+    """Write model.nii.gz, T1.nii.gz, and a second session T1_2.nii.gz to outdir,
+    and return the true transforms of both sessions and the landmarks"""
+    affine = np.diag([voxel_size] * 3 + [1.0])
+    affine[:3, 3] = -voxel_size * (np.array(shape) - 1) / 2
+    ijk = np.stack(np.meshgrid(*[np.arange(n) for n in shape], indexing='ij'), axis=-1)
+    world = ijk * voxel_size + affine[:3, 3]
+    centres = rng.uniform(-50, 50, size=(nblobs, 3))
+    widths = rng.uniform(4, 12, size=nblobs)
+    weights = rng.uniform(-80, 80, size=nblobs)
+    true = random_affine(rng)
+    # the same subject repositioned in the scanner
+    true2 = random_affine(rng, rotation=0.03, scale=0.0, translation=2.0) @ true
+    nibabel.Nifti1Image(phantom(world, centres, widths, weights).astype(np.float32),
+                        affine).to_filename(str(outdir / 'model.nii.gz'))
+    for fname, trans in [('T1.nii.gz', true), ('T1_2.nii.gz', true2)]:
+        # the T1 satisfies T1(trans @ p) = model(p)
+        inv = np.linalg.inv(trans)
+        t1 = phantom(world @ inv[:3, :3].T + inv[:3, 3], centres, widths, weights)
+        nibabel.Nifti1Image(t1.astype(np.float32), affine).to_filename(str(outdir / fname))
+    return true, true2, centres
+
+
+def run_preset(workdir, preset, num_threads, moving='T1.nii.gz', initial_transforms=None):
+    kwargs = {}
+    if initial_transforms is not None:
+        kwargs['initial_moving_transform'] = initial_transforms
+    reg = ants_registration_affine_node(preset=preset,
+                                        warm_start=initial_transforms is not None,
+                                        write_composite_transform=False,
+                                        output_warped_image=False,
+                                        num_threads=num_threads,
+                                        **kwargs)
+    reg.inputs.fixed_image = str(workdir.parent / 'model.nii.gz')
+    reg.inputs.moving_image = str(workdir.parent / moving)
+    workdir.mkdir()
+    with indirectory(str(workdir)):
+        start = time.perf_counter()
+        outputs = reg.run().outputs
+        elapsed = time.perf_counter() - start
+    # the forward transforms include the initial transforms when warm started
+    estimated = np.eye(4)
+    for transform in outputs.forward_transforms:
+        estimated = estimated @ read_itk_affine(transform)
+    return elapsed, estimated, outputs.forward_transforms
+
+
+def landmark_error(estimated, true, landmarks):
+    points = np.concatenate([landmarks, np.ones((len(landmarks), 1))], axis=1)
+    return np.linalg.norm((points @ estimated.T - points @ true.T)[:, :3], axis=1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--presets', nargs='+', default=list(REGISTRATION_PRESETS), choices=list(REGISTRATION_PRESETS))
+    parser.add_argument('--repeats', type=int, default=1, help='Number of synthetic image pairs')
+    parser.add_argument('--shape', type=int, nargs=3, default=[96, 112, 96])
+    parser.add_argument('--voxel-size', type=float, default=2.0)
+    parser.add_argument('--num-threads', type=int, default=1)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--warm-start', action='store_true',
+                        help='Also register a second session, from scratch and warm started from the first')
+    args = parser.parse_args()
+    rng = np.random.default_rng(args.seed)
+    runs = [(preset, 'cold') for preset in args.presets]
+    if args.warm_start:
+        runs += [(preset, start) for preset in args.presets for start in ['cold_session2', 'warm_session2']]
+    results = {run: {'time': [], 'mean': [], 'max': []} for run in runs}
+    with tempfile.TemporaryDirectory() as tmp:
+        for repeat in range(args.repeats):
+            outdir = Path(tmp, str(repeat))
+            outdir.mkdir()
+            true, true2, landmarks = make_images(outdir, rng, args.shape, args.voxel_size)
+            for preset in args.presets:
+                elapsed, estimated, transforms = run_preset(outdir / preset, preset, args.num_threads)
+                outcomes = [('cold', elapsed, estimated, true)]
+                if args.warm_start:
+                    for start, initial in [('cold_session2', None), ('warm_session2', transforms)]:
+                        elapsed2, estimated2, _ = run_preset(outdir / f'{preset}_{start}', preset, args.num_threads,
+                                                             moving='T1_2.nii.gz', initial_transforms=initial)
+                        outcomes.append((start, elapsed2, estimated2, true2))
+                for start, elapsed, estimated, trans in outcomes:
+                    err = landmark_error(estimated, trans, landmarks)
+                    results[preset, start]['time'].append(elapsed)
+                    results[preset, start]['mean'].append(err.mean())
+                    results[preset, start]['max'].append(err.max())
+    print('preset\tstart\ttime_s\tmean_landmark_error_mm\tmax_landmark_error_mm')
+    for (preset, start), r in results.items():
+        print('{}\t{}\t{:.2f}\t{:.3f}\t{:.3f}'.format(preset, start, np.mean(r['time']),
+                                                      np.mean(r['mean']), np.max(r['max'])))
+
+
+if __name__ == '__main__':
+    main()
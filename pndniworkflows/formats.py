@@ -0,0 +1,77 @@
+"""Connect image inputs and outputs, converting between MINC and NIfTI only where required.
+
+Interfaces declare the format of their image inputs and outputs with the
+``image_format`` trait metadata (e.g. ``File(exists=True, image_format='minc')``).
+"""
+from nipype.pipeline import engine as pe
+from .interfaces.minc import Mnc2nii, Nii2mnc
+from .interfaces.pndni_utils import MncLabel2NiiLabel
+
+
+IMAGE_FORMATS = ('minc', 'nifti')
+
+
+def image_format(node, field, output=True):
+    """Get the declared image format of an input or output of a node
+
+    :param node: a :py:class:`nipype.pipeline.engine.Node`
+    :param field: name of the input or output
+    :param output: :py:obj:`True` if field is an output, :py:obj:`False` if it is an input
+    :return: "minc", "nifti", or :py:obj:`None` if the format is not declared
+    """
+    if not isinstance(node, pe.Node):
+        return None
+    spec = node.interface.output_spec() if output else node.interface.inputs
+    if spec is None:
+        return None
+    trait = spec.trait(field)
+    if trait is None:
+        return None
+    return trait.image_format
+
+
+def connect_image(wf, src, src_field, dst, dst_field, src_format=None, dst_format=None, labels=False):
+    """Connect ``src.src_field`` to ``dst.dst_field``, inserting a conversion node if the
+    format produced by src differs from the format accepted by dst.
+
+    The formats are read from the interface specs (see :py:func:`image_format`)
+    unless given explicitly. If either format is unknown, the nodes are connected
+    directly. If src_field has already been converted to the format of dst in wf,
+    that conversion node is reused, so each output is converted at most once per format.
+
+    :param wf: workflow in which to make the connection
+    :param src: source node
+    :param src_field: output of src
+    :param dst: destination node
+    :param dst_field: input of dst
+    :param src_format: format of src_field, overriding the interface spec
+    :param dst_format: format accepted by dst_field, overriding the interface spec
+    :param labels: the image is a label image (use :py:class:`MncLabel2NiiLabel` to convert to NIfTI)
+    :return: the conversion node, or :py:obj:`None` if no conversion was required
+    """
+    if src_format is None:
+        src_format = image_format(src, src_field, output=True)
+    if dst_format is None:
+        dst_format = image_format(dst, dst_field, output=False)
+    for fmt in (src_format, dst_format):
+        if fmt is not None and fmt not in IMAGE_FORMATS:
+            raise ValueError(f'Unknown image format {fmt}')
+    if src_format is None or dst_format is None or src_format == dst_format:
+        wf.connect(src, src_field, dst, dst_field)
+        return None
+    if dst_format == 'minc':
+        interface_class = Nii2mnc
+    elif labels:
+        interface_class = MncLabel2NiiLabel
+    else:
+        interface_class = Mnc2nii
+    name = f'{src.name}_{src_field}_to_{dst_format}'
+    convert = wf.get_node(name)
+    if convert is None:
+        convert = pe.Node(interface_class(), name=name)
+        wf.connect(src, src_field, convert, 'in_file')
+    elif not isinstance(convert.interface, interface_class):
+        raise ValueError(f'{src.name}.{src_field} is already converted to {dst_format} with '
+                         f'{type(convert.interface).__name__} (labels must be the same for every connection)')
+    wf.connect(convert, 'out_file', dst, dst_field)
+    return convert
@@ -0,0 +1,561 @@
+"""In-process implementations of image operations"""
+import shutil
+import numpy as np
+import nibabel
+from nibabel.openers import ImageOpener
+from .utils import InProcessUnsupportedError, copy_file
+
+
+def _single_file_nifti(img):
+    return type(img) in (nibabel.Nifti1Image, nibabel.Nifti2Image)
+
+
+def forceqform(in_file, out_file):
+    """Copy a NIfTI file, setting the qform to the qform of the input (or the sform
+    if the qform is not set) and removing the sform.
+
+    Only the header is rewritten; the extensions and data block are streamed
+    to the output unchanged.
+
+    :param in_file: input NIfTI file (.nii or .nii.gz)
+    :param out_file: output NIfTI file (.nii or .nii.gz)
+    :raises: :py:class:`RuntimeError` if neither the qform nor the sform is set,
+             :py:class:`pndniworkflows.utils.InProcessUnsupportedError` if the input is not a
+             single file NIfTI or the sform cannot be represented exactly as a qform
+    """
+    img = nibabel.load(str(in_file))
+    if not _single_file_nifti(img):
+        raise InProcessUnsupportedError(f'{in_file} is not a single file NIfTI image')
+    # read the header from the file rather than using img.header, which does not
+    # preserve vox_offset
+    with ImageOpener(str(in_file), 'rb') as fin:
+        hdr = img.header_class.from_fileobj(fin)
+    qform, qcode = hdr.get_qform(coded=True)
+    sform, scode = hdr.get_sform(coded=True)
+    if qcode > 0:
+        affine, code = qform, qcode
+    elif scode > 0:
+        affine, code = sform, scode
+    else:
+        raise RuntimeError(f'Neither the qform nor the sform of {in_file} is set')
+    hdr.set_qform(affine, int(code))
+    if not np.allclose(hdr.get_qform(), affine, rtol=0.0, atol=1e-5):
+        raise InProcessUnsupportedError('sform cannot be represented as a qform')
+    hdr.set_sform(None, 0)
+    with ImageOpener(str(in_file), 'rb') as fin, ImageOpener(str(out_file), 'wb') as fout:
+        fin.seek(hdr.sizeof_hdr)
+        fout.write(hdr.binaryblock)
+        shutil.copyfileobj(fin, fout, 1 << 20)
+
+
+_INT_DTYPES = [np.dtype(t) for t in ('uint8', 'int8', 'uint16', 'int16', 'uint32', 'int32', 'int64')]
+
+
+def smallest_int_dtype(minval, maxval):
+    """Return the smallest integer dtype which can represent all values in [minval, maxval]
+
+    :Example:
+
+    .. doctest::
+
+       >>> from pndniworkflows.images import smallest_int_dtype
+       >>> smallest_int_dtype(0, 255)
+       dtype('uint8')
+       >>> smallest_int_dtype(-1, 255)
+       dtype('int16')
+    """
+    for dtype in _INT_DTYPES:
+        info = np.iinfo(dtype)
+        if info.min <= minval and maxval <= info.max:
+            return dtype
+    raise ValueError(f'No integer type can hold the range [{minval}, {maxval}]')
+
+
+def iter_slabs(length, bytes_per_index, slab_bytes=1 << 26):
+    """Split range(length) into slices with each slice covering at most slab_bytes
+    (but always at least one index)
+
+    :param length: length of the axis to split
+    :param bytes_per_index: number of bytes corresponding to a single index of the axis
+    :param slab_bytes: maximum number of bytes in a slab
+    :return: iterator of :py:obj:`slice`
+    """
+    step = max(1, int(slab_bytes // max(bytes_per_index, 1)))
+    for start in range(0, length, step):
+        yield slice(start, min(start + step, length))
+
+
+def _tag_features(data, affine, points):
+    """Return the image values at each point (nearest voxel), and a boolean array
+    indicating which points are inside the image"""
+    coords = np.concatenate([points, np.ones((points.shape[0], 1))], axis=1)
+    vox = np.rint(np.linalg.solve(affine, coords.T)[:3].T).astype(int)
+    inside = np.all((vox >= 0) & (vox < np.array(data.shape[:3])), axis=1)
+    vox = vox[inside]
+    return data[vox[:, 0], vox[:, 1], vox[:, 2]], inside
+
+
+def _bayes_classifier(features, labels):
+    classes = np.unique(labels)
+    means = np.array([features[labels == c].mean(axis=0) for c in classes])
+    variances = np.array([features[labels == c].var(axis=0) for c in classes])
+    variances = np.maximum(variances, 1e-6 * max(float(np.var(features)), 1e-12))
+    log_prior = np.log(np.array([np.mean(labels == c) for c in classes]))
+    log_norm = log_prior - 0.5 * np.sum(np.log(variances), axis=1)
+
+    def predict(x):
+        loglik = -0.5 * np.sum((x[:, np.newaxis, :] - means) ** 2 / variances, axis=2) + log_norm
+        return classes[np.argmax(loglik, axis=1)]
+    return predict
+
+
+def _knn_classifier(features, labels, k):
+    classes, label_inds = np.unique(labels, return_inverse=True)
+    k = min(k, features.shape[0])
+
+    sqnorm = np.sum(features ** 2, axis=1)
+
+    def predict(x):
+        # squared distance up to a per-row constant, which does not change the ranking
+        dist = sqnorm - 2.0 * x @ features.T
+        nearest = np.argpartition(dist, k - 1, axis=1)[:, :k]
+        counts = np.zeros((x.shape[0], len(classes)), dtype=np.int32)
+        np.add.at(counts, (np.arange(x.shape[0])[:, np.newaxis], label_inds[nearest]), 1)
+        return classes[np.argmax(counts, axis=1)]
+    return predict
+
+
+def classify_voxels(in_file, points, labels, out_file, mask_file=None, method='bayes', k=5,
+                    chunksize=1 << 16, num_threads=1):
+    """Classify the voxels of an image using training points, and write a label image.
+
+    The training features are the image values at the voxels nearest to each point.
+    Voxels (within the mask) are classified ``chunksize`` at a time on a thread pool.
+
+    :param in_file: input image
+    :param points: (N, 3) array of training point world coordinates
+    :param labels: (N,) array of integer labels (one for each point). Labels should be positive
+    :param out_file: output NIfTI label image. Voxels outside the mask are 0
+    :param mask_file: optional mask image on the same grid as in_file
+    :param method: "bayes" for a Gaussian Bayes classifier or "knn" for k-nearest neighbours
+    :param k: number of neighbours for "knn"
+    :param chunksize: number of voxels to classify at a time
+    :param num_threads: number of threads to use
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    img = nibabel.load(str(in_file))
+    data = np.asarray(img.dataobj, dtype=np.float32)
+    if data.ndim == 3:
+        data = data[..., np.newaxis]
+    features, inside = _tag_features(data, img.affine, np.asarray(points, dtype=np.float64))
+    labels = np.asarray(labels)[inside]
+    if len(labels) == 0:
+        raise ValueError('No training points are inside the image')
+    if method == 'bayes':
+        predict = _bayes_classifier(features, labels)
+    elif method == 'knn':
+        predict = _knn_classifier(features, labels, k)
+    else:
+        raise ValueError(f'Unknown method {method}')
+    if mask_file is not None:
+        mask = np.asarray(nibabel.load(str(mask_file)).dataobj) > 0
+        if mask.shape != data.shape[:3]:
+            raise ValueError('mask and image have different shapes')
+    else:
+        mask = np.ones(data.shape[:3], dtype=bool)
+    vox = data[mask]
+    out = np.zeros(vox.shape[0], dtype=smallest_int_dtype(min(0, labels.min()), labels.max()))
+    if method == 'knn':
+        # limit the size of the (chunksize, number of points) distance matrix
+        chunksize = max(1, min(chunksize, (1 << 22) // len(labels)))
+    chunks = [slice(i, i + chunksize) for i in range(0, vox.shape[0], chunksize)]
+
+    def run(slice_):
+        out[slice_] = predict(vox[slice_])
+
+    with ThreadPoolExecutor(max_workers=num_threads) as executor:
+        list(executor.map(run, chunks))
+    outdata = np.zeros(data.shape[:3], dtype=out.dtype)
+    outdata[mask] = out
+    outimg = nibabel.Nifti1Image(outdata, img.affine)
+    outimg.set_qform(img.affine, 1)
+    outimg.set_sform(img.affine, 1)
+    outimg.to_filename(str(out_file))
+
+
+def histogram_percentiles(data, percentiles, nbins=4096):
+    """Compute percentiles of data by histogramming instead of sorting.
+
+    One pass histograms the data and finds the bins containing the ranks which
+    are needed, a second pass gathers the values in those bins, and only these
+    are partitioned. The minimum has a bin of its own, so a large background
+    is never gathered. Percentiles are interpolated between ranks in the same way as
+    :py:func:`numpy.percentile`.
+
+    :param data: array of values
+    :param percentiles: sequence of percentiles in [0, 100]
+    :param nbins: number of histogram bins above the minimum
+    :return: :py:class:`numpy.ndarray` of percentile values
+    """
+    data = np.asarray(data).ravel()
+    if data.size == 0:
+        raise ValueError('Cannot compute percentiles of an empty array')
+    rank = np.asarray(percentiles, dtype=np.float64) / 100.0 * (data.size - 1)
+    k = np.floor(rank).astype(np.intp)
+    frac = rank - k
+    lo, hi = float(data.min()), float(data.max())
+    if hi <= lo:
+        return np.full(len(rank), lo)
+    needed = np.unique(np.concatenate([k, np.minimum(k + 1, data.size - 1)]))
+    scaled = np.subtract(data, lo, dtype=np.result_type(data.dtype, np.float32))
+    scaled *= nbins / (hi - lo)
+    # rounding up puts exactly the values equal to the minimum in bin 0
+    np.ceil(scaled, out=scaled)
+    ind = scaled.astype(np.intp)
+    del scaled
+    np.minimum(ind, nbins, out=ind)
+    counts = np.bincount(ind, minlength=nbins + 1)
+    cum = np.cumsum(counts)
+    bins = np.searchsorted(cum, needed, side='right')
+    exact = dict.fromkeys(needed[bins == 0].tolist(), lo)
+    needed, bins = needed[bins > 0], bins[bins > 0]
+    if len(needed):
+        selected = np.zeros(nbins + 1, dtype=bool)
+        selected[bins] = True
+        # np.compress is faster than boolean indexing
+        values = np.compress(selected[ind], data)
+        # bins are ordered by value, so the rank of a value within the selected values is
+        # its rank less the number of values in the bins which were not selected below it
+        unselected = np.where(selected, 0, counts)
+        local = needed - (np.cumsum(unselected) - unselected)[bins]
+        exact.update(zip(needed.tolist(), np.partition(values, local)[local].astype(np.float64)))
+    out = np.array([exact[i] for i in k.tolist()])
+    upper = np.array([exact[min(i + 1, data.size - 1)] for i in k.tolist()])
+    return out + frac * (upper - out)
+
+
+def percentile_normalize(in_file, out_file, const2, range_, mask_file=None, dtype=np.float32, nbins=4096):
+    """Linearly rescale an image so that the ``range_`` and ``100 - range_`` percentiles
+    map to ``const2[0]`` and ``const2[1]``, the same normalization as
+    ``inormalize -const2 <const2> -range <range_>``.
+
+    :param in_file: input image
+    :param out_file: output NIfTI image
+    :param const2: the two values to which the percentiles are mapped
+    :param range_: percentage to exclude at the top and bottom of the intensity range
+    :param mask_file: if specified, only voxels inside the mask are used to calculate the percentiles
+    :param dtype: output data type. Integer outputs are rounded and clipped
+    :param nbins: number of histogram bins used to calculate the percentiles
+    """
+    dtype = np.dtype(dtype)
+    img = nibabel.load(str(in_file))
+    data = np.asarray(img.dataobj, dtype=np.float64 if dtype == np.float64 else np.float32)
+    if mask_file is not None:
+        mask = np.asarray(nibabel.load(str(mask_file)).dataobj) > 0
+        values = data[mask]
+    else:
+        values = data
+    lo, hi = histogram_percentiles(values, [range_, 100.0 - range_], nbins=nbins)
+    scale = (const2[1] - const2[0]) / (hi - lo) if hi > lo else 0.0
+    data -= lo
+    data *= scale
+    data += const2[0]
+    if np.issubdtype(dtype, np.integer):
+        info = np.iinfo(dtype)
+        np.rint(data, out=data)
+        np.clip(data, info.min, info.max, out=data)
+    hdr = img.header.copy() if isinstance(img, nibabel.Nifti1Pair) else None
+    outimg = nibabel.Nifti1Image(data.astype(dtype, copy=False), img.affine, hdr)
+    outimg.set_data_dtype(dtype)
+    outimg.header.set_slope_inter(1.0, 0.0)
+    outimg.to_filename(str(out_file))
+
+
+def downsample_affine(affine, factors):
+    """Affine of an image downsampled by averaging blocks of voxels. The centre of each
+    block keeps its world coordinates.
+
+    :param affine: 4x4 affine of the original image
+    :param factors: block size along each axis
+    :return: 4x4 :py:class:`numpy.ndarray`
+    """
+    factors = np.asarray(factors, dtype=float)
+    out = np.array(affine, dtype=float)
+    out[:3, 3] = affine[:3, :3] @ ((factors - 1) / 2) + affine[:3, 3]
+    out[:3, :3] = affine[:3, :3] * factors
+    return out
+
+
+def downsample_factors(affine, voxel_size):
+    """Block sizes which downsample an image to approximately the requested voxel size.
+
+    :param affine: 4x4 affine of the image
+    :param voxel_size: target voxel size (mm)
+    :return: list of integer factors, one per axis (at least 1)
+    """
+    zooms = np.sqrt(np.sum(np.asarray(affine)[:3, :3] ** 2, axis=0))
+    return [max(1, int(round(voxel_size / z))) for z in zooms]
+
+
+def _block_average(img, factors):
+    if len(img.shape) != 3:
+        raise ValueError('Only 3D images can be downsampled')
+    factors = np.broadcast_to(np.asarray(factors, dtype=int), (3,))
+    if np.any(factors < 1):
+        raise ValueError('Downsampling factors must be positive')
+    newshape = np.array(img.shape) // factors
+    if np.any(newshape == 0):
+        raise ValueError('Downsampling factors are larger than the image')
+    data = np.asarray(img.dataobj[tuple(slice(0, n * f) for n, f in zip(newshape, factors))], dtype=np.float32)
+    data = data.reshape(newshape[0], factors[0], newshape[1], factors[1], newshape[2], factors[2])
+    return data.mean(axis=(1, 3, 5), dtype=np.float32), downsample_affine(img.affine, factors)
+
+
+def downsample_image(in_file, out_file, factors):
+    """Downsample a 3D image by averaging blocks of voxels. Voxels at the end of an axis which
+    do not fill a block are dropped.
+
+    :param in_file: input image
+    :param out_file: output NIfTI image (float32)
+    :param factors: block size, either an integer or one per axis
+    """
+    data, affine = _block_average(nibabel.load(str(in_file)), factors)
+    nibabel.Nifti1Image(data, affine).to_filename(str(out_file))
+
+
+def _foreground(data, fraction, name):
+    from scipy import ndimage
+    threshold = fraction * histogram_percentiles(data, [98])[0]
+    labels, nlabels = ndimage.label(data > threshold)
+    if nlabels == 0:
+        raise RuntimeError('No voxels in {} are above the threshold'.format(name))
+    mask = labels == np.argmax(np.bincount(labels.ravel())[1:]) + 1
+    return ndimage.binary_fill_holes(mask)
+
+
+def foreground_mask(in_file, out_file, fraction=0.1, dilate=2):
+    """Create a mask of the foreground (e.g. the head) of an image.
+
+    Voxels brighter than :py:obj:`fraction` times the 98th percentile are selected,
+    the largest connected component is kept, its holes are filled, and it is dilated.
+
+    :param in_file: input image
+    :param out_file: output NIfTI mask (uint8)
+    :param fraction: threshold relative to the 98th percentile
+    :param dilate: number of voxels by which to dilate the mask
+    """
+    from scipy import ndimage
+    img = nibabel.load(str(in_file))
+    mask = _foreground(np.asarray(img.dataobj, dtype=np.float32), fraction, in_file)
+    if dilate > 0:
+        mask = ndimage.binary_dilation(mask, iterations=dilate)
+    out = nibabel.Nifti1Image(mask.astype(np.uint8), img.affine)
+    out.to_filename(str(out_file))
+
+
+def foreground_bbox(in_file, voxel_size=4.0, fraction=0.1, margin=10.0):
+    """Find the bounding box of the foreground (e.g. the head) of an image.
+
+    The image is block averaged to about :py:obj:`voxel_size` and masked as in
+    :py:func:`foreground_mask`. The box contains every block which intersects the mask,
+    enlarged by :py:obj:`margin` mm on each side.
+
+    :param in_file: input image
+    :param voxel_size: approximate voxel size (mm) of the downsampled image
+    :param fraction: mask threshold relative to the 98th percentile
+    :param margin: margin (mm) to add on each side of the box
+    :return: tuple of three :py:class:`slice` objects in voxel coordinates of in_file
+    """
+    img = nibabel.load(str(in_file))
+    factors = downsample_factors(img.affine, voxel_size)
+    data, _ = _block_average(img, factors)
+    mask = _foreground(data, fraction, in_file)
+    zooms = np.sqrt(np.sum(img.affine[:3, :3] ** 2, axis=0))
+    slices = []
+    for axis in range(3):
+        inds = np.nonzero(np.any(mask, axis=tuple(i for i in range(3) if i != axis)))[0]
+        pad = int(np.ceil(margin / zooms[axis]))
+        start = max(inds[0] * factors[axis] - pad, 0)
+        if inds[-1] == mask.shape[axis] - 1:
+            # voxels beyond the last complete block are not in the downsampled image
+            stop = img.shape[axis]
+        else:
+            stop = min((inds[-1] + 1) * factors[axis] + pad, img.shape[axis])
+        slices.append(slice(int(start), int(stop)))
+    return tuple(slices)
+
+
+def _superior_axis(affine):
+    # the voxel axis closest to superior-inferior, and whether increasing it moves superiorly
+    ind = int(np.argmax(np.abs(affine[2, :3])))
+    return ind, affine[2, ind] >= 0
+
+
+def find_neck(in_file, voxel_size=4.0, fraction=0.1, min_distance=120.0, max_distance=220.0):
+    """Find the plane below which to cut off the neck, without registration.
+
+    The image is block averaged to about :py:obj:`voxel_size` and a head mask is made as in
+    :py:func:`foreground_mask`. Along the voxel axis closest to superior-inferior, the top of
+    the head is the most superior slice whose mask area is at least 5% of the largest.
+    The cutting plane is the slice with the smallest mask area (the neck) between
+    :py:obj:`min_distance` and :py:obj:`max_distance` mm below the top of the head.
+    If the image does not extend :py:obj:`min_distance` below the top of the head,
+    nothing needs to be cut and the most inferior slice is returned.
+
+    :param in_file: input image
+    :param voxel_size: approximate voxel size (mm) of the downsampled image
+    :param fraction: mask threshold relative to the 98th percentile
+    :param min_distance: minimum distance (mm) from the top of the head to the cutting plane
+    :param max_distance: maximum distance (mm) from the top of the head to the cutting plane
+    :return: world coordinates of a point on the cutting plane
+    """
+    img = nibabel.load(str(in_file))
+    data, affine = _block_average(img, downsample_factors(img.affine, voxel_size))
+    mask = _foreground(data, fraction, in_file)
+    ind, inf_to_sup = _superior_axis(affine)
+    profile = mask.sum(axis=tuple(i for i in range(3) if i != ind))
+    if inf_to_sup:
+        # order from superior to inferior
+        profile = profile[::-1]
+    spacing = np.linalg.norm(affine[:3, ind])
+    top = int(np.argmax(profile >= 0.05 * profile.max()))
+    start = top + int(np.ceil(min_distance / spacing))
+    stop = min(top + int(np.floor(max_distance / spacing)) + 1, len(profile))
+    if start >= len(profile):
+        cut = len(profile) - 1
+    else:
+        cut = start + int(np.argmin(profile[start:stop]))
+    if inf_to_sup:
+        cut = len(profile) - 1 - cut
+    vox = (np.array(data.shape) - 1) / 2
+    vox[ind] = cut
+    return (affine @ np.append(vox, 1.0))[:3]
+
+
+def _write_scaled_nifti(data, slope, inter, ref, out_file):
+    # nibabel chooses its own scaling when writing, so the header and data are written directly
+    hdr = ref.header.copy()
+    hdr.set_data_shape(data.shape)
+    hdr.set_data_dtype(data.dtype)
+    hdr.set_slope_inter(slope, inter)
+    # set to the minimum by write_to
+    hdr.set_data_offset(0)
+    with ImageOpener(str(out_file), 'wb') as f:
+        hdr.write_to(f)
+        f.write(b'\0' * (hdr.get_data_offset() - f.tell()))
+        f.write(data.tobytes(order='F'))
+
+
+def labels2probmaps(input_files, labels, out_files, out_dtype='float32'):
+    """Create probability maps from label images (e.g. the labels from several
+    segmentations of the same image). The probability of a label at a voxel is the
+    fraction of input files with that label there. Each input file is read once.
+
+    With an integer :py:obj:`out_dtype` the number of input files with each label is
+    stored, with scl_slope 1/(number of input files), so the probabilities are exact
+    (up to the precision of scl_slope, which is single precision). If there are more input files than the
+    integer type can count, probabilities are rounded to multiples of
+    1/(maximum of the type) instead.
+
+    :param input_files: list of NIfTI label images, all with the same shape
+    :param labels: list of labels
+    :param out_files: one NIfTI file per label, or a single file for a 4D image with
+                      one volume per label
+    :param out_dtype: 'float32', 'uint8', or 'uint16'
+    :raises: :py:class:`pndniworkflows.utils.InProcessUnsupportedError` if an input or output
+             is not NIfTI
+    """
+    if len(out_files) != len(labels) and len(out_files) != 1:
+        raise ValueError('There must be one output file per label, or a single output file')
+    for out_file in out_files:
+        if not str(out_file).endswith(('.nii', '.nii.gz')):
+            raise InProcessUnsupportedError(f'{out_file} is not a NIfTI file')
+    out_dtype = np.dtype(out_dtype)
+    if out_dtype not in (np.dtype(np.float32), np.dtype(np.uint8), np.dtype(np.uint16)):
+        raise ValueError(f'Unsupported output data type {out_dtype}')
+    ref = None
+    for in_file in input_files:
+        img = nibabel.load(str(in_file))
+        if not _single_file_nifti(img):
+            raise InProcessUnsupportedError(f'{in_file} is not a single file NIfTI image')
+        data = np.asanyarray(img.dataobj)
+        if ref is None:
+            ref = img
+            counts = np.zeros((len(labels),) + data.shape, dtype=np.uint32)
+        elif data.shape != ref.shape:
+            raise ValueError(f'{in_file} does not have the same shape as {input_files[0]}')
+        for count, label in zip(counts, labels):
+            count += data == label
+    n = len(input_files)
+    if out_dtype.kind == 'f':
+        maps = counts.astype(np.float32) / n
+        slope = None
+    else:
+        maxval = np.iinfo(out_dtype).max
+        if n <= maxval:
+            maps = counts.astype(out_dtype)
+            slope = 1.0 / n
+        else:
+            maps = np.rint(counts * (maxval / n)).astype(out_dtype)
+            slope = 1.0 / maxval
+    if len(out_files) == 1 and len(labels) > 1:
+        outputs = [np.moveaxis(maps, 0, -1)]
+    else:
+        outputs = list(maps)
+    for data, out_file in zip(outputs, out_files):
+        if slope is None:
+            out = nibabel.Nifti1Image(data, ref.affine, ref.header)
+            out.header.set_data_dtype(data.dtype)
+            out.header.set_slope_inter(1.0, 0.0)
+            out.to_filename(str(out_file))
+        else:
+            _write_scaled_nifti(data, slope, 0.0, ref, out_file)
+
+
+def downcast_image(in_file, out_file, mode='labels', tolerance=None):
+    """Write an image with a smaller data type, checking that its values are preserved.
+
+    With :py:obj:`mode` 'labels' every value must be an integer, and the data are stored with
+    the smallest integer type which holds them (see :py:func:`smallest_int_dtype`). If that is
+    the type of the input, the file is copied. With 'int16' the data are stored as int16 with
+    scl_slope and scl_inter spanning their range, and the largest difference from the input
+    values must not exceed :py:obj:`tolerance`.
+
+    :param in_file: input single file NIfTI image
+    :param out_file: output NIfTI image (.nii or .nii.gz)
+    :param mode: 'labels' or 'int16'
+    :param tolerance: maximum absolute error for 'int16'
+    :raises: :py:class:`ValueError` if the values cannot be stored within the constraints
+    """
+    img = nibabel.load(str(in_file))
+    if not _single_file_nifti(img):
+        raise ValueError(f'{in_file} is not a single file NIfTI image')
+    if not str(out_file).endswith(('.nii', '.nii.gz')):
+        raise ValueError(f'{out_file} is not a NIfTI file')
+    data = np.asanyarray(img.dataobj)
+    if data.dtype.kind == 'f' and not np.all(np.isfinite(data)):
+        raise ValueError(f'{in_file} contains non-finite values')
+    minval, maxval = (data.min(), data.max()) if data.size else (0, 0)
+    if mode == 'labels':
+        if data.dtype.kind == 'f' and not np.all(data == np.round(data)):
+            raise ValueError(f'{in_file} contains non-integer values')
+        dtype = smallest_int_dtype(int(minval), int(maxval))
+        slope, inter = img.header.get_slope_inter()
+        if dtype == img.get_data_dtype() and slope in (None, 1.0) and inter in (None, 0.0):
+            copy_file(in_file, out_file, compress=str(out_file).endswith('.gz'))
+            return
+        _write_scaled_nifti(data.astype(dtype), 1.0, 0.0, img, out_file)
+    elif mode == 'int16':
+        if tolerance is None:
+            raise ValueError('A tolerance is required for int16')
+        info = np.iinfo(np.int16)
+        # the values of scl_slope and scl_inter as stored in the header
+        slope = np.float32((float(maxval) - float(minval)) / (int(info.max) - int(info.min)) or 1.0)
+        inter = np.float32(float(minval) - float(info.min) * float(slope))
+        stored = np.clip(np.rint((data - np.float64(inter)) / np.float64(slope)), info.min, info.max).astype(np.int16)
+        error = np.max(np.abs(stored * np.float64(slope) + np.float64(inter) - data)) if data.size else 0.0
+        if error > tolerance:
+            raise ValueError(f'Storing {in_file} as int16 changes values by up to {error} (tolerance {tolerance})')
+        _write_scaled_nifti(stored, slope, inter, img, out_file)
+    else:
+        raise ValueError(f'Unknown mode {mode}')
@@ -0,0 +1,125 @@
+"""Extensions to the :py:mod:`nipype.interfaces.ants` interfaces"""
+from nipype.interfaces.base import Directory, isdefined
+from nipype.interfaces.ants.registration import Registration, RegistrationInputSpec
+from nipype import logging
+from pathlib import Path
+import json
+import os
+import shutil
+import hashlib
+import tempfile
+from ..utils import file_digest
+from .base import set_thread_environ, num_threads_trait
+
+
+iflogger = logging.getLogger('nipype.interface')
+# inputs which do not affect the results
+_CACHE_IGNORE = ('cache_dir', 'num_threads', 'environ')
+_CACHE_VERSION = 1
+
+
+def _canonical(value):
+    if isinstance(value, str) and os.path.isfile(value):
+        return {'sha256': file_digest(value)}
+    if isinstance(value, (list, tuple)):
+        return [_canonical(v) for v in value]
+    if isinstance(value, dict):
+        return {k: _canonical(v) for k, v in value.items()}
+    return value
+
+
+def _local_outputs(outputs, cwd):
+    # output files written to the working directory, as {name: [(index, path), ...]}
+    files = {}
+    for name, value in outputs.items():
+        values = value if isinstance(value, list) else [value]
+        paths = [(i, v) for i, v in enumerate(values)
+                 if isinstance(v, str) and os.path.commonpath([cwd, os.path.abspath(v)]) == cwd]
+        if paths:
+            files[name] = paths
+    return files
+
+
+class ThreadedRegistrationInputSpec(RegistrationInputSpec):
+    num_threads = num_threads_trait()
+
+
+class ThreadedRegistration(Registration):
+    """:py:class:`nipype.interfaces.ants.registration.Registration` which also sets
+    the :py:data:`pndniworkflows.interfaces.base.THREAD_VARIABLES` from :py:obj:`num_threads`.
+    nipype only sets NSLOTS, which ITK ignores if ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS
+    is set in the environment. Unlike nipype, :py:obj:`num_threads` must be at least 1.
+    """
+    input_spec = ThreadedRegistrationInputSpec
+
+    def _num_threads_update(self):
+        super(ThreadedRegistration, self)._num_threads_update()
+        set_thread_environ(self.inputs.environ, self.inputs.num_threads)
+
+
+class CachedRegistrationInputSpec(ThreadedRegistrationInputSpec):
+    cache_dir = Directory(desc='Directory in which to cache the outputs. If undefined, nothing is cached')
+
+
+class CachedRegistration(ThreadedRegistration):
+    """:py:class:`ThreadedRegistration` with an optional global cache.
+
+    If :py:obj:`cache_dir` is defined, the outputs are stored under a key computed from
+    the contents of the input files, the other inputs (except :py:obj:`num_threads`), and the
+    ANTs version. A later run with the same key copies the outputs from the cache instead of
+    running antsRegistration, regardless of the node's working directory or the names of the
+    input files. Entries are written to a temporary directory and renamed, so concurrent
+    runs do not see partial entries.
+    """
+    input_spec = CachedRegistrationInputSpec
+
+    def cache_key(self):
+        """The key under which the outputs are cached
+
+        :return: hex digest
+        """
+        params = {k: v for k, v in self.inputs.get_traitsfree().items() if k not in _CACHE_IGNORE}
+        key = {'version': _CACHE_VERSION,
+               'ants_version': self.version,
+               'inputs': _canonical(params)}
+        return hashlib.sha256(json.dumps(key, sort_keys=True, default=str).encode()).hexdigest()
+
+    def _run_interface(self, runtime, correct_return_codes=(0,)):
+        if not isdefined(self.inputs.cache_dir):
+            return super(CachedRegistration, self)._run_interface(runtime, correct_return_codes)
+        cache_dir = Path(self.inputs.cache_dir).resolve()
+        entry = cache_dir / self.cache_key()
+        cwd = os.path.abspath(runtime.cwd)
+        if entry.is_dir():
+            iflogger.info('Restoring registration outputs from %s', entry)
+            meta = json.loads((entry / 'metadata.json').read_text())
+            expected = self._list_outputs()
+            for name, stored in meta['files'].items():
+                for index, fname in stored:
+                    dest = expected[name][index] if isinstance(expected[name], list) else expected[name]
+                    shutil.copyfile(str(entry / fname), dest)
+            self._metric_value = meta['metric_value']
+            self._elapsed_time = meta['elapsed_time']
+            runtime.returncode = 0
+            return runtime
+        runtime = super(CachedRegistration, self)._run_interface(runtime, correct_return_codes)
+        if runtime.returncode not in correct_return_codes:
+            return runtime
+        files = {name: paths for name, paths in _local_outputs(self._list_outputs(), cwd).items()
+                 if all(os.path.exists(p) for _, p in paths)}
+        cache_dir.mkdir(parents=True, exist_ok=True)
+        tmp = tempfile.mkdtemp(prefix='.tmp', dir=str(cache_dir))
+        meta = {'files': {}, 'metric_value': self._metric_value, 'elapsed_time': self._elapsed_time}
+        for name, paths in files.items():
+            meta['files'][name] = []
+            for index, path in paths:
+                fname = '{}_{}_{}'.format(name, index, os.path.basename(path))
+                shutil.copyfile(path, os.path.join(tmp, fname))
+                meta['files'][name].append((index, fname))
+        Path(tmp, 'metadata.json').write_text(json.dumps(meta))
+        try:
+            os.rename(tmp, str(entry))
+        except OSError:
+            # another process stored the same entry first
+            shutil.rmtree(tmp)
+        return runtime
@@ -0,0 +1,77 @@
+"""Base classes for command line interfaces which are multithreaded or have an
+in-process implementation"""
+from nipype.interfaces.base import (CommandLine,
+                                    CommandLineInputSpec,
+                                    traits)
+from nipype import logging
+from ..utils import InProcessUnsupportedError
+
+
+iflogger = logging.getLogger('nipype.interface')
+#: Environment variables which limit the number of threads used by ITK and OpenMP programs
+THREAD_VARIABLES = ('ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS', 'OMP_NUM_THREADS')
+
+
+def set_thread_environ(environ, num_threads):
+    """Set the :py:data:`THREAD_VARIABLES` in environ to num_threads.
+
+    :param environ: dictionary of environment variables, modified in place
+    :param num_threads: number of threads
+    """
+    for var in THREAD_VARIABLES:
+        environ[var] = str(num_threads)
+
+
+def num_threads_trait():
+    """Return a :py:obj:`num_threads` trait. Since nipype plugins schedule a node by
+    its :py:obj:`num_threads`, it must be at least 1 (e.g. -1 would let MultiProc
+    start more nodes than there are processors)"""
+    return traits.Range(low=1, value=1, usedefault=True, nohash=True,
+                        desc='Number of threads. Also used by nipype plugins as the number of '
+                             'processors the node needs')
+
+
+class ThreadedCommandLineInputSpec(CommandLineInputSpec):
+    num_threads = num_threads_trait()
+
+
+class ThreadedCommandLine(CommandLine):
+    """A command line interface whose thread count is set by :py:obj:`num_threads`,
+    through the :py:data:`THREAD_VARIABLES` environment variables. Since
+    :py:class:`nipype.pipeline.engine.Node` reads :py:obj:`n_procs` from :py:obj:`num_threads`,
+    the MultiProc plugin schedules these nodes according to the threads they will use.
+    """
+
+    def __init__(self, **inputs):
+        super().__init__(**inputs)
+        self.inputs.on_trait_change(self._num_threads_update, 'num_threads')
+        self._num_threads_update()
+
+    def _num_threads_update(self):
+        set_thread_environ(self.inputs.environ, self.inputs.num_threads)
+
+
+class InProcessCommandLineInputSpec(ThreadedCommandLineInputSpec):
+    use_cli = traits.Bool(False, usedefault=True,
+                          desc='Always run the command line tool instead of the in-process implementation')
+
+
+class InProcessCommandLine(ThreadedCommandLine):
+    """A command line interface which is run in-process when possible.
+
+    Subclasses implement :py:meth:`_run_in_process`, which should raise
+    :py:class:`pndniworkflows.utils.InProcessUnsupportedError` for inputs it
+    cannot handle. In that case (or if :py:obj:`use_cli` is set) the command line
+    tool is run instead.
+    """
+
+    def _run_interface(self, runtime):
+        if not self.inputs.use_cli:
+            try:
+                return self._run_in_process(runtime)
+            except InProcessUnsupportedError as e:
+                iflogger.info(f'{self.__class__.__name__}: falling back to {self.cmd} ({e})')
+        return super()._run_interface(runtime)
+
+    def _run_in_process(self, runtime):
+        raise InProcessUnsupportedError('no in-process implementation')
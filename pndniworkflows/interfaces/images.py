@@ -0,0 +1,180 @@
+"""Interfaces to the in-process image operations in :py:mod:`pndniworkflows.images`"""
+from nipype.interfaces.base import (traits,
+                                    isdefined,
+                                    File,
+                                    TraitedSpec,
+                                    BaseInterfaceInputSpec,
+                                    SimpleInterface)
+from nipype.utils.filemanip import split_filename
+from pathlib import Path
+import nibabel
+from .base import num_threads_trait
+from ..points import PointArray
+from ..images import (classify_voxels, percentile_normalize, downsample_image, downsample_factors,
+                      foreground_mask, find_neck)
+
+
+class VoxelClassifyInputSpec(BaseInterfaceInputSpec):
+    in_file = File(exists=True, mandatory=True, desc='Image to classify', image_format='nifti')
+    tag_file = File(exists=True, mandatory=True,
+                    desc='Training points. `MINC tag file <https://en.wikibooks.org/wiki/MINC/SoftwareDevelopment/Tag_file_format_reference>`_ '
+                         'where the label of each point is its class')
+    mask_file = File(exists=True, desc='Only classify voxels inside this mask', image_format='nifti')
+    method = traits.Enum('bayes', 'knn', usedefault=True,
+                         desc='"bayes" for a Gaussian Bayes classifier, "knn" for k-nearest neighbours')
+    k = traits.Int(5, usedefault=True, desc='Number of neighbours for "knn"')
+    chunksize = traits.Int(1 << 16, usedefault=True, desc='Number of voxels to classify at a time')
+    num_threads = num_threads_trait()
+
+
+class VoxelClassifyOutputSpec(TraitedSpec):
+    out_file = File(exists=True, desc='Label image', image_format='nifti')
+
+
+class VoxelClassify(SimpleInterface):
+    """Classify voxels in-process (see :py:func:`pndniworkflows.images.classify_voxels`).
+    An alternative to :py:class:`pndniworkflows.interfaces.minc.Classify` which works on
+    NIfTI images directly, so no MINC conversion or relabelling is required.
+    """
+    input_spec = VoxelClassifyInputSpec
+    output_spec = VoxelClassifyOutputSpec
+
+    def _run_interface(self, runtime):
+        tags = PointArray.from_minc_tag(self.inputs.tag_file)
+        _, stem, ext = split_filename(self.inputs.in_file)
+        out_file = str(Path(stem + '_classified' + ext).resolve())
+        mask_file = self.inputs.mask_file if isdefined(self.inputs.mask_file) else None
+        classify_voxels(self.inputs.in_file, tags.coords, tags.labels, out_file,
+                        mask_file=mask_file,
+                        method=self.inputs.method,
+                        k=self.inputs.k,
+                        chunksize=self.inputs.chunksize,
+                        num_threads=self.inputs.num_threads)
+        self._results['out_file'] = out_file
+        return runtime
+
+
+class PercentileNormalizeInputSpec(BaseInterfaceInputSpec):
+    in_file = File(exists=True, mandatory=True, desc='input file', image_format='nifti')
+    mask_file = File(exists=True, desc='Only use voxels inside this mask to calculate the percentiles',
+                     image_format='nifti')
+    const2 = traits.List(traits.Float, minlen=2, maxlen=2, mandatory=True,
+                         desc='Values to which the bottom and top percentiles are mapped')
+    range = traits.Float(mandatory=True,
+                         desc='Percentage of the intensity distribution to exclude at the top and bottom')
+    out_dtype = traits.Enum('float32', 'float64', 'uint8', 'int16', 'uint16', 'int32', usedefault=True,
+                            desc='Output data type. Integer outputs are rounded and clipped')
+    nbins = traits.Int(4096, usedefault=True, desc='Number of histogram bins used to calculate the percentiles')
+
+
+class PercentileNormalizeOutputSpec(TraitedSpec):
+    out_file = File(exists=True, image_format='nifti')
+
+
+class PercentileNormalize(SimpleInterface):
+    """Normalize intensities in-process (see :py:func:`pndniworkflows.images.percentile_normalize`).
+    Equivalent to :py:class:`pndniworkflows.interfaces.minc.INormalize` with
+    :py:obj:`const2` and :py:obj:`range`, but works on NIfTI images directly.
+    """
+    input_spec = PercentileNormalizeInputSpec
+    output_spec = PercentileNormalizeOutputSpec
+
+    def _run_interface(self, runtime):
+        _, stem, ext = split_filename(self.inputs.in_file)
+        out_file = str(Path(stem + '_inorm' + ext).resolve())
+        mask_file = self.inputs.mask_file if isdefined(self.inputs.mask_file) else None
+        percentile_normalize(self.inputs.in_file, out_file,
+                             self.inputs.const2, self.inputs.range,
+                             mask_file=mask_file,
+                             dtype=self.inputs.out_dtype,
+                             nbins=self.inputs.nbins)
+        self._results['out_file'] = out_file
+        return runtime
+
+
+class DownsampleImageInputSpec(BaseInterfaceInputSpec):
+    in_file = File(exists=True, mandatory=True, desc='3D image to downsample', image_format='nifti')
+    factors = traits.Either(traits.Int, traits.List(traits.Int, minlen=3, maxlen=3), mandatory=True,
+                            xor=['voxel_size'], desc='Number of voxels to average along each axis')
+    voxel_size = traits.Float(mandatory=True, xor=['factors'],
+                              desc='Approximate output voxel size (mm). The factors are chosen from the input header '
+                                   '(see :py:func:`pndniworkflows.images.downsample_factors`)')
+
+
+class DownsampleImageOutputSpec(TraitedSpec):
+    out_file = File(exists=True, desc='Downsampled image', image_format='nifti')
+
+
+class DownsampleImage(SimpleInterface):
+    """Downsample an image by block averaging (see :py:func:`pndniworkflows.images.downsample_image`)"""
+    input_spec = DownsampleImageInputSpec
+    output_spec = DownsampleImageOutputSpec
+
+    def _run_interface(self, runtime):
+        _, stem, ext = split_filename(self.inputs.in_file)
+        out_file = str(Path(stem + '_downsampled' + ext).resolve())
+        if isdefined(self.inputs.voxel_size):
+            factors = downsample_factors(nibabel.load(self.inputs.in_file).affine, self.inputs.voxel_size)
+        else:
+            factors = self.inputs.factors
+        downsample_image(self.inputs.in_file, out_file, factors)
+        self._results['out_file'] = out_file
+        return runtime
+
+
+class ForegroundMaskInputSpec(BaseInterfaceInputSpec):
+    in_file = File(exists=True, mandatory=True, desc='Input image', image_format='nifti')
+    fraction = traits.Float(0.1, usedefault=True, desc='Threshold relative to the 98th percentile')
+    dilate = traits.Int(2, usedefault=True, desc='Number of voxels by which to dilate the mask')
+
+
+class ForegroundMaskOutputSpec(TraitedSpec):
+    out_file = File(exists=True, desc='Foreground mask', image_format='nifti')
+
+
+class ForegroundMask(SimpleInterface):
+    """Create a foreground mask (see :py:func:`pndniworkflows.images.foreground_mask`)"""
+    input_spec = ForegroundMaskInputSpec
+    output_spec = ForegroundMaskOutputSpec
+
+    def _run_interface(self, runtime):
+        _, stem, ext = split_filename(self.inputs.in_file)
+        out_file = str(Path(stem + '_mask' + ext).resolve())
+        foreground_mask(self.inputs.in_file, out_file,
+                        fraction=self.inputs.fraction,
+                        dilate=self.inputs.dilate)
+        self._results['out_file'] = out_file
+        return runtime
+
+
+class FindNeckInputSpec(BaseInterfaceInputSpec):
+    in_file = File(exists=True, mandatory=True, desc='T1 image', image_format='nifti')
+    voxel_size = traits.Float(4.0, usedefault=True, desc='Voxel size (mm) of the downsampled head mask')
+    fraction = traits.Float(0.1, usedefault=True, desc='Mask threshold relative to the 98th percentile')
+    min_distance = traits.Float(120.0, usedefault=True,
+                                desc='Minimum distance (mm) from the top of the head to the cutting plane')
+    max_distance = traits.Float(220.0, usedefault=True,
+                                desc='Maximum distance (mm) from the top of the head to the cutting plane')
+
+
+class FindNeckOutputSpec(TraitedSpec):
+    out_file = File(exists=True, desc='TSV file with a point on the cutting plane, for '
+                                      ':py:class:`pndniworkflows.interfaces.utils.CutImage`')
+
+
+class FindNeck(SimpleInterface):
+    """Find the neck cutting plane from the image alone (see :py:func:`pndniworkflows.images.find_neck`)"""
+    input_spec = FindNeckInputSpec
+    output_spec = FindNeckOutputSpec
+
+    def _run_interface(self, runtime):
+        point = find_neck(self.inputs.in_file,
+                          voxel_size=self.inputs.voxel_size,
+                          fraction=self.inputs.fraction,
+                          min_distance=self.inputs.min_distance,
+                          max_distance=self.inputs.max_distance)
+        _, stem, _ = split_filename(self.inputs.in_file)
+        out_file = str(Path(stem + '_neck.tsv').resolve())
+        PointArray([point]).to_tsv(out_file)
+        self._results['out_file'] = out_file
+        return runtime
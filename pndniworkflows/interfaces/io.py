@@ -7,15 +7,173 @@ from nipype.interfaces.base import (Directory,
                                     SimpleInterface)
 from nipype.interfaces import Rename
 from pathlib import Path
-from ..utils import write_labels, chunk, combine_stats_files, get_BIDSLayout_with_conf
-import shutil
+from ..utils import (write_labels, chunk, combine_stats_files, get_BIDSLayout_with_conf,
+                     set_compression, copy_file, file_digest, append_manifest, read_manifest,
+                     MANIFEST_NAME, MANIFEST_ALGORITHM)
+from ..images import downcast_image
+from .base import num_threads_trait
+from contextlib import contextmanager
 import csv
 import errno
+import os
+import shutil
+import tempfile
+
 
-
-class WriteBIDSFileInputSpec(BaseInterfaceInputSpec):
-    in_file = File(exists=True, mandatory=True, desc='input file')
+class ExportInputSpec(BaseInterfaceInputSpec):
+    downcast = traits.Enum('none', 'labels', 'int16', usedefault=True,
+                           desc='Store a NIfTI image with a smaller data type, checking that its values are '
+                                'preserved (see :py:func:`pndniworkflows.images.downcast_image`). '
+                                '"labels" uses the smallest integer type which holds the (integer) values, '
+                                '"int16" scales continuous values to int16 within downcast_tolerance. '
+                                '"none" copies the file')
+    downcast_tolerance = traits.Float(desc='Maximum absolute change of any value with downcast="int16"')
+
+
+def _compress(inputs):
+    return inputs.compress if isdefined(inputs.compress) else None
+
+
+def _image_writer(inputs, in_file):
+    def write(out_file, algorithm):
+        if inputs.downcast == 'none':
+            return copy_file(in_file, out_file, algorithm=algorithm, compress=_compress(inputs))
+        tolerance = inputs.downcast_tolerance if isdefined(inputs.downcast_tolerance) else None
+        downcast_image(in_file, out_file, mode=inputs.downcast, tolerance=tolerance)
+        # nibabel writes the file, so it is read again to hash it
+        return file_digest(out_file, algorithm) if algorithm is not None else None
+    return write
+
+
+def _image_params(inputs):
+    # the parameters of _image_writer, recorded in the manifest with its output
+    return {'downcast': inputs.downcast,
+            'downcast_tolerance': inputs.downcast_tolerance if isdefined(inputs.downcast_tolerance) else None,
+            'compress': _compress(inputs)}
+
+
+def _plain_copy(inputs, in_file):
+    # whether _image_writer writes a byte for byte copy of in_file
+    compress = _compress(inputs)
+    return inputs.downcast == 'none' and (compress is None or compress == str(in_file).lower().endswith('.gz'))
+
+
+def _labels_writer(labelinfo):
+    def write(out_file, algorithm):
+        write_labels(str(out_file), labelinfo)
+        return file_digest(out_file, algorithm) if algorithm is not None else None
+    return write
+
+
+@contextmanager
+def _staged(out_file):
+    # a file with the same name as out_file (gzip headers include the name), in a
+    # temporary directory next to it so that it can be renamed into place
+    tmpdir = tempfile.mkdtemp(prefix='.tmp', dir=str(Path(out_file).parent))
+    try:
+        yield Path(tmpdir, Path(out_file).name)
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+
+def _entry_current(out_file, entry):
+    # whether the manifest entry lists out_file with its current size and modification time
+    st = out_file.stat()
+    return entry is not None and entry['size'] == st.st_size and entry['mtime_ns'] == st.st_mtime_ns
+
+
+def _current_hash(out_file, known):
+    # the hash of out_file, taken from the manifest entries if they list it as it is now
+    entry = known.get(str(out_file.resolve()))
+    if _entry_current(out_file, entry):
+        return entry['hash']
+    return file_digest(out_file, MANIFEST_ALGORITHM)
+
+
+def _compare_existing(out_file, known, source, params, copy):
+    # compare out_file with the file which would be written, without writing it.
+    # Returns (same, digest of the new file), where same is None if the comparison
+    # needs the new file, and digest is None if it is not known
+    size = out_file.stat().st_size
+    if copy:
+        if Path(source).stat().st_size != size:
+            return False, None
+        digest = file_digest(source, MANIFEST_ALGORITHM)
+        return _current_hash(out_file, known) == digest, digest
+    entry = known.get(str(out_file.resolve()))
+    if source is not None and _entry_current(out_file, entry) and \
+       entry['source'] == str(source) and entry['params'] == params and \
+       Path(source).stat().st_mtime <= out_file.stat().st_mtime:
+        # made from source with the same parameters, and source has not changed since
+        return True, entry['hash']
+    return None, None
+
+
+def _unchanged(out_file, new_file, digest, known):
+    if out_file.stat().st_size != new_file.stat().st_size:
+        return False
+    return _current_hash(out_file, known) == digest
+
+
+def _write_output(write, out_file, on_exists='error', manifest=None, record=False, source=None, params=None, copy=False):
+    """Write out_file with write(file_name, algorithm), which returns the digest of
+    file_name if algorithm is not None. The file is written to a temporary file and renamed,
+    so out_file is never left incomplete.
+
+    If out_file exists, 'error' raises :py:class:`FileExistsError`. Otherwise it is compared with
+    the new file, without writing the new file where possible. If copy is true (the new file is a
+    copy of source), source is compared with out_file by size, then by hash (taken from manifest if
+    it has an entry with the current size and modification time of out_file). If not, out_file is the
+    same if manifest records it, with its current size and modification time, as made from source with
+    params (the parameters of write), and source has not been modified since.
+    Otherwise the new file is written to a temporary file and compared with out_file.
+    If they are the same, out_file is left as is; if not, 'skip' raises
+    :py:class:`FileExistsError` and 'replace' replaces it.
+
+    :return: True if out_file was written
+    """
+    out_file = Path(out_file)
+    exists = out_file.exists()
+    if exists and on_exists == 'error':
+        raise FileExistsError(errno.EEXIST, f'File {out_file} exists')
+    known = read_manifest(manifest) if manifest is not None and (exists or record) else {}
+    same, digest = _compare_existing(out_file, known, source, params, copy) if exists else (False, None)
+    if exists and same is False and on_exists == 'skip':
+        raise FileExistsError(errno.EEXIST, f'File {out_file} exists with different contents')
+    written = not same
+    if written:
+        algorithm = MANIFEST_ALGORITHM if (exists or record) and digest is None else None
+        with _staged(out_file) as tmp:
+            new_digest = write(tmp, algorithm)
+            digest = digest if new_digest is None else new_digest
+            if exists and same is None:
+                written = not _unchanged(out_file, tmp, digest, known)
+                if written and on_exists == 'skip':
+                    raise FileExistsError(errno.EEXIST, f'File {out_file} exists with different contents')
+            if written:
+                os.replace(str(tmp), str(out_file))
+    entry = known.get(str(out_file.resolve()))
+    if record and (not _entry_current(out_file, entry) or entry['hash'] != digest or entry['params'] != params):
+        append_manifest(manifest, out_file, digest, source=source, params=params)
+    return written
+
+
+class BIDSExportInputSpec(ExportInputSpec):
     out_dir = Directory(exists=True, mandatory=True, desc='output directory (bids root)')
+    compress = traits.Bool(desc='If true, gzip the output file. If false, write it uncompressed. '
+                                'If undefined, copy the input as is')
+    manifest = traits.Bool(False, usedefault=True,
+                           desc='Hash the output files while they are written, and append them to the '
+                                'manifest in out_dir (see :py:func:`pndniworkflows.utils.append_manifest`)')
+    on_exists = traits.Enum('error', 'skip', 'replace', usedefault=True,
+                            desc='What to do if an output file exists. "error" raises an error. Otherwise '
+                                 'the files are compared (using the hashes in the manifest in out_dir, '
+                                 'if it lists them), and an identical file is left as is. A different file '
+                                 'raises an error with "skip", and is replaced with "replace"')
+
+
+class WriteBIDSFileInputSpec(BIDSExportInputSpec):
+    in_file = File(exists=True, mandatory=True, desc='input file')
     labelinfo = traits.List(desc=':py:obj:`list` of :py:obj:`dict`. If specified, will be written '
                                  'to a tsv file corresponding to the output bids file using '
                                  ':py:func:`utils.write_labels`')
@@ -42,40 +200,113 @@ class WriteBIDSFileOutputSpec(TraitedSpec):
     out_labelfile = File(desc='output label file name')
 
 
+def _bids_path(inputs, layout, bidsargs):
+    p = layout.build_path(bidsargs, strict=True, validate=False)
+    if p is None:
+        raise RuntimeError('BIDSLayout was unable to build a path with parameters ' + ', '.join([f'{key}: {val}' for key, val in bidsargs.items()]))
+    outfull = (Path(inputs.out_dir) / p).resolve()
+    if outfull.exists() and inputs.on_exists == 'error':
+        raise RuntimeError(f'{str(outfull)} already exists')
+    return outfull
+
+
+def _bids_outputs(inputs, layout, in_file, bidsparams, labelinfo):
+    # the output file and label file (or None) names
+    if 'extension' in bidsparams.keys():
+        raise ValueError('"extension" must not be specified. It is determined from the input file')
+    extension = set_compression(''.join(Path(in_file).suffixes), _compress(inputs))
+    args = {'extension': extension[1:]}
+    for key, val in bidsparams.items():
+        args[key] = val
+    outfull = _bids_path(inputs, layout, args)
+    outtsv = None
+    if labelinfo is not None:
+        args['extension'] = 'tsv'
+        args['presuffix'] = args['suffix']
+        args['suffix'] = 'labels'
+        outtsv = _bids_path(inputs, layout, args)
+    return outfull, outtsv
+
+
+def _write_bids_outputs(inputs, in_file, labelinfo, outfull, outtsv):
+    manifest = Path(inputs.out_dir, MANIFEST_NAME)
+    outfull.parent.mkdir(parents=True, exist_ok=True)
+    _write_output(_image_writer(inputs, in_file), outfull,
+                  on_exists=inputs.on_exists, manifest=manifest, record=inputs.manifest,
+                  source=Path(in_file).resolve(), params=_image_params(inputs), copy=_plain_copy(inputs, in_file))
+    if outtsv is not None:
+        outtsv.parent.mkdir(parents=True, exist_ok=True)
+        _write_output(_labels_writer(labelinfo), outtsv,
+                      on_exists=inputs.on_exists, manifest=manifest, record=inputs.manifest)
+
+
 class WriteBIDSFile(SimpleInterface):
-    """Copy the input file to a file with a bids-style name"""
+    """Copy the input file to a file with a bids-style name.
+
+    Files are written to a temporary file and renamed, so an interrupted export
+    does not leave incomplete files, and can be resumed with :py:obj:`on_exists`.
+    """
 
     input_spec = WriteBIDSFileInputSpec
     output_spec = WriteBIDSFileOutputSpec
 
     def _run_interface(self, runtime):
-        if 'extension' in self.inputs.bidsparams.keys():
-            raise ValueError('"extension" must not be specified. It is determined from the input file')
-        args = {'extension': ''.join(Path(self.inputs.in_file).suffixes)[1:]}
-        for key, val in self.inputs.bidsparams.items():
-            args[key] = val
-        outfull = self.__make_and_prepare_bids_file(args)
+        labelinfo = self.inputs.labelinfo if isdefined(self.inputs.labelinfo) else None
+        layout = get_BIDSLayout_with_conf(self.inputs.out_dir, validate=False)
+        outfull, outtsv = _bids_outputs(self.inputs, layout, self.inputs.in_file, self.inputs.bidsparams, labelinfo)
         self._results['out_file'] = str(outfull)
-        shutil.copy(self.inputs.in_file, outfull)
-        if isdefined(self.inputs.labelinfo):
-            args['extension'] = 'tsv'
-            args['presuffix'] = args['suffix']
-            args['suffix'] = 'labels'
-            outtsv = self.__make_and_prepare_bids_file(args)
+        if outtsv is not None:
             self._results['out_labelfile'] = str(outtsv)
-            write_labels(str(outtsv), self.inputs.labelinfo)
+        _write_bids_outputs(self.inputs, self.inputs.in_file, labelinfo, outfull, outtsv)
         return runtime
 
-    def __make_and_prepare_bids_file(self, bidsargs):
-        b = get_BIDSLayout_with_conf(self.inputs.out_dir, validate=False)
-        p = b.build_path(bidsargs, strict=True, validate=False)
-        if p is None:
-            raise RuntimeError('BIDSLayout was unable to build a path with parameters ' + ', '.join([f'{key}: {val}' for key, val in bidsargs.items()]))
-        outfull = (Path(self.inputs.out_dir) / p).resolve()
-        if outfull.exists():
-            raise RuntimeError(f'{str(outfull)} already exists')
-        outfull.parent.mkdir(parents=True, exist_ok=True)
-        return outfull
+
+class WriteBIDSFilesInputSpec(BIDSExportInputSpec):
+    in_files = traits.List(File(exists=True), mandatory=True, desc='input files')
+    bidsparams = traits.List(traits.DictStrAny(), mandatory=True,
+                             desc='Bids parameters for each input file (see :py:class:`WriteBIDSFile`)')
+    labelinfo = traits.List(traits.Either(None, traits.List()),
+                            desc='Label information for each input file (see :py:class:`WriteBIDSFile`), '
+                                 'or None for files without labels')
+    num_threads = num_threads_trait()
+
+
+class WriteBIDSFilesOutputSpec(TraitedSpec):
+    out_files = traits.List(File(exists=True), desc='output file names')
+    out_labelfiles = traits.List(traits.Either(None, File(exists=True)),
+                                 desc='output label file names (None for files without labels)')
+
+
+class WriteBIDSFiles(SimpleInterface):
+    """:py:class:`WriteBIDSFile` for a list of files, so that all of a subject's outputs can
+    be exported by one node. The output names are all built with one
+    :py:class:`bids.layout.BIDSLayout` (and checked to be distinct) before any file is
+    written, and the files are then written by :py:obj:`num_threads` threads.
+    """
+
+    input_spec = WriteBIDSFilesInputSpec
+    output_spec = WriteBIDSFilesOutputSpec
+
+    def _run_interface(self, runtime):
+        from concurrent.futures import ThreadPoolExecutor
+        n = len(self.inputs.in_files)
+        labelinfo = self.inputs.labelinfo if isdefined(self.inputs.labelinfo) else [None] * n
+        if len(self.inputs.bidsparams) != n or len(labelinfo) != n:
+            raise ValueError('in_files, bidsparams, and labelinfo must have the same length')
+        layout = get_BIDSLayout_with_conf(self.inputs.out_dir, validate=False)
+        outputs = [_bids_outputs(self.inputs, layout, in_file, bidsparams, labels)
+                   for in_file, bidsparams, labels in zip(self.inputs.in_files, self.inputs.bidsparams, labelinfo)]
+        names = [f for pair in outputs for f in pair if f is not None]
+        if len(set(names)) != len(names):
+            raise ValueError('Several inputs have the same output file name')
+        with ThreadPoolExecutor(self.inputs.num_threads) as pool:
+            futures = [pool.submit(_write_bids_outputs, self.inputs, in_file, labels, outfull, outtsv)
+                       for in_file, labels, (outfull, outtsv) in zip(self.inputs.in_files, labelinfo, outputs)]
+            for future in futures:
+                future.result()
+        self._results['out_files'] = [str(outfull) for outfull, _ in outputs]
+        self._results['out_labelfiles'] = [None if outtsv is None else str(outtsv) for _, outtsv in outputs]
+        return runtime
 
 
 class WriteFSLStatsInputSpec(BaseInterfaceInputSpec):
@@ -237,11 +468,17 @@ class RenameAndCheckExtension(Rename):
         return runtime
 
 
-class ExportFileInputSpec(BaseInterfaceInputSpec):
+class ExportFileInputSpec(ExportInputSpec):
     in_file = File(exists=True, desc='Input file name')
     out_file = File(exists=False, desc='Output file name')
     check_extension = traits.Bool(False, desc='Ensure that the input and output file extensions match')
     clobber = traits.Bool(False, desc='Permit overwriting existing files')
+    compress = traits.Bool(desc='If true, gzip the output file. If false, write it uncompressed. '
+                                'If undefined, copy the input as is. out_file must end in ".gz" '
+                                'if and only if compress is true')
+    manifest = File(hash_files=False,
+                    desc='If specified, hash the output file while it is written, and append it to this '
+                         'manifest (see :py:func:`pndniworkflows.utils.append_manifest`)')
 
 
 class ExportFileOutputSpec(TraitedSpec):
@@ -249,6 +486,11 @@ class ExportFileOutputSpec(TraitedSpec):
 
 
 class ExportFile(SimpleInterface):
+    """Copy a file to :py:obj:`out_file`. If :py:obj:`compress` is defined, the file is
+    compressed or decompressed as needed while it is copied (and ".gz" is ignored by
+    :py:obj:`check_extension`).
+    """
+
     input_spec = ExportFileInputSpec
     output_spec = ExportFileOutputSpec
 
@@ -257,8 +499,17 @@ class ExportFile(SimpleInterface):
         out_file = Path(self.inputs.out_file)
         if not self.inputs.clobber and out_file.exists():
             raise FileExistsError(errno.EEXIST, f'File {out_file} exists')
-        if self.inputs.check_extension and in_file.suffix != out_file.suffix:
+        compress = _compress(self.inputs)
+        if compress is not None and set_compression(out_file, compress) != str(out_file):
+            raise ValueError(f'{out_file} must {"" if compress else "not "}end in ".gz" with compress={compress}')
+        # ".gz" is only ignored if the file is (de)compressed
+        strip = str if compress is None else (lambda f: set_compression(f, False))
+        if self.inputs.check_extension and Path(strip(in_file)).suffix != Path(strip(out_file)).suffix:
             raise MismatchedExtensionError(f'{in_file} and {out_file} have different extensions')
-        shutil.copy(str(in_file), str(out_file))
+        manifest = self.inputs.manifest if isdefined(self.inputs.manifest) else None
+        _write_output(_image_writer(self.inputs, in_file), out_file,
+                      on_exists='replace' if self.inputs.clobber else 'error',
+                      manifest=manifest, record=manifest is not None, source=in_file.resolve(),
+                      params=_image_params(self.inputs), copy=_plain_copy(self.inputs, in_file))
         self._results['out_file'] = self.inputs.out_file
         return runtime
@@ -6,25 +6,45 @@ Some argument descriptions are copied from the minc help, and as such is
 Copyright the MINC developers, McConnell Brain Imaging Centre,
 Montreal Neurological Institute, McGill University.
 """
-from nipype.interfaces.base import (CommandLine,
-                                    CommandLineInputSpec,
-                                    File,
+from nipype.interfaces.base import (File,
                                     Directory,
                                     TraitedSpec,
                                     Undefined,
+                                    isdefined,
                                     traits)
 from pathlib import Path
-
-
-class Mnc2niiInputSpec(CommandLineInputSpec):
+import subprocess
+from .base import (ThreadedCommandLine, ThreadedCommandLineInputSpec,
+                   InProcessCommandLine, InProcessCommandLineInputSpec)
+from ..mincio import minc_dtype, minc2nifti, nifti2minc
+from ..utils import features2npy
+
+
+def _output_dtype(inputs):
+    """Get the output dtype from the write_* options of Mnc2nii or Nii2mnc"""
+    for outtype in ('byte', 'short', 'int', 'float', 'double'):
+        if getattr(inputs, f'write_{outtype}'):
+            break
+    else:
+        return None
+    if inputs.write_signed:
+        signed = True
+    elif inputs.write_unsigned:
+        signed = False
+    else:
+        signed = None
+    return minc_dtype(outtype, signed)
+
+
+class Mnc2niiInputSpec(InProcessCommandLineInputSpec):
     in_file = File(exists=True, argstr='%s', mandatory=True,
-                   position=-2, desc='input_file')
+                   position=-2, desc='input_file', image_format='minc')
     out_file = File(argstr='%s', position=-1, desc='output file',
                     genfile=True,
                     hash_files=False,
                     name_source=['in_file'],
                     name_template='%s.nii',
-                    keep_extension=False)
+                    keep_extension=False, image_format='nifti')
     _xor_outtype = ('write_byte', 'write_short', 'write_int', 'write_float', 'write_double')
     write_byte = traits.Bool(desc='Write voxel data in 8-bit integer format',
                              argstr='-byte', xor=_xor_outtype)
@@ -48,24 +68,31 @@ class Mnc2niiInputSpec(CommandLineInputSpec):
 
 
 class Mnc2niiOutputSpec(TraitedSpec):
-    out_file = File(desc='output file', exists=True)
+    out_file = File(desc='output file', exists=True, image_format='nifti')
 
 
-class Mnc2nii(CommandLine):
-    """Interface to mnc2nii"""
+class Mnc2nii(InProcessCommandLine):
+    """Interface to mnc2nii. MINC 2.0 files are converted in-process
+    (see :py:func:`pndniworkflows.mincio.minc2nifti`) if h5py is available."""
 
     input_spec = Mnc2niiInputSpec
     output_spec = Mnc2niiOutputSpec
     _cmd = 'mnc2nii'
 
+    def _run_in_process(self, runtime):
+        minc2nifti(self.inputs.in_file, self._list_outputs()['out_file'],
+                   dtype=_output_dtype(self.inputs),
+                   scan_range=not (isdefined(self.inputs.noscanrange) and self.inputs.noscanrange))
+        return runtime
+
 
-class Nii2mncInputSpec(CommandLineInputSpec):
+class Nii2mncInputSpec(InProcessCommandLineInputSpec):
     in_file = File(exists=True, argstr='%s', mandatory=True,
-                   position=-2, desc='input_file')
+                   position=-2, desc='input_file', image_format='nifti')
     out_file = File(argstr='%s', position=-1, desc='output file',
                     name_source=['in_file'], name_template='%s.mnc',
                     keep_extension=False,
-                    hash_files=False)
+                    hash_files=False, image_format='minc')
     _xor_outtype = ('write_byte', 'write_short', 'write_int', 'write_float', 'write_double')
     write_byte = traits.Bool(desc='Write voxel data in 8-bit integer format',
                              argstr='-byte', xor=_xor_outtype)
@@ -89,35 +116,43 @@ class Nii2mncInputSpec(CommandLineInputSpec):
 
 
 class Nii2mncOutputSpec(TraitedSpec):
-    out_file = File(desc='output file', exists=True)
+    out_file = File(desc='output file', exists=True, image_format='minc')
 
 
-class Nii2mnc(CommandLine):
-    """Interface to nii2mnc"""
+class Nii2mnc(InProcessCommandLine):
+    """Interface to nii2mnc. NIfTI files are converted to MINC 2.0 in-process
+    (see :py:func:`pndniworkflows.mincio.nifti2minc`) if h5py is available.
+    Integer outputs are scaled slice by slice from data already in memory,
+    so :py:obj:`noscanrange` has no effect in that case."""
 
     input_spec = Nii2mncInputSpec
     output_spec = Nii2mncOutputSpec
     _cmd = 'nii2mnc'
 
+    def _run_in_process(self, runtime):
+        nifti2minc(self.inputs.in_file, self._list_outputs()['out_file'],
+                   dtype=_output_dtype(self.inputs))
+        return runtime
+
 
-class NUCorrectInputSpec(CommandLineInputSpec):
+class NUCorrectInputSpec(ThreadedCommandLineInputSpec):
     in_file = File(exists=True, argstr='%s', mandatory=True,
-                   position=-2, desc='input file')
+                   position=-2, desc='input file', image_format='minc')
     out_file = File(argstr='%s', position=-1, desc='output file',
                     name_source=['in_file'],
                     name_template='%s_nucor',
-                    keep_extension=True, hash_files=False)
+                    keep_extension=True, hash_files=False, image_format='minc')
     tmpdir = Directory(argstr='-tmpdir %s',
                        desc='temporary working directory')
     mask = File(exists=True, argstr='-mask %s',
-                desc='specify region for processing')
+                desc='specify region for processing', image_format='minc')
 
 
 class NUCorrectOutputSpec(TraitedSpec):
-    out_file = File(exists=True)
+    out_file = File(exists=True, image_format='minc')
 
 
-class NUCorrect(CommandLine):
+class NUCorrect(ThreadedCommandLine):
     """Interface to nu_correct"""
 
     input_spec = NUCorrectInputSpec
@@ -125,13 +160,13 @@ class NUCorrect(CommandLine):
     _cmd = 'nu_correct'
 
 
-class INormalizeInputSpec(CommandLineInputSpec):
+class INormalizeInputSpec(ThreadedCommandLineInputSpec):
     in_file = File(exists=True, argstr='%s', mandatory=True,
-                   position=-2, desc='input file')
+                   position=-2, desc='input file', image_format='minc')
     out_file = File(argstr='%s', position=-1, desc='output file',
                     name_source=['in_file'],
                     name_template='%s_inorm',
-                    keep_extension=True, hash_files=False)
+                    keep_extension=True, hash_files=False, image_format='minc')
     const2 = traits.List(traits.Float, minlen=2, maxlen=2,
                          argstr='-const2 %s',
                          desc='specify two constant values (for -range).')
@@ -142,35 +177,40 @@ class INormalizeInputSpec(CommandLineInputSpec):
 
 
 class INormalizeOutputSpec(TraitedSpec):
-    out_file = File(exists=True)
+    out_file = File(exists=True, image_format='minc')
 
 
-class INormalize(CommandLine):
-    """Interface to inormalize"""
+class INormalize(ThreadedCommandLine):
+    """Interface to inormalize. See also
+    :py:class:`pndniworkflows.interfaces.images.PercentileNormalize`"""
 
     input_spec = INormalizeInputSpec
     output_spec = INormalizeOutputSpec
     _cmd = 'inormalize'
 
 
-class ClassifyInputSpec(CommandLineInputSpec):
+class ClassifyInputSpec(ThreadedCommandLineInputSpec):
     tag_file = File(exists=True, argstr='-tagfile %s', mandatory=True,
                     desc='`Format reference <https://en.wikibooks.org/wiki/MINC/SoftwareDevelopment/Tag_file_format_reference>`_')
-    in_file = File(exists=True, position=-2, argstr='%s', mandatory=True)
-    mask_file = File(exists=True, position=1, argstr='-mask %s')
+    in_file = File(exists=True, position=-2, argstr='%s', mandatory=True, image_format='minc')
+    mask_file = File(exists=True, position=1, argstr='-mask %s', image_format='minc')
     dump_features = traits.Bool(position=0, argstr='-dump_features', xor=('out_file',),
                                 desc='Output the feature matrix instead of running the classifier')
+    features_npy = traits.Bool(False, usedefault=True, requires=['dump_features'],
+                               desc='Also convert the feature matrix to a binary .npy file')
     out_file = File(position=-1, genfile=True,
-                    argstr='%s', xor=('dump_features',))
+                    argstr='%s', xor=('dump_features',), image_format='minc')
 
 
 class ClassifyOutputSpec(TraitedSpec):
-    out_file = File()
+    out_file = File(image_format='minc')
     features = File()
+    features_npy = File(desc='Feature matrix as a float64 .npy file')
 
 
-class Classify(CommandLine):
-    """Interface to classify"""
+class Classify(ThreadedCommandLine):
+    """Interface to classify. With :py:obj:`dump_features`, the standard output
+    of classify is written directly to :py:obj:`features` rather than being held in memory."""
 
     input_spec = ClassifyInputSpec
     output_spec = ClassifyOutputSpec
@@ -178,17 +218,32 @@ class Classify(CommandLine):
     _terminal_output = 'file_split'
 
     def _run_interface(self, runtime):
-        # inspired by afni OutlierCount
-        runtime = super(Classify, self)._run_interface(runtime)
-        if self.inputs.dump_features:
-            out_features = self._gen_outfeatures()
-            with open(out_features, 'x') as f:
-                f.write(runtime.stdout)
+        if not self.inputs.dump_features:
+            return super(Classify, self)._run_interface(runtime)
+        out_features = self._gen_outfeatures()
+        runtime.cmdline = self.cmdline
+        runtime.environ.update(self._get_environ())
+        runtime.success_codes = (0,)
+        errfile = Path(runtime.cwd) / 'stderr.nipype'
+        with open(out_features, 'xb') as fout, open(errfile, 'wb') as ferr:
+            proc = subprocess.run(runtime.cmdline, shell=True, cwd=runtime.cwd,
+                                  env=runtime.environ, stdout=fout, stderr=ferr)
+        runtime.returncode = proc.returncode
+        runtime.stdout = ''
+        runtime.stderr = errfile.read_text(errors='replace')
+        runtime.merged = runtime.stderr
+        if runtime.returncode != 0:
+            raise RuntimeError(f'{runtime.cmdline} exited with code {runtime.returncode}:\n{runtime.stderr}')
+        if self.inputs.features_npy:
+            features2npy(out_features, self._gen_outfeatures_npy())
         return runtime
 
     def _gen_outfeatures(self):
         return str(Path('features.txt').resolve())
 
+    def _gen_outfeatures_npy(self):
+        return str(Path('features.npy').resolve())
+
     def _gen_out_filename(self):
         inpath = Path(self.inputs.in_file)
         suffixes = ''.join(inpath.suffixes)
@@ -198,6 +253,8 @@ class Classify(CommandLine):
         outputs = self.output_spec().get()
         if self.inputs.dump_features:
             outputs['features'] = self._gen_outfeatures()
+            if self.inputs.features_npy:
+                outputs['features_npy'] = self._gen_outfeatures_npy()
         else:
             outputs['out_file'] = self._gen_out_filename()
         return outputs
@@ -213,24 +270,24 @@ class Classify(CommandLine):
             return None
 
 
-class MincLookupInputSpec(CommandLineInputSpec):
+class MincLookupInputSpec(ThreadedCommandLineInputSpec):
     discrete = traits.Bool(argstr='-discrete', mandatory=True,
                            desc='Lookup table has discrete (integer) entries - range is ignored.')
     lut_string = traits.String(argstr='-lut_string %s', mandatory=True,
                                desc='String containing the lookup table, with ";" to separate lines.')
     in_file = File(exists=True, position=-2, argstr='%s',
-                   mandatory=True)
+                   mandatory=True, image_format='minc')
     out_file = File(position=-1, name_source='in_file',
                     name_template='%s_lut',
                     keep_extension=True,
-                    argstr='%s')
+                    argstr='%s', image_format='minc')
 
 
 class MincLookupOutputSpec(TraitedSpec):
-    out_file = File(exists=True)
+    out_file = File(exists=True, image_format='minc')
 
 
-class MincLookup(CommandLine):
+class MincLookup(ThreadedCommandLine):
     """Interface to minclookup"""
 
     input_spec = MincLookupInputSpec
@@ -1,16 +1,20 @@
 """Interfaces for `pndni_utils <https://github.com/pndni/pndni_utils>`_"""
-from nipype.interfaces.base import (CommandLine,
-                                    CommandLineInputSpec,
-                                    BaseInterfaceInputSpec,
+from nipype.interfaces.base import (BaseInterfaceInputSpec,
                                     SimpleInterface,
                                     File,
                                     TraitedSpec,
                                     traits,
+                                    isdefined,
                                     InputMultiPath,
                                     OutputMultiPath)
 import os
 from pathlib import Path
-from pndni.convertpoints import Points
+from ..points import PointArray
+from .base import (ThreadedCommandLine, ThreadedCommandLineInputSpec,
+                   InProcessCommandLine, InProcessCommandLineInputSpec)
+from ..images import forceqform, labels2probmaps
+from ..utils import InProcessUnsupportedError
+from ..mincio import default_dircos, minc2nifti
 
 
 # from BEP011 (https://docs.google.com/document/d/1YG2g4UkEio4t_STIBOqYOwneLEs1emHIXbGKynx7V0Y/edit#heading=h.mqkmyp254xh6)
@@ -29,42 +33,81 @@ BIDS_LABELS = [('Background', 'BG'),
                ('Cerebellum', 'CBM')]
 
 
-class MncLabel2NiiLabelInputSpec(CommandLineInputSpec):
-    in_file = File(exists=True, mandatory=True, argstr='%s', position=0)
+class MncLabel2NiiLabelInputSpec(InProcessCommandLineInputSpec):
+    in_file = File(exists=True, mandatory=True, argstr='%s', position=0, image_format='minc')
     out_file = File(argstr='%s', position=1, name_source=['in_file'],
-                    hash_files=False, name_template='%s.nii')
+                    hash_files=False, name_template='%s.nii', image_format='nifti')
 
 
 class MncLabel2NiiLabelOutputSpec(TraitedSpec):
-    out_file = File(exists=True)
+    out_file = File(exists=True, image_format='nifti')
 
 
-class MncLabel2NiiLabel(CommandLine):
+class MncLabel2NiiLabel(InProcessCommandLine):
+    """Interface to mnclabel2niilabel. MINC 2.0 files are converted in-process
+    (see :py:func:`pndniworkflows.mincio.minc2nifti` with ``labels=True``)
+    if h5py is available."""
     input_spec = MncLabel2NiiLabelInputSpec
     output_spec = MncLabel2NiiLabelOutputSpec
     _cmd = 'mnclabel2niilabel'
 
+    def _run_in_process(self, runtime):
+        minc2nifti(self.inputs.in_file, self._list_outputs()['out_file'], labels=True)
+        return runtime
+
 
-class Labels2ProbMapsInputSpec(CommandLineInputSpec):
+class Labels2ProbMapsInputSpec(InProcessCommandLineInputSpec):
     output_template = traits.Str(default='out_{label}.nii.gz', argstr='%s', position=0,
                                  desc='Template string for output files. Must contain {label}.')
     input_files = InputMultiPath(File(exists=True), mandatory=True, argstr='%s', position=1)
     labels = traits.ListInt(minlen=1, mandatory=True, argstr='--labels %s')
     bids_labels = traits.Bool(argstr='--bids_labels',
                               desc='Assume label numbers correspond to then standard anatomical labels in BEP011')
+    out_dtype = traits.Enum('float32', 'uint8', 'uint16', usedefault=True,
+                            desc='Output data type. Integer outputs are stored with scl_slope '
+                                 '(see :py:func:`pndniworkflows.images.labels2probmaps`). '
+                                 'Only float32 is supported by labels2probmaps')
+    merged_file = File(hash_files=False,
+                       desc='If specified, write a single 4D file with one volume per label (in the '
+                            'order of labels) instead of using output_template. Not supported by labels2probmaps')
 
 
 class Labels2ProbMapsOutputSpec(TraitedSpec):
     output_files = OutputMultiPath(File(exists=True))
 
 
-class Labels2ProbMaps(CommandLine):
+class Labels2ProbMaps(InProcessCommandLine):
+    """Interface to labels2probmaps. NIfTI files are processed in-process
+    (see :py:func:`pndniworkflows.images.labels2probmaps`), reading each input file
+    once for all labels."""
     input_spec = Labels2ProbMapsInputSpec
     output_spec = Labels2ProbMapsOutputSpec
     _cmd = 'labels2probmaps'
 
+    def _cli_supported(self):
+        return self.inputs.out_dtype == 'float32' and not isdefined(self.inputs.merged_file)
+
+    def _run_interface(self, runtime):
+        if self.inputs.use_cli and not self._cli_supported():
+            raise ValueError('out_dtype and merged_file require the in-process implementation')
+        return super(Labels2ProbMaps, self)._run_interface(runtime)
+
+    def _run_in_process(self, runtime):
+        try:
+            labels2probmaps(self.inputs.input_files, self.inputs.labels,
+                            self._list_outputs()['output_files'],
+                            out_dtype=self.inputs.out_dtype)
+        except InProcessUnsupportedError as e:
+            if not self._cli_supported():
+                raise ValueError(f'out_dtype and merged_file require the in-process implementation ({e})')
+            raise
+        return runtime
+
     def _list_outputs(self):
         outputs = self.output_spec().get()
+        if isdefined(self.inputs.merged_file):
+            outputs['output_files'] = [os.path.abspath(self.inputs.merged_file)]
+            return outputs
         if self.inputs.bids_labels:
             labels = [BIDS_LABELS[l][1] for l in self.inputs.labels]
         else:
@@ -74,7 +117,7 @@ class Labels2ProbMaps(CommandLine):
         return outputs
 
 
-class SwapLabelsInputSpec(CommandLineInputSpec):
+class SwapLabelsInputSpec(ThreadedCommandLineInputSpec):
     label_map = traits.Dict(key_trait=traits.Int(), value_trait=traits.Int(), position=0, argstr='%s')
     in_file = File(exists=True, argstr='%s', position=1)
     out_file = File(name_source=['in_file'],
@@ -87,7 +130,7 @@ class SwapLabelsOutputSpec(TraitedSpec):
     out_file = File(exists=True)
 
 
-class SwapLabels(CommandLine):
+class SwapLabels(ThreadedCommandLine):
     input_spec = SwapLabelsInputSpec
     output_spec = SwapLabelsOutputSpec
     _cmd = 'swaplabels'
@@ -98,7 +141,7 @@ class SwapLabels(CommandLine):
         return super(SwapLabels, self)._format_arg(name, spec, value)
 
 
-class CombineLabelsInputSpec(CommandLineInputSpec):
+class CombineLabelsInputSpec(ThreadedCommandLineInputSpec):
     label_files = InputMultiPath(exists=True, position=-1, argstr='%s')
     out_file = File(position=0, argstr='%s',
                     genfile=True, hash_files=False)
@@ -108,7 +151,7 @@ class CombineLabelsOutputSpec(TraitedSpec):
     out_file = File(exists=True)
 
 
-class CombineLabels(CommandLine):
+class CombineLabels(ThreadedCommandLine):
     input_spec = CombineLabelsInputSpec
     output_spec = CombineLabelsOutputSpec
     _cmd = 'combinelabels'
@@ -132,44 +175,64 @@ class CombineLabels(CommandLine):
         return outputs
 
 
-class ForceQFormInputSpec(CommandLineInputSpec):
+class ForceQFormInputSpec(InProcessCommandLineInputSpec):
     in_file = File(exists=True, desc='Input NIFTI file', mandatory=True,
-                   argstr='%s', position=0)
+                   argstr='%s', position=0, image_format='nifti')
     out_file = File(argstr='%s', position=1, name_source=['in_file'],
                     hash_files=False, name_template='%s_qform',
-                    keep_extension=True)
+                    keep_extension=True, image_format='nifti')
     maxangle = traits.Float(argstr='--maxangle %s', position=2)
 
 
 class ForceQFormOutputSpec(TraitedSpec):
-    out_file = File(exists=True, desc='Output file')
+    out_file = File(exists=True, desc='Output file', image_format='nifti')
 
 
-class ForceQForm(CommandLine):
+class ForceQForm(InProcessCommandLine):
+    """Interface to forceqform. If the sform (or qform) can be represented
+    exactly as a qform, only the header is rewritten in-process
+    (see :py:func:`pndniworkflows.images.forceqform`). Otherwise the
+    command line tool is used.
+    """
     input_spec = ForceQFormInputSpec
     output_spec = ForceQFormOutputSpec
     _cmd = 'forceqform'
 
+    def _run_in_process(self, runtime):
+        if isdefined(self.inputs.maxangle):
+            raise InProcessUnsupportedError('maxangle is only supported by the command line tool')
+        forceqform(self.inputs.in_file, self._list_outputs()['out_file'])
+        return runtime
+
 
-class MncDefaultDircosInputSpec(CommandLineInputSpec):
+class MncDefaultDircosInputSpec(InProcessCommandLineInputSpec):
     in_file = File(exists=True, desc='Input MINC 2.0 file', mandatory=True,
-                   argstr='%s', position=0)
+                   argstr='%s', position=0, image_format='minc')
     out_file = File(argstr='%s', position=1, name_source=['in_file'],
                     hash_files=False, name_template='%s_dircosfix',
-                    keep_extension=True)
+                    keep_extension=True, image_format='minc')
 
 
 class MncDefaultDircosOutputSpec(TraitedSpec):
-    out_file = File(exists=True, desc='Output file')
+    out_file = File(exists=True, desc='Output file', image_format='minc')
 
 
-class MncDefaultDircos(CommandLine):
+class MncDefaultDircos(InProcessCommandLine):
+    """Interface to minc_default_dircos. If the direction cosines are missing
+    or already close to the defaults, only the dimension attributes are rewritten
+    in-process (see :py:func:`pndniworkflows.mincio.default_dircos`). Otherwise the
+    command line tool is used.
+    """
     input_spec = MncDefaultDircosInputSpec
     output_spec = MncDefaultDircosOutputSpec
     _cmd = 'minc_default_dircos'
 
+    def _run_in_process(self, runtime):
+        default_dircos(self.inputs.in_file, self._list_outputs()['out_file'])
+        return runtime
+
 
-class StatsInputSpec(CommandLineInputSpec):
+class StatsInputSpec(ThreadedCommandLineInputSpec):
     in_file = File(exists=True, desc='Input file', mandatory=True,
                    argstr='%s', position=0)
     index_mask_file = File(exists=True, desc='Mask file',
@@ -183,7 +246,7 @@ class StatsOutputSpec(TraitedSpec):
     out_stat = traits.List(traits.Float())
 
 
-class Stats(CommandLine):
+class Stats(ThreadedCommandLine):
     input_spec = StatsInputSpec
     output_spec = StatsOutputSpec
     _cmd = 'stats'
@@ -242,6 +305,6 @@ class ConvertPoints(SimpleInterface):
         out = Path(Path(self.inputs.in_file).with_suffix(ext).name).resolve()
         if out.exists():
             raise RuntimeError(f'File {out} exists.')
-        Points.from_file(self.inputs.in_file).to_file(out)
+        PointArray.from_file(self.inputs.in_file).to_file(out)
         self._results['out_file'] = out
         return runtime
@@ -7,7 +7,9 @@ from nipype.interfaces.base import (traits,
                                     StdOutCommandLine,
                                     StdOutCommandLineInputSpec)
 from nipype.algorithms.misc import Gunzip
-from pndniworkflows.utils import csv2tsv, cutimage
+from pndniworkflows.utils import csv2tsv, cutimage, cropimage, uncropimage, transform_points
+from pndniworkflows.images import foreground_bbox
+from nipype.utils.filemanip import split_filename
 from pathlib import Path
 
 
@@ -176,10 +178,13 @@ class CutImageInputSpec(BaseInterfaceInputSpec):
     in_file = File(exists=True, desc='Input file to cut', mandatory=True)
     points_file = File(exists=True, desc='TSV file with points either indicating box or cutting plane', mandatory=True)
     neckonly = traits.Bool(True, desc='If true, cut off image below inferior-most point. Otherwise, cut to box around points')
+    compress = traits.Bool(desc='If true, gzip the output. If false, write it uncompressed. '
+                                'If undefined, match the compression of the input')
 
 
 class CutImageOutputSpec(TraitedSpec):
     out_file = File(exists=True, desc='Cut file')
+    crop_file = File(exists=True, desc='JSON file recording the crop (see :py:class:`UncropImage`)')
 
 
 class CutImage(SimpleInterface):
@@ -187,10 +192,106 @@ class CutImage(SimpleInterface):
     output_spec = CutImageOutputSpec
 
     def _run_interface(self, runtime):
+        compress = self.inputs.compress if isdefined(self.inputs.compress) else None
+        crop_file = _crop_file_name(self.inputs.in_file)
         outfile = cutimage(self.inputs.in_file,
                            self.inputs.points_file,
-                           self.inputs.neckonly)
+                           self.inputs.neckonly,
+                           compress=compress,
+                           crop_file=crop_file)
         self._results['out_file'] = outfile
+        self._results['crop_file'] = crop_file
+        return runtime
+
+
+def _crop_file_name(in_file):
+    _, stem, _ = split_filename(in_file)
+    return str(Path(stem + '_crop.json').resolve())
+
+
+class AutoCropInputSpec(BaseInterfaceInputSpec):
+    in_file = File(exists=True, mandatory=True, desc='Input file to crop')
+    voxel_size = traits.Float(4.0, usedefault=True, desc='Voxel size (mm) of the downsampled foreground mask')
+    fraction = traits.Float(0.1, usedefault=True, desc='Mask threshold relative to the 98th percentile')
+    margin = traits.Float(10.0, usedefault=True, desc='Margin (mm) to keep around the foreground')
+    compress = traits.Bool(desc='If true, gzip the output. If false, write it uncompressed. '
+                                'If undefined, match the compression of the input')
+
+
+class AutoCropOutputSpec(TraitedSpec):
+    out_file = File(exists=True, desc='Cropped file')
+    crop_file = File(exists=True, desc='JSON file recording the crop (see :py:class:`UncropImage`)')
+
+
+class AutoCrop(SimpleInterface):
+    """Crop an image to the bounding box of its foreground
+    (see :py:func:`pndniworkflows.images.foreground_bbox`).
+    The cut is made in voxel coordinates, as in :py:class:`CutImage`."""
+    input_spec = AutoCropInputSpec
+    output_spec = AutoCropOutputSpec
+
+    def _run_interface(self, runtime):
+        compress = self.inputs.compress if isdefined(self.inputs.compress) else None
+        slices = foreground_bbox(self.inputs.in_file,
+                                 voxel_size=self.inputs.voxel_size,
+                                 fraction=self.inputs.fraction,
+                                 margin=self.inputs.margin)
+        crop_file = _crop_file_name(self.inputs.in_file)
+        self._results['out_file'] = cropimage(self.inputs.in_file, slices, compress=compress, crop_file=crop_file)
+        self._results['crop_file'] = crop_file
+        return runtime
+
+
+class UncropImageInputSpec(BaseInterfaceInputSpec):
+    in_file = File(exists=True, mandatory=True, desc='Image on the grid of a cropped image')
+    crop_file = File(exists=True, mandatory=True,
+                     desc='JSON file recording the crop (from :py:class:`CutImage` or :py:class:`AutoCrop`)')
+    fill = traits.Float(0.0, usedefault=True, desc='Value of the voxels outside the crop')
+    compress = traits.Bool(desc='If true, gzip the output. If false, write it uncompressed. '
+                                'If undefined, match the compression of the input')
+
+
+class UncropImageOutputSpec(TraitedSpec):
+    out_file = File(exists=True, desc='Image on the grid of the image before cropping')
+
+
+class UncropImage(SimpleInterface):
+    """Pad an image back to the grid it was cropped from (see :py:func:`pndniworkflows.utils.uncropimage`)"""
+    input_spec = UncropImageInputSpec
+    output_spec = UncropImageOutputSpec
+
+    def _run_interface(self, runtime):
+        compress = self.inputs.compress if isdefined(self.inputs.compress) else None
+        self._results['out_file'] = uncropimage(self.inputs.in_file, self.inputs.crop_file,
+                                                fill=self.inputs.fill, compress=compress)
+        return runtime
+
+
+class TransformPointsInputSpec(BaseInterfaceInputSpec):
+    in_file = File(exists=True, mandatory=True, desc='TSV file with x, y, z, and index columns')
+    transforms = traits.List(File(exists=True), mandatory=True,
+                             desc='ITK affine transforms, applied in reverse order (last one first)')
+    invert_transform_flags = traits.List(traits.Bool(), desc='Whether to invert each transform')
+
+
+class TransformPointsOutputSpec(TraitedSpec):
+    out_file = File(exists=True, desc='Transformed points TSV file')
+
+
+class TransformPoints(SimpleInterface):
+    """Apply affine transforms to points in-process (see :py:func:`pndniworkflows.utils.transform_points`).
+    Replaces converting the points to an ANTs CSV, running
+    :py:class:`nipype.interfaces.ants.resampling.ApplyTransformsToPoints`, and converting back.
+    """
+    input_spec = TransformPointsInputSpec
+    output_spec = TransformPointsOutputSpec
+
+    def _run_interface(self, runtime):
+        out_file = str(Path(Path(self.inputs.in_file).stem + '_transformed.tsv').resolve())
+        flags = self.inputs.invert_transform_flags if isdefined(self.inputs.invert_transform_flags) else None
+        transform_points(self.inputs.in_file, self.inputs.transforms, out_file,
+                         invert_transform_flags=flags)
+        self._results['out_file'] = out_file
         return runtime
 
 
@@ -0,0 +1,286 @@
+"""In-process reading and writing of MINC 2.0 (HDF5) files"""
+import shutil
+import numpy as np
+import nibabel
+from nibabel.openers import ImageOpener
+from .utils import InProcessUnsupportedError
+from .images import smallest_int_dtype, iter_slabs
+
+
+_HDF5_SIGNATURE = b'\x89HDF\r\n\x1a\n'
+_SPATIAL_DIMS = ('xspace', 'yspace', 'zspace')
+_DEFAULT_DIRCOS = {'xspace': (1.0, 0.0, 0.0),
+                   'yspace': (0.0, 1.0, 0.0),
+                   'zspace': (0.0, 0.0, 1.0)}
+
+
+def _h5py():
+    try:
+        import h5py
+    except ImportError:
+        raise InProcessUnsupportedError('h5py is not installed')
+    return h5py
+
+
+def is_minc2(filename):
+    """Return :py:obj:`True` if filename is an HDF5 (i.e. MINC 2.0) file"""
+    with open(filename, 'rb') as f:
+        return f.read(len(_HDF5_SIGNATURE)) == _HDF5_SIGNATURE
+
+
+def _open_minc2(filename, mode='r'):
+    h5py = _h5py()
+    if not is_minc2(filename):
+        raise InProcessUnsupportedError(f'{filename} is not a MINC 2.0 file')
+    return h5py.File(filename, mode)
+
+
+def default_dircos(in_file, out_file, atol=1e-6):
+    """Copy a MINC 2.0 file, setting the direction cosines of the spatial dimensions
+    to their default values. Only the dimension attributes are modified.
+
+    :param in_file: input MINC 2.0 file
+    :param out_file: output MINC 2.0 file
+    :param atol: direction cosines must be missing, or within atol of the defaults.
+    :raises: :py:class:`pndniworkflows.utils.InProcessUnsupportedError` if the input is not MINC 2.0,
+             h5py is not available, or the direction cosines are not close to the defaults
+             (which would require resampling the image)
+    """
+    with _open_minc2(in_file) as f:
+        dims = f['minc-2.0']['dimensions']
+        for name in _SPATIAL_DIMS:
+            if name in dims and 'direction_cosines' in dims[name].attrs:
+                if not np.allclose(dims[name].attrs['direction_cosines'], _DEFAULT_DIRCOS[name],
+                                   rtol=0.0, atol=atol):
+                    raise InProcessUnsupportedError(f'{name} direction cosines are not close to the default')
+    shutil.copyfile(str(in_file), str(out_file))
+    with _open_minc2(out_file, 'r+') as f:
+        dims = f['minc-2.0']['dimensions']
+        for name in _SPATIAL_DIMS:
+            if name in dims:
+                dims[name].attrs['direction_cosines'] = np.array(_DEFAULT_DIRCOS[name], dtype=np.float64)
+
+
+_MINC_TYPES = {'byte': ('uint8', 'int8'),
+               'short': ('uint16', 'int16'),
+               'int': ('uint32', 'int32'),
+               'float': ('float32', 'float32'),
+               'double': ('float64', 'float64')}
+
+
+def minc_dtype(outtype, signed=None):
+    """Get the numpy dtype corresponding to MINC command line type options
+
+    :param outtype: One of "byte", "short", "int", "float", "double"
+    :param signed: :py:obj:`True` for signed, :py:obj:`False` for unsigned. If :py:obj:`None`
+                   "byte" is unsigned and all other types are signed (the MINC defaults)
+    :return: :py:class:`numpy.dtype`
+
+    :Example:
+
+    .. doctest::
+
+       >>> from pndniworkflows.mincio import minc_dtype
+       >>> minc_dtype('byte')
+       dtype('uint8')
+       >>> minc_dtype('short', signed=False)
+       dtype('uint16')
+    """
+    unsigned_type, signed_type = _MINC_TYPES[outtype]
+    if signed is None:
+        signed = outtype != 'byte'
+    return np.dtype(signed_type if signed else unsigned_type)
+
+
+def _load_minc2(in_file):
+    _h5py()
+    if not is_minc2(in_file):
+        raise InProcessUnsupportedError(f'{in_file} is not a MINC 2.0 file')
+    img = nibabel.load(str(in_file))
+    if len(img.shape) != 3:
+        raise InProcessUnsupportedError(f'{in_file} is not a 3D image')
+    return img
+
+
+def _scan(slabs):
+    """return min, max, and whether all values are integers"""
+    minval, maxval, integral = np.inf, -np.inf, True
+    for data in slabs:
+        minval = min(minval, float(data.min()))
+        maxval = max(maxval, float(data.max()))
+        integral = integral and bool(np.all(np.mod(data, 1) == 0))
+    return minval, maxval, integral
+
+
+def minc2nifti(in_file, out_file, dtype=None, scan_range=True, labels=False, slab_bytes=1 << 26):
+    """Convert a 3D MINC 2.0 file to NIfTI, reading and writing one slab at a time.
+
+    The MINC dimensions are reversed so that the (C ordered) MINC data
+    and (Fortran ordered) NIfTI data have the same layout on disk.
+
+    :param in_file: input MINC 2.0 file
+    :param out_file: output NIfTI file (.nii or .nii.gz)
+    :param dtype: output data type. If :py:obj:`None`, use the type of the MINC file,
+                  or float32 if the MINC file is integer valued but the scaled
+                  values are not integers.
+    :param scan_range: if the output type is an integer, scan the data to choose
+                       scl_slope and scl_inter so that the full range is represented. Otherwise
+                       the values are rounded and clipped to the output type.
+    :param labels: round the values to integers and use the smallest integer type
+                   that can hold them (ignoring dtype)
+    :param slab_bytes: approximate maximum memory to use for a slab of data
+    """
+    img = _load_minc2(in_file)
+    shape = img.shape
+    slabs = list(iter_slabs(shape[0], np.prod(shape[1:]) * 8, slab_bytes))
+    stored_dtype = img.get_data_dtype()
+
+    def read_slabs():
+        for slab in slabs:
+            data = np.asarray(img.dataobj[slab])
+            yield np.rint(data) if labels else data
+
+    slope, inter = 1.0, 0.0
+    if labels or (dtype is None and not np.issubdtype(stored_dtype, np.floating)) or \
+       (dtype is not None and not np.issubdtype(dtype, np.floating) and scan_range):
+        minval, maxval, integral = _scan(read_slabs())
+        if labels:
+            dtype = smallest_int_dtype(minval, maxval)
+        elif dtype is None:
+            fits = np.iinfo(stored_dtype).min <= minval and maxval <= np.iinfo(stored_dtype).max
+            dtype = stored_dtype if integral and fits else np.dtype('float32')
+        else:
+            info = np.iinfo(dtype)
+            if not integral or minval < info.min or maxval > info.max:
+                slope = (maxval - minval) / (float(info.max) - float(info.min)) if maxval > minval else 1.0
+                inter = minval - float(info.min) * slope
+    elif dtype is None:
+        dtype = stored_dtype
+    dtype = np.dtype(dtype)
+
+    affine = img.affine[:, [2, 1, 0, 3]]
+    hdr = nibabel.Nifti1Header()
+    hdr.set_data_shape(shape[::-1])
+    hdr.set_data_dtype(dtype)
+    hdr.set_qform(affine, 1)
+    hdr.set_sform(affine, 1)
+    hdr.set_xyzt_units('mm')
+    hdr['scl_slope'] = slope
+    hdr['scl_inter'] = inter
+    with ImageOpener(str(out_file), 'wb') as f:
+        hdr.write_to(f)
+        for data in read_slabs():
+            if np.issubdtype(dtype, np.integer):
+                info = np.iinfo(dtype)
+                data = np.clip(np.rint((data - inter) / slope), info.min, info.max)
+            f.write(np.ascontiguousarray(data, dtype=dtype).tobytes())
+
+
+def _axis_names(affine):
+    names = []
+    for col in affine[:3, :3].T:
+        names.append(_SPATIAL_DIMS[int(np.argmax(np.abs(col)))])
+    if len(set(names)) != 3:
+        raise InProcessUnsupportedError('Unable to match voxel axes to world axes')
+    return names
+
+
+def _string(value):
+    return np.bytes_(value)
+
+
+def nifti2minc(in_file, out_file, dtype=None, slab_bytes=1 << 26):
+    """Convert a 3D NIfTI file to MINC 2.0, reading and writing one slab at a time.
+
+    The MINC dimension order is the reverse of the NIfTI axes so that the
+    (Fortran ordered) NIfTI data and (C ordered) MINC data have the same layout.
+    Integer outputs are scaled per slice (using the "image-min" and "image-max"
+    variables); slices whose values are integers within the range of the output
+    type are stored unscaled.
+
+    :param in_file: input NIfTI file
+    :param out_file: output MINC 2.0 file
+    :param dtype: output data type. If :py:obj:`None`, use the type of the NIfTI file,
+                  or float32 if the NIfTI file has a scaling factor.
+    :param slab_bytes: approximate maximum memory to use for a slab of data
+    """
+    h5py = _h5py()
+    img = nibabel.load(str(in_file))
+    if not isinstance(img, nibabel.Nifti1Pair) or len(img.shape) != 3:
+        raise InProcessUnsupportedError(f'{in_file} is not a 3D NIfTI image')
+    if dtype is None:
+        slope, inter = img.dataobj.slope, img.dataobj.inter
+        if slope in (1.0, None) and inter in (0.0, None):
+            dtype = img.get_data_dtype()
+        else:
+            dtype = np.float32
+    dtype = np.dtype(dtype)
+    is_int = np.issubdtype(dtype, np.integer)
+
+    affine = img.affine
+    names = _axis_names(affine)
+    steps = []
+    dircos = []
+    for name, col in zip(names, affine[:3, :3].T):
+        step = np.linalg.norm(col) * np.sign(col[_SPATIAL_DIMS.index(name)])
+        steps.append(step)
+        dircos.append(col / step)
+    starts = np.linalg.solve(np.array(dircos).T, affine[:3, 3])
+
+    shape = img.shape
+    nslices = shape[2]
+    with h5py.File(str(out_file), 'w') as f:
+        root = f.create_group('minc-2.0')
+        root.attrs['ident'] = _string('pndniworkflows')
+        root.attrs['minc_version'] = _string('2.1.0')
+        f.create_group('minc-2.0/info')
+        dims = f.create_group('minc-2.0/dimensions')
+        for name, length, step, start, cos in zip(names, shape, steps, starts, dircos):
+            dim = dims.create_dataset(name, data=np.int32(0))
+            dim.attrs['varid'] = _string('dimension____')
+            dim.attrs['vartype'] = _string('dimension____')
+            dim.attrs['version'] = _string('MINC Version    1.0')
+            dim.attrs['spacing'] = _string('regular__')
+            dim.attrs['alignment'] = _string('centre')
+            dim.attrs['units'] = _string('mm')
+            dim.attrs['length'] = np.int32(length)
+            dim.attrs['step'] = np.float64(step)
+            dim.attrs['start'] = np.float64(start)
+            dim.attrs['direction_cosines'] = np.asarray(cos, dtype=np.float64)
+        image_group = f.create_group('minc-2.0/image/0')
+        image = image_group.create_dataset('image', shape=shape[::-1], dtype=dtype)
+        image.attrs['dimorder'] = _string(','.join(names[::-1]))
+        image.attrs['varid'] = _string('MINC standard variable')
+        image.attrs['vartype'] = _string('group________')
+        image.attrs['version'] = _string('MINC Version    1.0')
+        image.attrs['complete'] = _string('true_')
+        if is_int:
+            image.attrs['signtype'] = _string('signed__' if np.iinfo(dtype).min < 0 else 'unsigned')
+        image_min = np.zeros(nslices)
+        image_max = np.zeros(nslices)
+        if is_int:
+            info = np.iinfo(dtype)
+            vmin, vmax = float(info.min), float(info.max)
+        for slab in iter_slabs(nslices, np.prod(shape[:2]) * 8, slab_bytes):
+            data = np.asarray(img.dataobj[..., slab], dtype=np.float64).transpose(2, 1, 0)
+            smin = data.min(axis=(1, 2))
+            smax = data.max(axis=(1, 2))
+            if is_int:
+                unscaled = (smin >= vmin) & (smax <= vmax) & np.all(np.mod(data, 1) == 0, axis=(1, 2))
+                smin = np.where(unscaled, vmin, smin)
+                smax = np.where(unscaled, vmax, np.where(smax > smin, smax, smin + 1.0))
+                scale = ((vmax - vmin) / (smax - smin))[:, np.newaxis, np.newaxis]
+                data = np.clip(np.rint((data - smin[:, np.newaxis, np.newaxis]) * scale + vmin), vmin, vmax)
+            image[slab] = data.astype(dtype)
+            image_min[slab] = smin
+            image_max[slab] = smax
+        if is_int:
+            image.attrs['valid_range'] = np.array([vmin, vmax])
+        else:
+            image.attrs['valid_range'] = np.array([image_min.min(), image_max.max()])
+        for varname, values in [('image-min', image_min), ('image-max', image_max)]:
+            var = image_group.create_dataset(varname, data=values)
+            var.attrs['dimorder'] = _string(names[2])
+            var.attrs['varid'] = _string('MINC standard variable')
+            var.attrs['vartype'] = _string('var_attribute')
+            var.attrs['version'] = _string('MINC Version    1.0')
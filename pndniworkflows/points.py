@@ -0,0 +1,122 @@
+"""Points held as numpy arrays.
+
+:py:class:`pndni.convertpoints.Points` stores one object per point, which is slow
+for large point sets (e.g. classifier training tags). :py:class:`PointArray` stores the
+coordinates as an (N, 3) array and the labels as an (N,) array, so points can be
+transformed without a Python loop. The TSV format used throughout pndniworkflows is
+read and written directly; ANTs CSV and MINC tag files are read and written with
+:py:class:`pndni.convertpoints.Points`.
+"""
+import csv
+from pathlib import Path
+import numpy as np
+from pndni.convertpoints import Points, SinglePoint
+
+
+_TSV_COLUMNS = ('x', 'y', 'z', 'index')
+
+
+class PointArray(object):
+    """Points in RAS world coordinates, with an integer label for each point
+
+    :param coords: (N, 3) array of coordinates
+    :param labels: (N,) array of labels (default 0 for every point)
+    """
+
+    def __init__(self, coords, labels=None):
+        coords = np.array(coords, dtype=np.float64).reshape(-1, 3)
+        if labels is None:
+            labels = np.zeros(len(coords), dtype=np.int64)
+        labels = np.array(labels, dtype=np.int64).reshape(-1)
+        if len(labels) != len(coords):
+            raise ValueError('There must be one label for each point')
+        self.coords = coords
+        self.labels = labels
+
+    def __len__(self):
+        return len(self.coords)
+
+    @classmethod
+    def from_points(cls, points_obj):
+        """Create from a :py:class:`pndni.convertpoints.Points` object"""
+        coords = [[float(sp.x), float(sp.y), float(sp.z)] for sp in points_obj.points]
+        labels = [int(sp.index) for sp in points_obj.points]
+        return cls(coords, labels)
+
+    def to_points(self):
+        """Convert to a :py:class:`pndni.convertpoints.Points` object"""
+        return Points([SinglePoint(x, y, z, index)
+                       for (x, y, z), index in zip(self.coords.tolist(), self.labels.tolist())])
+
+    @classmethod
+    def from_tsv(cls, fname):
+        """Read a TSV file with x, y, z, and index columns. Other columns are ignored"""
+        with open(fname, 'r', newline='') as f:
+            reader = csv.reader(f, delimiter='\t')
+            header = next(reader)
+            rows = [row for row in reader if row]
+        missing = [c for c in _TSV_COLUMNS if c not in header]
+        if missing:
+            raise ValueError('{} is missing columns {}'.format(fname, ', '.join(missing)))
+        cols = [header.index(c) for c in _TSV_COLUMNS]
+        table = np.array([[row[i] for i in cols] for row in rows], dtype=str).reshape(-1, 4)
+        return cls(table[:, :3].astype(np.float64), table[:, 3].astype(np.int64))
+
+    def to_tsv(self, fname):
+        """Write a TSV file with x, y, z, and index columns"""
+        table = np.empty((len(self), 4), dtype=object)
+        table[:, :3] = self.coords
+        table[:, 3] = self.labels
+        with open(fname, 'w', newline='') as f:
+            f.write('\t'.join(_TSV_COLUMNS) + '\n')
+            # str gives the shortest representation which round trips
+            np.savetxt(f, table, fmt='%s', delimiter='\t')
+
+    @classmethod
+    def from_ants_csv(cls, fname):
+        """Read an ANTs CSV file (see :py:meth:`pndni.convertpoints.Points.from_ants_csv`)"""
+        return cls.from_points(Points.from_ants_csv(fname))
+
+    def to_ants_csv(self, fname):
+        """Write an ANTs CSV file (see :py:meth:`pndni.convertpoints.Points.to_ants_csv`)"""
+        self.to_points().to_ants_csv(fname)
+
+    @classmethod
+    def from_minc_tag(cls, fname):
+        """Read a MINC tag file (see :py:meth:`pndni.convertpoints.Points.from_minc_tag`)"""
+        return cls.from_points(Points.from_minc_tag(fname))
+
+    def to_minc_tag(self, fname):
+        """Write a MINC tag file (see :py:meth:`pndni.convertpoints.Points.to_minc_tag`)"""
+        self.to_points().to_minc_tag(fname)
+
+    @classmethod
+    def from_file(cls, fname):
+        """Read a TSV (.tsv), ANTs CSV (.csv) or MINC tag (.tag) file"""
+        if Path(fname).suffix == '.tsv':
+            return cls.from_tsv(fname)
+        return cls.from_points(Points.from_file(fname))
+
+    def to_file(self, fname):
+        """Write a TSV (.tsv), ANTs CSV (.csv) or MINC tag (.tag) file"""
+        if Path(fname).suffix == '.tsv':
+            self.to_tsv(fname)
+        else:
+            self.to_points().to_file(fname)
+
+    def transform(self, affine):
+        """Apply a 4x4 affine matrix to the coordinates
+
+        :param affine: 4x4 matrix
+        :return: transformed :py:class:`PointArray`, with the same labels
+        """
+        affine = np.asarray(affine)
+        return PointArray(self.coords @ affine[:3, :3].T + affine[:3, 3], self.labels)
+
+    def voxel_coords(self, affine):
+        """Voxel coordinates of the points in an image
+
+        :param affine: 4x4 voxel to world affine of the image
+        :return: (N, 3) array
+        """
+        return self.transform(np.linalg.inv(affine)).coords
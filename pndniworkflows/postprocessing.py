@@ -5,7 +5,8 @@ from collections import namedtuple
 from . import utils
 from .interfaces.io import WriteFSLStats
 from .interfaces.pndni_utils import Stats
-from .interfaces.utils import Zipper
+from .interfaces.utils import Zipper, GunzipOrIdent
+from .resources import estimated_node
 
 
 StatDesc = namedtuple('StatDesc', ['flag', 'names', 'fsl'])
@@ -26,7 +27,7 @@ STATS = {'robustminmax': StatDesc('-r', ['robust_min', 'robust_max'], True),
          'kurtosis': StatDesc('--kurtosis', ['kurtosis'], False)}
 
 
-def image_stats_wf(stat_keys, labels, name):
+def image_stats_wf(stat_keys, labels, name, compress_intermediates=None, reference_image=None, memory_models=None):
     """Create a workflow to calculate image statistics using fslstats
 
     :param stat_keys: list of keys indicating which statistics to calculate.
@@ -35,7 +36,14 @@ def image_stats_wf(stat_keys, labels, name):
                    :py:class:`OrderedDict` must have an "index" field.
                    (e.g. ``[OrderedDict(index=1, name='Brain'), OrderedDict(index=2, name='WM')]``)
     :param name: The name of the workflow
+    :param compress_intermediates: Compression policy for images used by the workflow.
+                                   If :py:obj:`False` and both fslstats and stats are required,
+                                   the inputs are decompressed once and shared rather than
+                                   being decompressed by each tool.
 
+    :param reference_image: If specified with memory_models, set the memory estimates of the nodes from
+                            the size of this image (see :py:func:`pndniworkflows.resources.estimated_node`)
+    :param memory_models: Memory models for the nodes (see :py:func:`pndniworkflows.resources.memory_estimate`)
     :return: A :py:mod:`nipype` workflow
 
     Workflow inputs/outputs
@@ -54,9 +62,9 @@ def image_stats_wf(stat_keys, labels, name):
     stats_op_string = ' '.join((stat.flag for stat in stats if not stat.fsl))
     inputspec = pe.Node(IdentityInterface(['in_file', 'index_mask_file']), 'inputspec')
     if fsl_op_string:
-        fslimagestats = pe.Node(ImageStats(op_string=fsl_op_string), 'fslimagestats')
+        fslimagestats = estimated_node(ImageStats(op_string=fsl_op_string), 'fslimagestats', reference_image, memory_models)
     if stats_op_string:
-        statsimagestats = pe.Node(Stats(op_string=stats_op_string), 'statsimagestats')
+        statsimagestats = estimated_node(Stats(op_string=stats_op_string), 'statsimagestats', reference_image, memory_models)
     write = pe.Node(WriteFSLStats(), 'write')
     fsl_header = []
     stats_header = []
@@ -69,12 +77,20 @@ def image_stats_wf(stat_keys, labels, name):
     write.inputs.statnames = header
     write.inputs.labels = utils.labels2dict(labels, 'name')
     outputspec = pe.Node(IdentityInterface(['out_file']), 'outputspec')
+    if fsl_op_string and stats_op_string and compress_intermediates is False:
+        images = pe.Node(IdentityInterface(['in_file', 'index_mask_file']), 'images')
+        for field in ['in_file', 'index_mask_file']:
+            gunzip = estimated_node(GunzipOrIdent(), f'gunzip_{field}', reference_image, memory_models)
+            wf.connect([(inputspec, gunzip, [(field, 'in_file')]),
+                        (gunzip, images, [('out_file', field)])])
+    else:
+        images = inputspec
     if fsl_op_string:
-        wf.connect([(inputspec, fslimagestats, [('in_file', 'in_file'),
-                                                ('index_mask_file', 'index_mask_file')])])
+        wf.connect([(images, fslimagestats, [('in_file', 'in_file'),
+                                             ('index_mask_file', 'index_mask_file')])])
     if stats_op_string:
-        wf.connect([(inputspec, statsimagestats, [('in_file', 'in_file'),
-                                                  ('index_mask_file', 'index_mask_file')])])
+        wf.connect([(images, statsimagestats, [('in_file', 'in_file'),
+                                               ('index_mask_file', 'index_mask_file')])])
     if fsl_op_string and stats_op_string:
         zipper = pe.Node(Zipper(chunksize1=len(fsl_header), chunksize2=len(stats_header)), 'zipper')
         wf.connect(fslimagestats, 'out_stat', zipper, 'list1')
@@ -1,73 +1,130 @@
 from nipype.pipeline import engine as pe
 from nipype import IdentityInterface, Function
 from .registration import ants_registration_affine_node
-from nipype.interfaces.ants.resampling import ApplyTransformsToPoints
-from .interfaces.utils import CutImage
-from .interfaces.pndni_utils import ConvertPoints
+from .interfaces.utils import CutImage, TransformPoints, AutoCrop
+from .interfaces.images import DownsampleImage, ForegroundMask, FindNeck
+from .resources import estimated_node
 
 
 def writepoints(limits):
     from pathlib import Path
-    x, y, z = limits
-    with open('points.tsv', 'w') as f:
-        f.write('x\ty\tz\tindex\n')
-        f.write('{}\t{}\t{}\t0\n'.format(x, y, z))
-        f.write('{}\t{}\t{}\t0\n'.format(x, -y, z))
-        f.write('{}\t{}\t{}\t0\n'.format(-x, -y, z))
-        f.write('{}\t{}\t{}\t0\n'.format(-x, y, z))
+    import numpy as np
+    from pndniworkflows.points import PointArray
+    # the corners of the rectangle (+-x, +-y) at height z
+    PointArray(np.array(limits, dtype=float) * [[1, 1, 1], [1, -1, 1], [-1, -1, 1], [-1, 1, 1]]).to_tsv('points.tsv')
     return str(Path('points.tsv').resolve())
 
 
-def neck_removal_wf(usemodel):
+def neck_removal_wf(usemodel, compress_intermediates=None, external_transform=False, prepared_points=False,
+                    reference_image=None, registration_voxel_size=None, detect=False, memory_models=None):
     """Create a workflow to to remove the neck. This workflow requires a
     model image (e.g. an MNI standard) and points on that image. The model
     is registered to the T1 image, and the points transformed into T1 space.
     The inferior most transformed point is used to determine the cutting
     plane, which is aligned with the voxel coordinates.
 
+    :param usemodel: If true, transform the limits from model space to T1 space.
+                     Otherwise the limits are assumed to be in T1 space
+    :param compress_intermediates: Compression policy for images written by the workflow.
+                                   :py:obj:`False` writes them uncompressed (leaving compression
+                                   to :py:class:`WriteBIDSFile` or :py:class:`ExportFile`),
+                                   :py:obj:`True` gzips them, and :py:obj:`None` matches the input
+    :param external_transform: If true (and :py:obj:`usemodel` is true), the model is not registered
+                               by this workflow. Instead the transforms are taken from
+                               :py:obj:`inputspec.transforms`, so that one registration
+                               (e.g. :py:func:`model_registration_wf`) can be shared between workflows
+    :param prepared_points: If true, the cutting plane is read from :py:obj:`inputspec.points`
+                            (e.g. :py:func:`template_preparation_wf`'s :py:obj:`outputspec.neck_points`)
+                            instead of being written from :py:obj:`inputspec.limits` for every subject
+    :param registration_voxel_size: If specified, register downsampled images with approximately this
+                                    voxel size (see :py:func:`model_registration_wf`)
+    :param reference_image: If specified with memory_models, set the memory estimates of the nodes from
+                            the size of this image (see :py:func:`pndniworkflows.resources.estimated_node`)
+    :param memory_models: Memory models for the nodes (see :py:func:`pndniworkflows.resources.memory_estimate`)
+    :param detect: If true, find the cutting plane from the T1 image alone
+                   (see :py:class:`pndniworkflows.interfaces.images.FindNeck`), without a model
+                   or limits. :py:obj:`usemodel` must be false
     :return: A :py:mod:`nipype` workflow
 
     Workflow inputs/outputs
 
     :param inputspec.T1: The T1 image to remove the neck from
     :param inputspec.model: The reference image to register to the T1 image
+                            (only if :py:obj:`external_transform` is false)
+    :param inputspec.transforms: The transforms from model space to T1 space
+                                 (only if :py:obj:`external_transform` is true)
     :param inputspec.limits: Points in model roughly indicating the ideal cutting plane
+                             (only if :py:obj:`prepared_points` is false)
+    :param inputspec.points: Points file written by :py:func:`writepoints`
+                             (only if :py:obj:`prepared_points` is true)
     :return: A :py:mod:`nipype` node
 
     """
     name = 'neck_removal'
     wf = pe.Workflow(name)
-    inputspec = pe.Node(IdentityInterface(['T1', 'model', 'limits']), name='inputspec')
-    wpoints = pe.Node(Function(input_names=['limits'], output_names=['points'], function=writepoints), name='write_points')
-    cut = pe.Node(CutImage(neckonly=True), name='cut')
+    if detect:
+        if usemodel:
+            raise ValueError('usemodel and detect cannot both be true')
+        inputspec = pe.Node(IdentityInterface(['T1']), name='inputspec')
+    else:
+        inputspec = pe.Node(IdentityInterface(['T1', _model_field(usemodel, external_transform),
+                                               'points' if prepared_points else 'limits']),
+                            name='inputspec')
+    if detect:
+        points = estimated_node(FindNeck(), 'find_neck', reference_image, memory_models)
+        wf.connect(inputspec, 'T1', points, 'in_file')
+        points_field = 'out_file'
+    elif prepared_points:
+        points = inputspec
+        points_field = 'points'
+    else:
+        points = pe.Node(Function(input_names=['limits'], output_names=['points'], function=writepoints),
+                         name='write_points')
+        wf.connect(inputspec, 'limits', points, 'limits')
+        points_field = 'points'
+    cut = estimated_node(CutImage(neckonly=True), 'cut', reference_image, memory_models)
+    _set_compress(cut, compress_intermediates)
     outputspec = pe.Node(IdentityInterface(['cropped']), name='outputspec')
     if usemodel:
-        trpoints = _tr_points_wf()
-        wf.connect([(inputspec, trpoints, [('T1', 'inputspec.T1'),
-                                           ('model', 'inputspec.model')]),
-                    (wpoints, trpoints, [('points', 'inputspec.points')]),
+        trpoints = _tr_points_wf(external_transform, registration_voxel_size, reference_image, memory_models)
+        _connect_model(wf, inputspec, trpoints, external_transform)
+        wf.connect([(points, trpoints, [(points_field, 'inputspec.points')]),
                     (trpoints, cut, [('outputspec.out_points', 'points_file')])])
     else:
-        wf.connect([(wpoints, cut, [('points', 'points_file')])])
-    wf.connect([(inputspec, wpoints, [('limits', 'limits')]),
-                (inputspec, cut, [('T1', 'in_file')]),
+        wf.connect([(points, cut, [(points_field, 'points_file')])])
+    wf.connect([(inputspec, cut, [('T1', 'in_file')]),
                 (cut, outputspec, [('out_file', 'cropped')])])
     return wf
 
 
-def crop_wf(usemodel):
+def crop_wf(usemodel, compress_intermediates=None, external_transform=False, reference_image=None,
+            registration_voxel_size=None, memory_models=None):
     """Create a workflow to to crop the image. This workflow requires a
     model image (e.g. an MNI standard) and points on that image. The model
     is registered to the T1 image, and the points transformed into T1 space.
     The image is cut to a box containing all of the transformed points.
     All cuts are in voxel coordinates.
 
+    :param usemodel: If true, transform the points from model space to T1 space.
+                     Otherwise the points are assumed to be in T1 space
+    :param compress_intermediates: Compression policy for images written by the workflow.
+                                   See :py:func:`neck_removal_wf`
+    :param external_transform: Take the transforms from :py:obj:`inputspec.transforms`
+                               instead of registering the model. See :py:func:`neck_removal_wf`
+    :param registration_voxel_size: If specified, register downsampled images with approximately this
+                                    voxel size (see :py:func:`model_registration_wf`)
+    :param reference_image: If specified with memory_models, set the memory estimates of the nodes from
+                            the size of this image (see :py:func:`pndniworkflows.resources.estimated_node`)
+    :param memory_models: Memory models for the nodes (see :py:func:`pndniworkflows.resources.memory_estimate`)
     :return: A :py:mod:`nipype` workflow
 
     Workflow inputs/outputs
 
     :param inputspec.T1: The T1 image to remove the neck from
     :param inputspec.model: The reference image to register to the T1 image
+                            (only if :py:obj:`external_transform` is false)
+    :param inputspec.transforms: The transforms from model space to T1 space
+                                 (only if :py:obj:`external_transform` is true)
     :param inputspec.points: Points file (tsv file with x, y, z, and index (ignored),
                              representing the limits in model space
     :return: A :py:mod:`nipype` node
@@ -75,14 +132,15 @@ def crop_wf(usemodel):
     """
     name = 'crop'
     wf = pe.Workflow(name)
-    inputspec = pe.Node(IdentityInterface(['T1', 'model', 'points']), name='inputspec')
-    cut = pe.Node(CutImage(neckonly=False), name='cut')
+    inputspec = pe.Node(IdentityInterface(['T1', _model_field(usemodel, external_transform), 'points']),
+                        name='inputspec')
+    cut = estimated_node(CutImage(neckonly=False), 'cut', reference_image, memory_models)
+    _set_compress(cut, compress_intermediates)
     outputspec = pe.Node(IdentityInterface(['cropped']), name='outputspec')
     if usemodel:
-        trpoints = _tr_points_wf()
-        wf.connect([(inputspec, trpoints, [('T1', 'inputspec.T1'),
-                                           ('model', 'inputspec.model'),
-                                           ('points', 'inputspec.points')]),
+        trpoints = _tr_points_wf(external_transform, registration_voxel_size, reference_image, memory_models)
+        _connect_model(wf, inputspec, trpoints, external_transform)
+        wf.connect([(inputspec, trpoints, [('points', 'inputspec.points')]),
                     (trpoints, cut, [('outputspec.out_points', 'points_file')])])
     else:
         wf.connect([(inputspec, cut, [('points', 'points_file')])])
@@ -91,19 +149,188 @@ def crop_wf(usemodel):
     return wf
 
 
-def _tr_points_wf():
+def autocrop_wf(compress_intermediates=None, voxel_size=4.0, margin=10.0, reference_image=None, memory_models=None):
+    """Create a workflow to crop the image to the bounding box of the head, removing
+    empty margins of the field of view. No model is required: the box is found from a
+    thresholded, downsampled image (see :py:class:`pndniworkflows.interfaces.utils.AutoCrop`).
+    The cut is made in voxel coordinates, and recorded so that images derived from the
+    cropped image can be padded back to the original grid with
+    :py:class:`pndniworkflows.interfaces.utils.UncropImage`.
+
+    :param compress_intermediates: Compression policy for images written by the workflow.
+                                   See :py:func:`neck_removal_wf`
+    :param voxel_size: Voxel size (mm) of the downsampled image used to find the head
+    :param margin: Margin (mm) to keep around the head
+    :param reference_image: If specified with memory_models, set the memory estimates of the nodes from
+                            the size of this image (see :py:func:`pndniworkflows.resources.estimated_node`)
+    :param memory_models: Memory models for the nodes (see :py:func:`pndniworkflows.resources.memory_estimate`)
+    :return: A :py:mod:`nipype` workflow
+
+    Workflow inputs/outputs
+
+    :param inputspec.T1: The T1 image to crop
+    :param outputspec.cropped: The cropped image
+    :param outputspec.crop_file: JSON file recording the crop
+
+    """
+    wf = pe.Workflow('autocrop')
+    inputspec = pe.Node(IdentityInterface(['T1']), name='inputspec')
+    crop = estimated_node(AutoCrop(voxel_size=voxel_size, margin=margin), 'crop', reference_image, memory_models)
+    _set_compress(crop, compress_intermediates)
+    outputspec = pe.Node(IdentityInterface(['cropped', 'crop_file']), name='outputspec')
+    wf.connect([(inputspec, crop, [('T1', 'in_file')]),
+                (crop, outputspec, [('out_file', 'cropped'),
+                                    ('crop_file', 'crop_file')])])
+    return wf
+
+
+def _set_compress(node, compress):
+    if compress is not None:
+        node.inputs.compress = compress
+
+
+def _model_field(usemodel, external_transform):
+    return 'transforms' if usemodel and external_transform else 'model'
+
+
+def _connect_model(wf, inputspec, trpoints, external_transform):
+    if external_transform:
+        wf.connect(inputspec, 'transforms', trpoints, 'inputspec.transforms')
+    else:
+        wf.connect([(inputspec, trpoints, [('T1', 'inputspec.T1'),
+                                           ('model', 'inputspec.model')])])
+
+
+def model_registration_wf(name='model_registration', cache_dir=None, preset='default', use_mask=False,
+                          warm_start=False, num_threads=1, reference_image=None, voxel_size=None, memory_models=None):
+    """Create a workflow to register a model image (e.g. an MNI standard) to a T1 image.
+    The output transforms can be passed to :py:func:`crop_wf` and :py:func:`neck_removal_wf`
+    (with :py:obj:`external_transform=True`), so that a single registration is shared
+    by every point set on a subject.
+
+    :param name: Name of the workflow
+    :param cache_dir: If specified, cache the registration outputs in this directory
+                      (see :py:class:`pndniworkflows.interfaces.ants.CachedRegistration`)
+    :param preset: Registration schedule (see :py:data:`pndniworkflows.registration.REGISTRATION_PRESETS`).
+                   The transforms are only used to place points, so "fast" is often sufficient
+    :param use_mask: If true, restrict the metric to :py:obj:`inputspec.model_mask`
+    :param warm_start: If true, start from :py:obj:`inputspec.initial_transforms` (e.g. the
+                       :py:obj:`outputspec.transforms` of another session of the same subject)
+                       with a reduced schedule
+                       (see :py:func:`pndniworkflows.registration.ants_registration_affine_node`)
+    :param num_threads: Number of threads for the registration
+    :param voxel_size: If specified, both images are block averaged in-process to approximately
+                       this voxel size (mm) before registering them
+                       (see :py:class:`pndniworkflows.interfaces.images.DownsampleImage`).
+                       Downsampling keeps world coordinates, so the transforms apply to the
+                       full resolution images unchanged, and the cost of registration no longer
+                       depends on the input resolution
+    :param reference_image: If specified with memory_models, set the memory estimates of the nodes from
+                            the size of this image (see :py:func:`pndniworkflows.resources.estimated_node`)
+    :param memory_models: Memory models for the nodes (see :py:func:`pndniworkflows.resources.memory_estimate`)
+    :return: A :py:mod:`nipype` workflow
+
+    Workflow inputs/outputs
+
+    :param inputspec.T1: The T1 image
+    :param inputspec.model: The reference image to register to the T1 image
+    :param inputspec.model_mask: Mask of the model (only if :py:obj:`use_mask` is true)
+    :param inputspec.initial_transforms: Transforms from model space to the space of another
+                                         session (only if :py:obj:`warm_start` is true)
+    :param outputspec.transforms: The transforms from model space to T1 space
+    """
+    wf = pe.Workflow(name)
+    fields = ['T1', 'model']
+    if use_mask:
+        fields.append('model_mask')
+    if warm_start:
+        fields.append('initial_transforms')
+    inputspec = pe.Node(IdentityInterface(fields), 'inputspec')
+    # only the transform is used, so don't write the warped image
+    reg = estimated_node(ants_registration_affine_node(write_composite_transform=False,
+                                                       output_warped_image=False,
+                                                       cache_dir=cache_dir,
+                                                       preset=preset,
+                                                       warm_start=warm_start,
+                                                       num_threads=num_threads), 'register', reference_image, memory_models)
+    outputspec = pe.Node(IdentityInterface(['transforms']), 'outputspec')
+    if voxel_size is None:
+        wf.connect([(inputspec, reg, [('T1', 'moving_image'),
+                                      ('model', 'fixed_image')])])
+    else:
+        for field, regfield in [('T1', 'moving_image'), ('model', 'fixed_image')]:
+            downsample = estimated_node(DownsampleImage(voxel_size=voxel_size), f'downsample_{field}', reference_image,
+                                        memory_models)
+            wf.connect([(inputspec, downsample, [(field, 'in_file')]),
+                        (downsample, reg, [('out_file', regfield)])])
+    wf.connect(reg, 'forward_transforms', outputspec, 'transforms')
+    if use_mask:
+        nstages = len(reg.inputs.transforms)
+        wf.connect(inputspec, ('model_mask', _repeat, nstages), reg, 'fixed_image_masks')
+    if warm_start:
+        wf.connect(inputspec, 'initial_transforms', reg, 'initial_moving_transform')
+    return wf
+
+
+def _repeat(x, n):
+    return [x] * n
+
+
+def template_preparation_wf(downsample_factors=None, name='template_preparation'):
+    """Create a workflow to prepare the model for :py:func:`model_registration_wf`
+    and :py:func:`neck_removal_wf`. Its inputs are the same for every subject, so it
+    should be placed outside of any per-subject iterables, and runs once.
+
+    :param downsample_factors: If specified, downsample the model by averaging blocks of this size
+                               (see :py:func:`pndniworkflows.images.downsample_image`),
+                               reducing the cost of every registration to it
+    :param name: Name of the workflow
+    :return: A :py:mod:`nipype` workflow
+
+    Workflow inputs/outputs
+
+    :param inputspec.model: The reference image
+    :param inputspec.limits: Points in model roughly indicating the ideal cutting plane
+    :param outputspec.model: The (downsampled) model, for :py:obj:`model_registration_wf.inputspec.model`
+    :param outputspec.model_mask: Foreground mask of the model, for
+                                  :py:obj:`model_registration_wf.inputspec.model_mask`
+    :param outputspec.neck_points: Points file for :py:obj:`neck_removal_wf.inputspec.points`
+    """
+    wf = pe.Workflow(name)
+    inputspec = pe.Node(IdentityInterface(['model', 'limits']), 'inputspec')
+    wpoints = pe.Node(Function(input_names=['limits'], output_names=['points'], function=writepoints),
+                      name='write_points')
+    mask = pe.Node(ForegroundMask(), name='mask')
+    outputspec = pe.Node(IdentityInterface(['model', 'model_mask', 'neck_points']), 'outputspec')
+    if downsample_factors is not None:
+        model = pe.Node(DownsampleImage(factors=downsample_factors), name='downsample')
+        wf.connect(inputspec, 'model', model, 'in_file')
+        model_field = 'out_file'
+    else:
+        model = inputspec
+        model_field = 'model'
+    wf.connect([(inputspec, wpoints, [('limits', 'limits')]),
+                (model, mask, [(model_field, 'in_file')]),
+                (model, outputspec, [(model_field, 'model')]),
+                (mask, outputspec, [('out_file', 'model_mask')]),
+                (wpoints, outputspec, [('points', 'neck_points')])])
+    return wf
+
+
+def _tr_points_wf(external_transform=False, voxel_size=None, reference_image=None, memory_models=None):
     wf = pe.Workflow('trpointswf')
-    inputspec = pe.Node(IdentityInterface(['T1', 'model', 'points']), 'inputspec')
-    reg = pe.Node(ants_registration_affine_node(write_composite_transform=False), name='register')
-    convertpoints = pe.Node(ConvertPoints(in_format='tsv', out_format='ants'), 'convert_points')
-    trpoints = pe.Node(ApplyTransformsToPoints(dimension=3), name='transform_points')
-    convertpoints2 = pe.Node(ConvertPoints(in_format='ants', out_format='tsv'), 'convert_points2')
+    trpoints = pe.Node(TransformPoints(), name='transform_points')
     outputspec = pe.Node(IdentityInterface(['out_points']), 'outputspec')
-    wf.connect([(inputspec, reg, [('T1', 'moving_image'),
-                                  ('model', 'fixed_image')]),
-                (inputspec, convertpoints, [('points', 'in_file')]),
-                (reg, trpoints, [('forward_transforms', 'transforms')]),
-                (convertpoints, trpoints, [('out_file', 'input_file')]),
-                (trpoints, convertpoints2, [('output_file', 'in_file')]),
-                (convertpoints2, outputspec, [('out_file', 'out_points')])])
+    if external_transform:
+        inputspec = pe.Node(IdentityInterface(['transforms', 'points']), 'inputspec')
+        wf.connect(inputspec, 'transforms', trpoints, 'transforms')
+    else:
+        inputspec = pe.Node(IdentityInterface(['T1', 'model', 'points']), 'inputspec')
+        reg = model_registration_wf(voxel_size=voxel_size, reference_image=reference_image,
+                                    memory_models=memory_models)
+        wf.connect([(inputspec, reg, [('T1', 'inputspec.T1'),
+                                      ('model', 'inputspec.model')]),
+                    (reg, trpoints, [('outputspec.transforms', 'transforms')])])
+    wf.connect([(inputspec, trpoints, [('points', 'in_file')]),
+                (trpoints, outputspec, [('out_file', 'out_points')])])
     return wf
@@ -1,12 +1,55 @@
-from nipype.interfaces.ants.registration import Registration
+from nipype.pipeline import engine as pe
+from nipype import IdentityInterface
+from .interfaces.ants import ThreadedRegistration, CachedRegistration
+from .resources import estimated_node
 
 
-def ants_registration_syn_no_affine_node(**kwargs):
+#: Number of multi-resolution levels used by each registration preset. Presets keep the
+#: coarsest levels of the default schedules and drop the finest (and slowest) ones
+REGISTRATION_PRESETS = {'default': 4, 'fast': 3, 'preview': 2}
+#: Number of levels (the finest of the preset) kept when warm starting from a previous transform
+WARM_START_LEVELS = 1
+#: Maximum number of iterations at each level when warm starting from a previous transform
+WARM_START_ITERATIONS = 50
+
+
+def _registration(cache_dir=None, **kwargs):
+    if cache_dir is None:
+        return ThreadedRegistration(**kwargs)
+    return CachedRegistration(cache_dir=cache_dir, **kwargs)
+
+
+def _apply_preset(defaults, preset):
+    if preset not in REGISTRATION_PRESETS:
+        raise ValueError('Unknown registration preset {}. Options are {}'.format(preset, list(REGISTRATION_PRESETS)))
+    levels = REGISTRATION_PRESETS[preset]
+    for key in ['number_of_iterations', 'shrink_factors', 'smoothing_sigmas']:
+        defaults[key] = [stage[:levels] for stage in defaults[key]]
+
+
+def _apply_warm_start(defaults):
+    defaults.pop('initial_moving_transform_com', None)
+    for key in ['number_of_iterations', 'shrink_factors', 'smoothing_sigmas']:
+        defaults[key] = [stage[-WARM_START_LEVELS:] for stage in defaults[key]]
+    defaults['number_of_iterations'] = [[min(n, WARM_START_ITERATIONS) for n in stage]
+                                        for stage in defaults['number_of_iterations']]
+
+
+def ants_registration_syn_no_affine_node(preset='default', warm_start=False, **kwargs):
     """return antsRegistration interace instance with default values
     based on antsRegistrationSyN.sh with the s transformation option
     and the rigid and affine steps removed
 
-    :param \\*\\*kwargs: parameters to override the default values
+    :param preset: Name of the iteration schedule, one of :py:data:`REGISTRATION_PRESETS`.
+                   "fast" and "preview" skip the finest levels of the default schedule
+    :param warm_start: If true, the registration starts from :py:obj:`initial_moving_transform`
+                       (e.g. the transform already computed for another session of the same subject),
+                       which must then be set. Only the finest :py:data:`WARM_START_LEVELS` levels of
+                       the preset's schedule are run, with at most :py:data:`WARM_START_ITERATIONS`
+                       iterations each
+    :param \\*\\*kwargs: parameters to override the default values. If :py:obj:`cache_dir`
+                         is given, a :py:class:`pndniworkflows.interfaces.ants.CachedRegistration`
+                         is returned, which stores its outputs in that directory
     :return: :py:obj:`Registration` node
     """
     defaults = dict(dimension=3,
@@ -29,16 +72,28 @@ def ants_registration_syn_no_affine_node(**kwargs):
                     winsorize_upper_quantile=0.995,
                     write_composite_transform=True,
                     output_warped_image=True)
+    _apply_preset(defaults, preset)
+    if warm_start:
+        _apply_warm_start(defaults)
     defaults.update(kwargs)
-    ants = Registration(**defaults)
+    ants = _registration(**defaults)
     return ants
 
 
-def ants_registration_syn_node(**kwargs):
+def ants_registration_syn_node(preset='default', warm_start=False, **kwargs):
     """return antsRegistration interace instance with default values
     based on antsRegistrationSyN.sh with the s transformation option
 
-    :param \\*\\*kwargs: parameters to override the default values
+    :param preset: Name of the iteration schedule, one of :py:data:`REGISTRATION_PRESETS`.
+                   "fast" and "preview" skip the finest levels of the default schedule
+    :param warm_start: If true, the registration starts from :py:obj:`initial_moving_transform`
+                       (e.g. the transform already computed for another session of the same subject),
+                       which must then be set. Only the finest :py:data:`WARM_START_LEVELS` levels of
+                       the preset's schedule are run, with at most :py:data:`WARM_START_ITERATIONS`
+                       iterations each
+    :param \\*\\*kwargs: parameters to override the default values. If :py:obj:`cache_dir`
+                         is given, a :py:class:`pndniworkflows.interfaces.ants.CachedRegistration`
+                         is returned, which stores its outputs in that directory
     :return: :py:obj:`Registration` node
     """
     defaults = dict(dimension=3,
@@ -63,16 +118,28 @@ def ants_registration_syn_node(**kwargs):
                     winsorize_upper_quantile=0.995,
                     write_composite_transform=True,
                     output_warped_image=True)
+    _apply_preset(defaults, preset)
+    if warm_start:
+        _apply_warm_start(defaults)
     defaults.update(kwargs)
-    ants = Registration(**defaults)
+    ants = _registration(**defaults)
     return ants
 
 
-def ants_registration_affine_node(**kwargs):
+def ants_registration_affine_node(preset='default', warm_start=False, **kwargs):
     """return antsRegistration interace instance with default values
     based on antsRegistrationSyN.sh with the a transformation option
 
-    :param \\*\\*kwargs: parameters to override the default values
+    :param preset: Name of the iteration schedule, one of :py:data:`REGISTRATION_PRESETS`.
+                   "fast" and "preview" skip the finest levels of the default schedule
+    :param warm_start: If true, the registration is initialized with :py:obj:`initial_moving_transform`
+                       (e.g. the transform already computed for another session of the same subject),
+                       which must then be set, instead of by aligning the centres of mass. Only the finest
+                       :py:data:`WARM_START_LEVELS` levels of the preset's schedule are run, with at most
+                       :py:data:`WARM_START_ITERATIONS` iterations each
+    :param \\*\\*kwargs: parameters to override the default values. If :py:obj:`cache_dir`
+                         is given, a :py:class:`pndniworkflows.interfaces.ants.CachedRegistration`
+                         is returned, which stores its outputs in that directory
     :return: :py:obj:`Registration` node
     """
     defaults = dict(dimension=3,
@@ -97,6 +164,61 @@ def ants_registration_affine_node(**kwargs):
                     winsorize_upper_quantile=0.995,
                     write_composite_transform=True,
                     output_warped_image=True)
+    _apply_preset(defaults, preset)
+    if warm_start:
+        _apply_warm_start(defaults)
     defaults.update(kwargs)
-    ants = Registration(**defaults)
+    ants = _registration(**defaults)
     return ants
+
+
+def ants_registration_syn_wf(name='syn_registration', preset='default', cache_dir=None, num_threads=1,
+                             reference_image=None, memory_models=None):
+    """Create a workflow equivalent to :py:func:`ants_registration_syn_node`, but with the
+    linear and SyN stages in separate nodes. The affine registration
+    (:py:func:`ants_registration_affine_node`) initializes the SyN registration
+    (:py:func:`ants_registration_syn_no_affine_node`), so changing the SyN parameters or
+    rerunning a failed SyN stage does not repeat the linear stages.
+
+    :param name: Name of the workflow
+    :param preset: Registration schedule for both stages (see :py:data:`REGISTRATION_PRESETS`)
+    :param cache_dir: If specified, cache the outputs of each stage in this directory
+                      (see :py:class:`pndniworkflows.interfaces.ants.CachedRegistration`)
+    :param num_threads: Number of threads for each registration
+    :param reference_image: If specified with memory_models, set the memory estimates of the nodes from
+                            the size of this image (see :py:func:`pndniworkflows.resources.estimated_node`)
+    :param memory_models: Memory models for the nodes (see :py:func:`pndniworkflows.resources.memory_estimate`)
+    :return: A :py:mod:`nipype` workflow
+
+    Workflow inputs/outputs
+
+    :param inputspec.fixed_image: The fixed image
+    :param inputspec.moving_image: The moving image
+    :param outputspec.affine_transforms: The transforms from the linear stages only
+    :param outputspec.composite_transform: The composite (affine and SyN) transform
+    :param outputspec.inverse_composite_transform: The inverse composite transform
+    :param outputspec.warped_image: The moving image warped to the fixed image
+    """
+    wf = pe.Workflow(name)
+    inputspec = pe.Node(IdentityInterface(['fixed_image', 'moving_image']), 'inputspec')
+    affine = estimated_node(ants_registration_affine_node(preset=preset,
+                                                          cache_dir=cache_dir,
+                                                          num_threads=num_threads,
+                                                          write_composite_transform=False,
+                                                          output_warped_image=False), 'affine', reference_image, memory_models)
+    syn = estimated_node(ants_registration_syn_no_affine_node(preset=preset,
+                                                              cache_dir=cache_dir,
+                                                              num_threads=num_threads), 'syn', reference_image, memory_models)
+    outputspec = pe.Node(IdentityInterface(['affine_transforms', 'composite_transform',
+                                            'inverse_composite_transform', 'warped_image']),
+                         'outputspec')
+    wf.connect([(inputspec, affine, [('fixed_image', 'fixed_image'),
+                                     ('moving_image', 'moving_image')]),
+                (inputspec, syn, [('fixed_image', 'fixed_image'),
+                                  ('moving_image', 'moving_image')]),
+                (affine, syn, [('forward_transforms', 'initial_moving_transform')]),
+                (affine, outputspec, [('forward_transforms', 'affine_transforms')]),
+                (syn, outputspec, [('composite_transform', 'composite_transform'),
+                                   ('inverse_composite_transform', 'inverse_composite_transform'),
+                                   ('warped_image', 'warped_image')])])
+    return wf
@@ -0,0 +1,185 @@
+"""Memory estimates for nodes, from the size of their input images.
+
+Each interface has a :py:class:`MemoryModel`, linear in the number of voxels of the input
+image: working buffers of a fixed type (e.g. float32 copies) take :py:obj:`bytes_per_voxel`,
+and copies of the input in its own data type take :py:obj:`input_copies` times the size of
+that type. The shape and data type are read from the image header, so estimates can be made
+when a workflow is built, and are passed to :py:class:`nipype.pipeline.engine.Node` when the
+node is created (see :py:func:`estimated_node`).
+
+A compressed input takes one more copy of the input at its peak
+(:py:data:`COMPRESSED_COPIES`). nibabel memory-maps an uncompressed image, while a compressed
+one is decompressed into a buffer which is then copied into the array. Loading a 256x256x256
+image with nibabel (``np.asanyarray(img.dataobj)``, int16 and float32) raised the peak resident
+memory of the process by the size of the data for ``.nii`` and by twice that for ``.nii.gz``.
+
+No models are provided: the memory use of each tool depends on its parameters and
+version, and an estimate which is too low lets nipype start more nodes than fit in memory.
+Models are fitted with :py:func:`fit_memory_model` to runs profiled with nipype's resource
+monitor (see :py:func:`memory_samples`), and passed to the workflows, which set
+:py:obj:`mem_gb` only for nodes with a model.
+"""
+from collections import namedtuple
+from pathlib import Path
+import numpy as np
+import nibabel
+from nipype.pipeline import engine as pe
+from nipype.utils.filemanip import loadpkl
+
+
+MemoryModel = namedtuple('MemoryModel', ['base_gb', 'bytes_per_voxel', 'input_copies'], defaults=[0])
+#: Additional copies of the input (in its own data type) when it is compressed
+COMPRESSED_COPIES = 1
+_LINEAR_TRANSFORMS = ('Rigid', 'Affine', 'Translation', 'CompositeAffine', 'Similarity')
+
+
+def image_voxels(filename):
+    """Number of voxels (over all volumes) of an image, read from its header.
+
+    :param filename: image file
+    :return: number of voxels
+    """
+    return int(np.prod(nibabel.load(str(filename)).shape))
+
+
+def image_itemsize(filename):
+    """Size in bytes of the data type of an image, read from its header.
+
+    :param filename: image file
+    :return: bytes per voxel of the stored data
+    """
+    return nibabel.load(str(filename)).header.get_data_dtype().itemsize
+
+
+def image_compressed(filename):
+    """Whether an image is gzip compressed, from its file name.
+
+    :param filename: image file
+    :return: :py:obj:`bool`
+    """
+    return str(filename).lower().endswith('.gz')
+
+
+def model_key(interface):
+    """The key of the memory model for an interface. Registrations are keyed by whether
+    they include a nonlinear stage, everything else by class name.
+
+    :param interface: :py:mod:`nipype` interface
+    :return: key into the models passed to :py:func:`memory_estimate`. "registration_linear",
+             "registration_syn", or the class name
+    """
+    if hasattr(interface.inputs, 'transforms') and hasattr(interface.inputs, 'fixed_image'):
+        if all(t in _LINEAR_TRANSFORMS for t in interface.inputs.transforms):
+            return 'registration_linear'
+        return 'registration_syn'
+    return type(interface).__name__
+
+
+def estimate_mem_gb(model, nvoxels, itemsize, compressed=False):
+    """Memory estimate for an image with nvoxels voxels.
+
+    :param model: :py:class:`MemoryModel`
+    :param nvoxels: number of voxels
+    :param itemsize: size in bytes of the data type of the image
+    :param compressed: whether the image is compressed (see :py:data:`COMPRESSED_COPIES`)
+    :return: memory in GB
+    """
+    copies = model.input_copies + (COMPRESSED_COPIES if compressed else 0)
+    return model.base_gb + (model.bytes_per_voxel + copies * itemsize) * nvoxels / 2 ** 30
+
+
+def memory_estimate(interface, reference_image, models):
+    """Memory estimate for an interface, based on the size of reference_image.
+
+    :param interface: :py:mod:`nipype` interface
+    :param reference_image: image representative of the workflow's input (e.g. the subject's T1)
+    :param models: dictionary of :py:class:`MemoryModel`, keyed by :py:func:`model_key`
+    :return: memory in GB, or :py:obj:`None` if the interface has no model
+    """
+    model = models.get(model_key(interface))
+    if model is None:
+        return None
+    return estimate_mem_gb(model, image_voxels(reference_image), image_itemsize(reference_image),
+                           compressed=image_compressed(reference_image))
+
+
+def estimated_node(interface, name, reference_image=None, models=None, **kwargs):
+    """Create a :py:class:`nipype.pipeline.engine.Node` whose :py:obj:`mem_gb` is estimated
+    from the size of reference_image (see :py:func:`memory_estimate`). nipype only accepts
+    :py:obj:`mem_gb` when the node is created, so workflows take the reference image and the
+    models as arguments and create their nodes with this function.
+
+    :param interface: :py:mod:`nipype` interface
+    :param name: name of the node
+    :param reference_image: image representative of the workflow's input
+    :param models: dictionary of :py:class:`MemoryModel`, keyed by :py:func:`model_key`.
+                   nipype's default is used unless both reference_image and models are
+                   specified and models includes the interface
+    :param \\*\\*kwargs: other arguments to :py:class:`nipype.pipeline.engine.Node`
+    :return: :py:class:`nipype.pipeline.engine.Node`
+    """
+    if reference_image is not None and models is not None:
+        mem_gb = memory_estimate(interface, reference_image, models=models)
+        if mem_gb is not None:
+            kwargs['mem_gb'] = mem_gb
+    return pe.Node(interface, name=name, **kwargs)
+
+
+def fit_memory_model(nvoxels, peak_gb, margin=1.2, itemsize=None, compressed=None):
+    """Fit a :py:class:`MemoryModel` by least squares to measured peak memory use.
+
+    :param nvoxels: number of voxels of the input image of each run
+    :param peak_gb: peak memory of each run in GB
+    :param margin: factor by which the fitted coefficients are increased
+    :param itemsize: size of the data type of the input image of each run. If the runs
+                     include more than one data type, :py:obj:`input_copies` is fitted too.
+                     Otherwise it is 0, and the input is part of :py:obj:`bytes_per_voxel`
+    :param compressed: whether the input image of each run was compressed. If specified
+                       (requires itemsize), :py:data:`COMPRESSED_COPIES` copies of the
+                       compressed inputs are subtracted from their peaks, as
+                       :py:func:`estimate_mem_gb` adds them back
+    :return: :py:class:`MemoryModel`
+    """
+    nvoxels = np.asarray(nvoxels, dtype=float)
+    peak_gb = np.asarray(peak_gb, dtype=float)
+    if compressed is not None:
+        if itemsize is None:
+            raise ValueError('itemsize is required with compressed')
+        extra = COMPRESSED_COPIES * np.asarray(itemsize, dtype=float) * nvoxels / 2 ** 30
+        peak_gb = peak_gb - np.where(np.asarray(compressed, dtype=bool), extra, 0.0)
+    if len(nvoxels) < 2 or np.all(nvoxels == nvoxels[0]):
+        raise ValueError('At least two different image sizes are required to fit a memory model')
+    # GB per 2 ** 30 voxels is bytes per voxel
+    columns = [np.ones_like(nvoxels), nvoxels / 2 ** 30]
+    if itemsize is not None and len(np.unique(itemsize)) > 1:
+        columns.append(nvoxels * np.asarray(itemsize, dtype=float) / 2 ** 30)
+    coefs, *_ = np.linalg.lstsq(np.stack(columns, axis=1), peak_gb, rcond=None)
+    return MemoryModel(*(max(c, 0.0) * margin for c in coefs))
+
+
+def memory_samples(base_dir, node_name, input_name='in_file'):
+    """Collect measurements for :py:func:`fit_memory_model` from the working directories of
+    runs made with nipype's resource monitor enabled.
+
+    :param base_dir: directory to search for results of the node
+    :param node_name: name of the node
+    :param input_name: the node input whose image size the model depends on
+    :return: tuple of arrays (nvoxels, peak_gb, itemsize, compressed)
+    """
+    nvoxels = []
+    peak_gb = []
+    itemsize = []
+    compressed = []
+    for result_file in sorted(Path(base_dir).glob('**/{0}/result_{0}.pklz'.format(node_name))):
+        result = loadpkl(str(result_file))
+        peak = getattr(result.runtime, 'mem_peak_gb', None)
+        in_file = result.inputs.get(input_name)
+        if isinstance(in_file, list):
+            in_file = in_file[0]
+        if peak is None or not in_file or not Path(in_file).exists():
+            continue
+        nvoxels.append(image_voxels(in_file))
+        peak_gb.append(peak)
+        itemsize.append(image_itemsize(in_file))
+        compressed.append(image_compressed(in_file))
+    return np.array(nvoxels), np.array(peak_gb), np.array(itemsize), np.array(compressed, dtype=bool)
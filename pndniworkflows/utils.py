@@ -9,11 +9,15 @@ from itertools import product
 from collections import defaultdict, OrderedDict
 from pkg_resources import resource_filename
 import io
+import gzip
+import shutil
+import hashlib
 import numpy as np
 import nibabel
 from pathlib import Path
 from nipype.utils.filemanip import split_filename
-from pndni.convertpoints import Points
+from pndni.convertpoints import Points  # noqa:F401
+from .points import PointArray
 
 
 def get_BIDSLayout_with_conf(dir_, **kwargs):
@@ -210,14 +214,16 @@ def first_nonunique(x):
     return None
 
 
-def chunk(iterable, chunksize):
+def chunk(iterable, chunksize, partial=False):
     """Yield lists of size ``chunksize`` with elements from iterable.
 
     :param iterable: any iterable
     :param chunksize: the size of the yielded lists
+    :param partial: if true, yield the remaining elements as a shorter final list
+                    instead of raising an error
     :return: iterator
     :raises: RuntimeError if iterable is exhausted with some elements not yielded as lists
-             (i.e. if the length of the iterable is not divisible by chunksize)
+             (i.e. if the length of the iterable is not divisible by chunksize) and partial is false
 
     :Example:
 
@@ -235,7 +241,10 @@ def chunk(iterable, chunksize):
             yield out
             out = []
     if len(out) > 0:
-        raise RuntimeError('iterator length not divisible by chunksize')
+        if partial:
+            yield out
+        else:
+            raise RuntimeError('iterator length not divisible by chunksize')
     return
 
 
@@ -243,6 +252,12 @@ class UnaccountedBidsPropertiesError(Exception):
     pass
 
 
+class InProcessUnsupportedError(Exception):
+    """Raised by in-process implementations of command line tools
+    for inputs they do not support"""
+    pass
+
+
 class InvariantViolationError(Exception):
     pass
 
@@ -463,15 +478,223 @@ def csv2tsv(input_file, output_file, header=None):
             writer.writerow(row)
 
 
-def cutimage(T1, points, neckonly):
+def features2npy(in_file, out_file, chunksize=65536):
+    """Convert a whitespace delimited text matrix (e.g. the output of
+    ``classify -dump_features``) to a .npy file of float64, which can then be
+    memory-mapped with :py:func:`numpy.load`. The file is read twice (once to
+    find the shape, and once to convert ``chunksize`` rows at a time), so the
+    whole matrix is never held in memory.
+
+    :param in_file: input text file. Blank lines are ignored
+    :param out_file: output .npy file
+    :param chunksize: number of rows to convert at a time
+    """
+    nrows = 0
+    ncols = None
+    with open(in_file, 'r') as f:
+        for line in f:
+            ncols_line = len(line.split())
+            if ncols_line == 0:
+                continue
+            if ncols is None:
+                ncols = ncols_line
+            elif ncols != ncols_line:
+                raise ValueError(f'Row {nrows + 1} of {in_file} has {ncols_line} columns, expected {ncols}')
+            nrows += 1
+    out = np.lib.format.open_memmap(str(out_file), mode='w+', dtype=np.float64,
+                                    shape=(nrows, ncols or 0))
+    with open(in_file, 'r') as f:
+        lines = (line for line in f if line.strip())
+        row = 0
+        for block in chunk(lines, chunksize, partial=True):
+            values = np.array(' '.join(block).split(), dtype=np.float64)
+            out[row:row + len(block)] = values.reshape(len(block), ncols)
+            row += len(block)
+    out.flush()
+    del out
+
+
+def set_compression(filename, compress):
+    """Add or remove a ".gz" suffix according to a compression policy
+
+    :param filename: file name
+    :param compress: :py:obj:`True` to ensure the name ends in ".gz", :py:obj:`False` to
+                     ensure it does not, :py:obj:`None` to leave it unchanged
+    :return: :py:obj:`str` file name
+
+    :Example:
+
+    .. doctest::
+
+       >>> from pndniworkflows.utils import set_compression
+       >>> set_compression('T1w.nii.gz', False)
+       'T1w.nii'
+       >>> set_compression('T1w.nii', True)
+       'T1w.nii.gz'
+       >>> set_compression('T1w.nii', None)
+       'T1w.nii'
+    """
+    filename = str(filename)
+    is_compressed = filename.lower().endswith('.gz')
+    if compress is None or compress == is_compressed:
+        return filename
+    if compress:
+        return filename + '.gz'
+    return filename[:-3]
+
+
+def file_digest(filename, algorithm='sha256', blocksize=1 << 20):
+    """Hash the contents of a file.
+
+    :param filename: file to hash
+    :param algorithm: name of a :py:mod:`hashlib` algorithm
+    :param blocksize: number of bytes to read at a time
+    :return: hex digest
+    """
+    h = hashlib.new(algorithm)
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(blocksize), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+class _HashingWriter(object):
+    # file-like object which hashes everything written to it
+    def __init__(self, fileobj, hashobj):
+        self.fileobj = fileobj
+        self.hashobj = hashobj
+
+    def write(self, data):
+        self.hashobj.update(data)
+        return self.fileobj.write(data)
+
+    def flush(self):
+        self.fileobj.flush()
+
+
+def copy_file(in_file, out_file, algorithm=None, compress=None):
+    """Copy in_file to out_file. If :py:obj:`compress` is specified, the data is compressed
+    or decompressed while it is copied (according to whether in_file ends in ".gz"), so that
+    compression can be deferred to the final export of a file.
+
+    If :py:obj:`algorithm` is specified, the output is hashed as it is written,
+    so it does not need to be read again.
+
+    :param in_file: input file name
+    :param out_file: output file name
+    :param algorithm: name of a :py:mod:`hashlib` algorithm
+    :param compress: :py:obj:`True` to gzip the output, :py:obj:`False` to write it uncompressed,
+                     :py:obj:`None` to copy in_file as is
+    :return: hex digest of out_file (as :py:func:`file_digest`) if algorithm is specified,
+             otherwise :py:obj:`None`
+    """
+    in_gz = str(in_file).lower().endswith('.gz')
+    out_gz = in_gz if compress is None else compress
+    if in_gz == out_gz and algorithm is None:
+        shutil.copy(str(in_file), str(out_file))
+        return None
+    h = hashlib.new(algorithm) if algorithm is not None else None
+    with open(out_file, 'wb') as raw:
+        writer = _HashingWriter(raw, h) if h is not None else raw
+        if out_gz and not in_gz:
+            # mtime=0 so that identical inputs produce identical outputs
+            with open(in_file, 'rb') as fin, gzip.GzipFile(str(out_file), 'wb', fileobj=writer, mtime=0) as fout:
+                shutil.copyfileobj(fin, fout, 1 << 20)
+        else:
+            with (gzip.open if in_gz and not out_gz else open)(in_file, 'rb') as fin:
+                shutil.copyfileobj(fin, writer, 1 << 20)
+    shutil.copymode(str(in_file), str(out_file))
+    return h.hexdigest() if h is not None else None
+
+
+#: Name of the manifest file in the root of a dataset (see :py:func:`append_manifest`)
+MANIFEST_NAME = '.manifest.tsv'
+#: Hash algorithm used in manifests
+MANIFEST_ALGORITHM = 'blake2b'
+_MANIFEST_FIELDS = ('path', 'size', 'hash', 'source', 'params', 'mtime_ns')
+
+
+def append_manifest(manifest, path, digest, source=None, params=None):
+    """Append an entry to a manifest, a TSV file with path, size, hash, source, params, and
+    mtime_ns (modification time in nanoseconds) columns. The file is locked while the entry is written, so several processes can
+    append to the same manifest. A path may be listed more than once, in which case the
+    last entry is current (see :py:func:`read_manifest`).
+
+    :param manifest: manifest file. Created (with a header) if it does not exist
+    :param path: the file, stored relative to the directory of the manifest if it is inside it
+    :param digest: :py:data:`MANIFEST_ALGORITHM` hex digest of path
+    :param source: file path was made from
+    :param params: :py:obj:`dict` of the parameters path was made from source with. Stored as JSON
+    """
+    import fcntl
+    manifest = Path(manifest).resolve()
+    path = Path(path).resolve()
+    try:
+        relpath = path.relative_to(manifest.parent)
+    except ValueError:
+        relpath = path
+    st = path.stat()
+    row = [str(relpath), str(st.st_size), digest, '' if source is None else str(source),
+           '' if params is None else json.dumps(params, sort_keys=True), str(st.st_mtime_ns)]
+    if any('\t' in v or '\n' in v for v in row):
+        raise ValueError('Manifest entries must not contain tabs or newlines')
+    with open(manifest, 'a', newline='') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            # the position from open() may predate another process's write
+            if os.fstat(f.fileno()).st_size == 0:
+                f.write('\t'.join(_MANIFEST_FIELDS) + '\n')
+            f.write('\t'.join(row) + '\n')
+            f.flush()
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def read_manifest(manifest):
+    """Read a manifest written by :py:func:`append_manifest`. Columns are read by position,
+    so entries written before a column was added (and any header) are read with it empty.
+
+    :param manifest: manifest file
+    :return: :py:obj:`dict` mapping absolute paths to :py:obj:`dict` with size (:py:obj:`int`),
+             hash, source, params (:py:obj:`dict` or None), and mtime_ns (:py:obj:`int` or None).
+             Empty if the manifest does not exist
+    """
+    import fcntl
+    manifest = Path(manifest).resolve()
+    entries = {}
+    if not manifest.exists():
+        return entries
+    with open(manifest, 'r', newline='') as f:
+        fcntl.flock(f, fcntl.LOCK_SH)
+        try:
+            rows = list(csv.reader(f, delimiter='\t', quoting=csv.QUOTE_NONE))
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+    for row in rows[1:]:
+        row = dict(zip(_MANIFEST_FIELDS, row + [''] * (len(_MANIFEST_FIELDS) - len(row))))
+        entries[str(manifest.parent / row['path'])] = {'size': int(row['size']),
+                                                       'hash': row['hash'],
+                                                       'source': row['source'],
+                                                       'params': json.loads(row['params']) if row['params'] else None,
+                                                       'mtime_ns': int(row['mtime_ns']) if row['mtime_ns'] else None}
+    return entries
+
+
+def cutimage(T1, points, neckonly, compress=None, crop_file=None):
+    """Cut an image to the points in a TSV file (see :py:class:`pndniworkflows.interfaces.utils.CutImage`).
+    The cut is made in voxel coordinates with :py:func:`cropimage`.
+
+    :param T1: input image
+    :param points: TSV file with x, y, z, and index columns
+    :param neckonly: If true, cut off the image below the inferior-most point. Otherwise,
+                     cut to the box around the points
+    :param compress: compression policy for the output (see :py:func:`set_compression`)
+    :param crop_file: If specified, record the crop in this JSON file (see :py:func:`cropimage`)
+    :return: output file name
+    """
     t1 = nibabel.load(T1)
     aff = t1.affine
-    points_obj = Points.from_tsv(points)
-    points = []
-    for sp in points_obj.points:
-        points.append([float(sp.x), float(sp.y), float(sp.z), 1.0])
-    points = np.array(points)
-    voxel_coords = np.linalg.solve(aff, points.T)
+    voxel_coords = PointArray.from_tsv(points).voxel_coords(aff).T
     if neckonly:
         ind = np.argmax(np.abs(aff[2, :3]))
         inf_to_sup = aff[2, ind] >= 0
@@ -487,8 +710,125 @@ def cutimage(T1, points, neckonly):
         slice_ = tuple(slice(max(int(np.floor(np.min(voxel_coords[ind, :]))), 0),
                              min(int(np.ceil(np.max(voxel_coords[ind, :]))) + 1, t1.shape[ind]))
                        for ind in range(3))
-    out = t1.slicer[tuple(slice_)]
-    _, stem, ext = split_filename(T1)
-    outname = str(Path(stem + '_cropped' + ext).resolve())
+    return cropimage(T1, slice_, compress=compress, crop_file=crop_file)
+
+
+def cropimage(in_file, slices, compress=None, crop_file=None):
+    """Crop an image to slices along its first three (voxel) axes, writing
+    ``<stem>_cropped<ext>`` to the current directory.
+
+    If :py:obj:`crop_file` is specified, the shape and affine of the input and the
+    offset of the crop are written to it as JSON, so that the cropped image (or
+    an image derived from it on the same grid) can be padded back to the input
+    grid with :py:func:`uncropimage`.
+
+    :param in_file: input image
+    :param slices: three :py:class:`slice` objects with step 1 (or None)
+    :param compress: compression policy for the output (see :py:func:`set_compression`)
+    :param crop_file: JSON file in which to record the crop
+    :return: output file name
+    """
+    img = nibabel.load(str(in_file))
+    slices = tuple(slice(None) if s is None else s for s in slices)
+    ranges = [s.indices(n) for s, n in zip(slices, img.shape[:3])]
+    if any(step != 1 for _, _, step in ranges):
+        raise ValueError('Only contiguous crops are supported')
+    if any(stop <= start for start, stop, _ in ranges):
+        raise ValueError('Crop of {} is empty'.format(in_file))
+    out = img.slicer[tuple(slice(start, stop) for start, stop, _ in ranges)]
+    _, stem, ext = split_filename(str(in_file))
+    outname = str(Path(set_compression(stem + '_cropped' + ext, compress)).resolve())
     out.to_filename(outname)
+    if crop_file is not None:
+        record = {'shape': [int(n) for n in img.shape[:3]],
+                  'affine': img.affine.tolist(),
+                  'offset': [start for start, _, _ in ranges],
+                  'cropped_shape': [stop - start for start, stop, _ in ranges]}
+        with open(crop_file, 'w') as f:
+            json.dump(record, f, indent=2)
+    return outname
+
+
+def uncropimage(in_file, crop_file, fill=0, compress=None):
+    """Pad an image on a cropped grid back to the grid it was cropped from,
+    writing ``<stem>_uncropped<ext>`` to the current directory.
+
+    :param in_file: image with the shape and voxel grid of the cropped image
+                    (any additional dimensions are kept)
+    :param crop_file: JSON file written by :py:func:`cropimage`
+    :param fill: value of the voxels outside the crop
+    :param compress: compression policy for the output (see :py:func:`set_compression`)
+    :return: output file name
+    :raises: :py:class:`ValueError` if in_file is not on the cropped grid
+    """
+    with open(crop_file, 'r') as f:
+        record = json.load(f)
+    img = nibabel.load(str(in_file))
+    affine = np.array(record['affine'])
+    offset = np.array(record['offset'])
+    if list(img.shape[:3]) != record['cropped_shape']:
+        raise ValueError('{} has shape {}, but the crop has shape {}'.format(
+            in_file, img.shape[:3], tuple(record['cropped_shape'])))
+    expected = affine.copy()
+    expected[:3, 3] = affine[:3, :3] @ offset + affine[:3, 3]
+    if not np.allclose(img.affine, expected, atol=1e-4):
+        raise ValueError('{} is not on the grid of the crop'.format(in_file))
+    data = np.asanyarray(img.dataobj)
+    out = np.full(tuple(record['shape']) + data.shape[3:], fill, dtype=data.dtype)
+    out[tuple(slice(o, o + n) for o, n in zip(offset, data.shape[:3]))] = data
+    header = img.header.copy()
+    # scaling has already been applied to data
+    header.set_slope_inter(None, None)
+    outimg = type(img)(out, affine, header)
+    _, stem, ext = split_filename(str(in_file))
+    outname = str(Path(set_compression(stem + '_uncropped' + ext, compress)).resolve())
+    outimg.to_filename(outname)
     return outname
+
+
+# ITK and nibabel use LPS and RAS world coordinates respectively
+_LPS = np.diag([-1.0, -1.0, 1.0, 1.0])
+
+
+def read_itk_affine(filename):
+    """Read an ITK affine transform (e.g. the ``.mat`` files written by ANTs)
+    and return it as a 4x4 matrix acting on RAS coordinates.
+
+    :param filename: ITK transform file in MATLAB format
+    :return: 4x4 :py:class:`numpy.ndarray`
+    """
+    from scipy.io import loadmat
+    mat = loadmat(str(filename))
+    keys = [k for k in mat
+            if k.split('_')[0] in ('AffineTransform', 'MatrixOffsetTransformBase') and k.endswith('_3_3')]
+    if len(keys) != 1:
+        raise ValueError(f'{filename} does not contain a single 3D affine transform')
+    params = mat[keys[0]].ravel()
+    A = params[:9].reshape(3, 3)
+    center = mat['fixed'].ravel() if 'fixed' in mat else np.zeros(3)
+    lps = np.eye(4)
+    lps[:3, :3] = A
+    lps[:3, 3] = params[9:12] + center - A @ center
+    return _LPS @ lps @ _LPS
+
+
+def transform_points(in_file, transforms, out_file, invert_transform_flags=None):
+    """Apply ITK affine transforms to a points TSV file, as with
+    ``antsApplyTransformsToPoints``. As with ANTs, the transforms are applied in reverse order
+    (the last one listed is applied first).
+
+    :param in_file: TSV file with x, y, z, and index columns
+    :param transforms: list of ITK affine transform files (see :py:func:`read_itk_affine`)
+    :param out_file: output TSV file
+    :param invert_transform_flags: list of booleans, one per transform, indicating whether
+                                   to invert that transform
+    """
+    if invert_transform_flags is None:
+        invert_transform_flags = [False] * len(transforms)
+    if len(invert_transform_flags) != len(transforms):
+        raise ValueError('invert_transform_flags must be the same length as transforms')
+    total = np.eye(4)
+    for transform, invert in zip(transforms, invert_transform_flags):
+        aff = read_itk_affine(transform)
+        total = total @ (np.linalg.inv(aff) if invert else aff)
+    PointArray.from_tsv(in_file).transform(total).to_tsv(out_file)
@@ -16,7 +16,8 @@ setup(
     setup_requires=['pytest-runner'],
     tests_require=['pytest'],
     extra_require={
-        'doc': ['Sphinx', 'sphinx-argparse', 'sphinx-rtd-theme']
+        'doc': ['Sphinx', 'sphinx-argparse', 'sphinx-rtd-theme'],
+        'minc': ['h5py'],
     },
     packages=find_packages(),
     package_data={
@@ -0,0 +1,73 @@
+import numpy as np
+import nibabel
+import os
+import shutil
+import pytest
+from nipype.interfaces.ants.registration import Registration
+from nipype.utils.filemanip import indirectory
+from pndniworkflows.registration import ants_registration_affine_node
+from pndniworkflows.interfaces.ants import ThreadedRegistration, CachedRegistration
+from nipype.pipeline import engine as pe
+from traits.api import TraitError
+
+
+def _fake_run(calls):
+    # write the expected outputs instead of running antsRegistration
+    def run(self, runtime, correct_return_codes=(0,)):
+        calls.append(runtime.cwd)
+        outputs = self._list_outputs()
+        for f in outputs['forward_transforms'] + [outputs['warped_image']]:
+            with open(f, 'w') as fobj:
+                fobj.write(f'{len(calls)} {os.path.basename(f)}')
+        runtime.returncode = 0
+        return runtime
+    return run
+
+
+def test_CachedRegistration(tmp_path, monkeypatch):
+    calls = []
+    monkeypatch.setattr(Registration, '_run_interface', _fake_run(calls))
+    rng = np.random.default_rng(0)
+    for name in ['fixed', 'moving']:
+        nibabel.Nifti1Image(rng.normal(size=(4, 5, 6)), np.eye(4)).to_filename(str(tmp_path / f'{name}.nii'))
+    shutil.copyfile(tmp_path / 'moving.nii', tmp_path / 'moving2.nii')
+    cache_dir = tmp_path / 'cache'
+
+    def run(wd, moving='moving.nii', **kwargs):
+        reg = ants_registration_affine_node(cache_dir=str(cache_dir), write_composite_transform=False, **kwargs)
+        assert isinstance(reg, CachedRegistration)
+        reg.inputs.fixed_image = str(tmp_path / 'fixed.nii')
+        reg.inputs.moving_image = str(tmp_path / moving)
+        (tmp_path / wd).mkdir()
+        with indirectory(str(tmp_path / wd)):
+            return reg.run().outputs
+
+    out1 = run('a')
+    assert len(calls) == 1
+    # same content under a different name and working directory, and a different number of threads
+    out2 = run('b', moving='moving2.nii', num_threads=4)
+    assert len(calls) == 1
+    assert out2.forward_transforms[0].startswith(str(tmp_path / 'b'))
+    assert os.path.exists(out2.warped_image)
+    for f1, f2 in zip(out1.forward_transforms + [out1.warped_image], out2.forward_transforms + [out2.warped_image]):
+        assert open(f1).read() == open(f2).read()
+    run('c', sampling_percentage=[0.5, 0.5])
+    assert len(calls) == 2
+    assert len([p for p in cache_dir.iterdir() if not p.name.startswith('.')]) == 2
+
+
+def test_registration_no_cache():
+    assert type(ants_registration_affine_node()) is ThreadedRegistration
+
+
+def test_registration_threads(monkeypatch):
+    monkeypatch.setenv('ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS', '64')
+    reg = ants_registration_affine_node(num_threads=3)
+    assert reg.inputs.environ['ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS'] == '3'
+    assert reg.inputs.environ['NSLOTS'] == '3'
+    node = pe.Node(reg, name='reg')
+    assert node.n_procs == 3
+    node.n_procs = 2
+    assert reg.inputs.environ['ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS'] == '2'
+    with pytest.raises(TraitError):
+        ants_registration_affine_node(num_threads=-1)
@@ -0,0 +1,45 @@
+import pytest
+from nipype.pipeline import engine as pe
+from nipype import IdentityInterface
+from pndniworkflows.formats import connect_image, image_format
+from pndniworkflows.interfaces.minc import NUCorrect, INormalize, Classify, Mnc2nii, Nii2mnc
+from pndniworkflows.interfaces.pndni_utils import ForceQForm, MncLabel2NiiLabel
+
+
+def test_image_format():
+    assert image_format(pe.Node(NUCorrect(), 'nu'), 'in_file', output=False) == 'minc'
+    assert image_format(pe.Node(Mnc2nii(), 'm2n'), 'out_file') == 'nifti'
+    assert image_format(pe.Node(IdentityInterface(['T1']), 'inputspec'), 'T1') is None
+
+
+def test_connect_image():
+    wf = pe.Workflow('wf')
+    inputspec = pe.Node(IdentityInterface(['T1']), 'inputspec')
+    qform = pe.Node(ForceQForm(), 'qform')
+    nu = pe.Node(NUCorrect(), 'nu')
+    inorm = pe.Node(INormalize(), 'inorm')
+    classify = pe.Node(Classify(), 'classify')
+    qform2 = pe.Node(ForceQForm(), 'qform2')
+    assert connect_image(wf, inputspec, 'T1', qform, 'in_file') is None
+    assert isinstance(connect_image(wf, qform, 'out_file', nu, 'in_file').interface, Nii2mnc)
+    assert connect_image(wf, nu, 'out_file', inorm, 'in_file') is None
+    assert connect_image(wf, inorm, 'out_file', classify, 'in_file') is None
+    convert = connect_image(wf, classify, 'out_file', qform2, 'in_file', labels=True)
+    assert isinstance(convert.interface, MncLabel2NiiLabel)
+    assert len(wf._graph.nodes()) == 8
+
+
+def test_connect_image_fan_out():
+    wf = pe.Workflow('wf')
+    qform = pe.Node(ForceQForm(), 'qform')
+    nu = pe.Node(NUCorrect(), 'nu')
+    classify = pe.Node(Classify(), 'classify')
+    convert = connect_image(wf, qform, 'out_file', nu, 'in_file')
+    assert connect_image(wf, qform, 'out_file', classify, 'in_file') is convert
+    assert len(wf._graph.nodes()) == 4
+    assert sorted(n.name for n in wf._graph.successors(convert)) == ['classify', 'nu']
+    qform2 = pe.Node(ForceQForm(), 'qform2')
+    qform3 = pe.Node(ForceQForm(), 'qform3')
+    connect_image(wf, classify, 'out_file', qform2, 'in_file', labels=True)
+    with pytest.raises(ValueError):
+        connect_image(wf, classify, 'out_file', qform3, 'in_file', labels=False)
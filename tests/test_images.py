@@ -0,0 +1,141 @@
+import numpy as np
+import nibabel
+import pytest
+from nipype.utils.filemanip import indirectory
+from pndniworkflows.interfaces.images import VoxelClassify, PercentileNormalize, DownsampleImage, ForegroundMask, FindNeck
+from pndniworkflows.images import histogram_percentiles
+from utils import head_phantom
+
+
+@pytest.fixture
+def tissue_image(tmp_path):
+    rng = np.random.default_rng(0)
+    truth = np.zeros((20, 21, 22), dtype=np.uint8)
+    truth[5:15, 5:15, 5:15] = 1
+    truth[8:12, 8:12, 8:12] = 2
+    truth[:, :, 18:] = 3
+    means = np.array([0.0, 100.0, 200.0, 300.0])
+    data = means[truth] + rng.normal(scale=10.0, size=truth.shape)
+    affine = np.diag([2.0, 1.0, 1.5, 1.0])
+    affine[:3, 3] = [-10, 5, 3]
+    nibabel.Nifti1Image(data.astype(np.float32), affine).to_filename(str(tmp_path / 'in.nii.gz'))
+    mask = truth > 0
+    nibabel.Nifti1Image(mask.astype(np.uint8), affine).to_filename(str(tmp_path / 'mask.nii.gz'))
+    lines = []
+    for label in [1, 2, 3]:
+        vox = np.argwhere(truth == label)[::7][:20]
+        for v in vox:
+            x, y, z = (affine @ np.append(v, 1.0))[:3]
+            lines.append(f' {x} {y} {z} 0 -1 -1 "{label}"')
+    (tmp_path / 'tags.tag').write_text('MNI Tag Point File\nVolumes = 1;\nPoints =\n' + '\n'.join(lines) + ';\n')
+    return tmp_path, truth
+
+
+@pytest.mark.parametrize('method', ['bayes', 'knn'])
+def test_VoxelClassify(tissue_image, method):
+    tmp_path, truth = tissue_image
+    i = VoxelClassify(in_file=tmp_path / 'in.nii.gz', tag_file=tmp_path / 'tags.tag',
+                      mask_file=tmp_path / 'mask.nii.gz', method=method,
+                      chunksize=1000, num_threads=3)
+    with indirectory(tmp_path):
+        r = i.run()
+    assert r.outputs.out_file.endswith('in_classified.nii.gz')
+    out = nibabel.load(r.outputs.out_file)
+    assert out.get_data_dtype() == np.uint8
+    assert np.allclose(out.affine, nibabel.load(str(tmp_path / 'in.nii.gz')).affine)
+    assert np.all(np.asanyarray(out.dataobj) == truth)
+
+
+def test_VoxelClassify_num_threads_hash(tissue_image):
+    tmp_path, _ = tissue_image
+    kwargs = dict(in_file=tmp_path / 'in.nii.gz', tag_file=tmp_path / 'tags.tag')
+    hashes = [VoxelClassify(num_threads=n, **kwargs).inputs.get_hashval()[1] for n in [1, 4]]
+    assert hashes[0] == hashes[1]
+
+
+@pytest.mark.parametrize('nbins', [1, 4, 4096])
+def test_histogram_percentiles(nbins):
+    rng = np.random.default_rng(0)
+    data = np.concatenate([np.zeros(5000), rng.exponential(100.0, size=10001)])
+    p = [0, 2, 37.5, 50, 98, 100]
+    assert np.allclose(histogram_percentiles(data, p, nbins=nbins), np.percentile(data, p))
+
+
+@pytest.mark.parametrize('out_dtype', ['float32', 'uint16'])
+@pytest.mark.parametrize('masked', [False, True])
+def test_PercentileNormalize(tissue_image, out_dtype, masked):
+    tmp_path, truth = tissue_image
+    i = PercentileNormalize(in_file=tmp_path / 'in.nii.gz', const2=[0, 1000], range=5, out_dtype=out_dtype)
+    if masked:
+        i.inputs.mask_file = tmp_path / 'mask.nii.gz'
+    with indirectory(tmp_path):
+        r = i.run()
+    assert r.outputs.out_file.endswith('in_inorm.nii.gz')
+    out = nibabel.load(r.outputs.out_file)
+    assert out.get_data_dtype() == np.dtype(out_dtype)
+    data = np.asanyarray(nibabel.load(str(tmp_path / 'in.nii.gz')).dataobj)
+    values = data[truth > 0] if masked else data
+    lo, hi = np.percentile(values, [5, 95])
+    expected = (data - lo) * 1000 / (hi - lo)
+    if out_dtype == 'uint16':
+        expected = np.clip(np.rint(expected), 0, 65535)
+    assert np.allclose(np.asanyarray(out.dataobj), expected, atol=1e-2)
+
+
+def test_DownsampleImage(tmp_path):
+    data = np.arange(5 * 6 * 7, dtype=np.float32).reshape((5, 6, 7))
+    affine = np.array([[0, 2.0, 0, 3], [-1.0, 0, 0, 4], [0, 0, 1.5, -5], [0, 0, 0, 1]])
+    nibabel.Nifti1Image(data, affine).to_filename(str(tmp_path / 'in.nii'))
+    with indirectory(tmp_path):
+        r = DownsampleImage(in_file=tmp_path / 'in.nii', factors=[2, 3, 1]).run()
+    assert r.outputs.out_file.endswith('in_downsampled.nii')
+    out = nibabel.load(r.outputs.out_file)
+    assert out.shape == (2, 2, 7)
+    assert np.allclose(out.get_fdata()[1, 0, 4], data[2:4, 0:3, 4].mean())
+    # the centre of each block keeps its world coordinates
+    assert np.allclose(out.affine @ [1, 0, 4, 1], affine @ [2.5, 1, 4, 1])
+
+
+def test_ForegroundMask(tmp_path):
+    rng = np.random.default_rng(0)
+    data = rng.normal(scale=2.0, size=(20, 21, 22))
+    truth = np.zeros(data.shape, dtype=bool)
+    truth[3:15, 4:16, 5:17] = True
+    data[truth] += 100
+    # a dark hole inside the head and a small bright region outside it
+    data[7:10, 8:11, 9:12] -= 100
+    data[17:19, 17:19, 18:20] += 100
+    nibabel.Nifti1Image(data, np.eye(4)).to_filename(str(tmp_path / 'in.nii.gz'))
+    with indirectory(tmp_path):
+        r = ForegroundMask(in_file=tmp_path / 'in.nii.gz', dilate=0).run()
+    assert r.outputs.out_file.endswith('in_mask.nii.gz')
+    mask = np.asanyarray(nibabel.load(r.outputs.out_file).dataobj)
+    assert mask.dtype == np.uint8
+    assert np.all(mask == truth)
+    with indirectory(tmp_path):
+        r = ForegroundMask(in_file=tmp_path / 'in.nii.gz', dilate=1).run()
+    mask = np.asanyarray(nibabel.load(r.outputs.out_file).dataobj)
+    assert mask.sum() == 12 ** 3 + 6 * 12 ** 2
+
+
+@pytest.mark.parametrize('flip', [False, True])
+def test_FindNeck(tmp_path, flip):
+    head_phantom(tmp_path / 'in.nii.gz', flip=flip)
+    with indirectory(tmp_path):
+        r = FindNeck(in_file=tmp_path / 'in.nii.gz').run()
+    assert r.outputs.out_file.endswith('in_neck.tsv')
+    with open(r.outputs.out_file) as f:
+        assert f.readline() == 'x\ty\tz\tindex\n'
+        z = float(f.readline().split('\t')[2])
+    # below the head and above the shoulders
+    assert 70 < z < 125
+
+
+def test_DownsampleImage_voxel_size(tmp_path):
+    affine = np.diag([0.9, 1.1, 2.0, 1.0])
+    nibabel.Nifti1Image(np.zeros((20, 20, 20), dtype=np.float32), affine).to_filename(str(tmp_path / 'in.nii'))
+    with indirectory(tmp_path):
+        r = DownsampleImage(in_file=tmp_path / 'in.nii', voxel_size=4.0).run()
+    out = nibabel.load(r.outputs.out_file)
+    assert out.shape == (20 // 4, 20 // 4, 20 // 2)
+    assert np.allclose(out.header.get_zooms(), [3.6, 4.4, 4.0])
@@ -2,10 +2,14 @@ from pndniworkflows import preprocessing  # noqa:F401
 from pndniworkflows import postprocessing  # noqa:F401
 from pndniworkflows import registration  # noqa:F401
 from pndniworkflows import utils  # noqa:F401
+from pndniworkflows import points  # noqa:F401
+from pndniworkflows import resources  # noqa:F401
 from pndniworkflows.interfaces import utils as int_utils  # noqa:F401
 from pndniworkflows.interfaces import pndni_utils  # noqa:F401
 from pndniworkflows.interfaces import io  # noqa:F401
 from pndniworkflows.interfaces import minc  # noqa:F401
+from pndniworkflows.interfaces import images as int_images  # noqa:F401
+from pndniworkflows.interfaces import ants  # noqa:F401
 
 
 def test_import():
@@ -1,9 +1,14 @@
-from pndniworkflows.interfaces.io import WriteFSLStats, WriteBIDSFile, WriteFile, RenameAndCheckExtension, MismatchedExtensionError, ExportFile
+from pndniworkflows.utils import read_manifest, file_digest, MANIFEST_NAME
+from pndniworkflows.interfaces.io import WriteFSLStats, WriteBIDSFile, WriteBIDSFiles, WriteFile, RenameAndCheckExtension, MismatchedExtensionError, ExportFile
 import pytest
 import csv
+import gzip
+import os
 from pathlib import Path
 from collections import OrderedDict
 from utils import cdtmppath
+import numpy as np
+import nibabel
 
 
 def test_write_bids(cdtmppath):
@@ -172,3 +177,239 @@ def test_ExportFile(tmp_path):
     i.inputs.clobber = True
     i.run()
     assert (tmp_path / 'out.txt').read_text() == 'test string'
+
+
+def test_write_bids_compress(cdtmppath):
+    Path('test.nii').write_bytes(b'testnii')
+    outpath = (cdtmppath / 'out').resolve()
+    outpath.mkdir()
+    w = WriteBIDSFile(out_dir=str(outpath), bidsparams={'suffix': 'T1w', 'subject': '1'},
+                      in_file=str(Path('test.nii').resolve()), compress=True)
+    r = w.run()
+    assert r.outputs.out_file == str(outpath / 'sub-1/anat/sub-1_T1w.nii.gz')
+    assert gzip.decompress(Path(r.outputs.out_file).read_bytes()) == b'testnii'
+    w = WriteBIDSFile(out_dir=str(outpath), bidsparams={'suffix': 'T1w', 'subject': '2'},
+                      in_file=r.outputs.out_file, compress=False)
+    r = w.run()
+    assert r.outputs.out_file == str(outpath / 'sub-2/anat/sub-2_T1w.nii')
+    assert Path(r.outputs.out_file).read_bytes() == b'testnii'
+
+
+def test_ExportFile_compress(tmp_path):
+    testin = tmp_path / 'in.nii'
+    testin.write_bytes(b'test string')
+    i = ExportFile(in_file=testin, out_file=tmp_path / 'out.nii.gz', check_extension=True, compress=True)
+    i.run()
+    assert gzip.decompress((tmp_path / 'out.nii.gz').read_bytes()) == b'test string'
+    ExportFile(in_file=tmp_path / 'out.nii.gz', out_file=tmp_path / 'out2.nii', check_extension=True,
+               compress=False).run()
+    assert (tmp_path / 'out2.nii').read_bytes() == b'test string'
+    i = ExportFile(in_file=tmp_path / 'out.nii.gz', out_file=tmp_path / 'out.tsv', check_extension=True,
+                   compress=False)
+    with pytest.raises(MismatchedExtensionError):
+        i.run()
+    # the name must agree with compress
+    with pytest.raises(ValueError):
+        ExportFile(in_file=testin, out_file=tmp_path / 'out3.nii', compress=True).run()
+    # without compress, the file is copied as is, and ".gz" is part of the extension
+    with pytest.raises(MismatchedExtensionError):
+        ExportFile(in_file=testin, out_file=tmp_path / 'out4.nii.gz', check_extension=True).run()
+    ExportFile(in_file=tmp_path / 'out.nii.gz', out_file=tmp_path / 'out5.nii.gz', check_extension=True).run()
+    assert (tmp_path / 'out5.nii.gz').read_bytes() == (tmp_path / 'out.nii.gz').read_bytes()
+
+
+@pytest.mark.parametrize('values,dtype', [([0, 1, 2, 255], 'uint8'), ([-1, 0, 3], 'int8'), ([0, 1000], 'uint16')])
+def test_ExportFile_downcast_labels(tmp_path, values, dtype):
+    data = np.zeros((4, 5, 6))
+    data.flat[:len(values)] = values
+    nibabel.Nifti1Image(data, np.diag([2.0, 1.0, 1.0, 1.0])).to_filename(str(tmp_path / 'in.nii.gz'))
+    ExportFile(in_file=tmp_path / 'in.nii.gz', out_file=tmp_path / 'out.nii.gz', downcast='labels').run()
+    out = nibabel.load(str(tmp_path / 'out.nii.gz'))
+    assert out.get_data_dtype() == np.dtype(dtype)
+    assert np.array_equal(np.asanyarray(out.dataobj), data)
+    assert np.allclose(out.affine, np.diag([2.0, 1.0, 1.0, 1.0]))
+    data.flat[0] = 0.5
+    nibabel.Nifti1Image(data, np.eye(4)).to_filename(str(tmp_path / 'in2.nii'))
+    with pytest.raises(ValueError):
+        ExportFile(in_file=tmp_path / 'in2.nii', out_file=tmp_path / 'out2.nii', downcast='labels').run()
+    assert not (tmp_path / 'out2.nii').exists()
+
+
+def test_ExportFile_downcast_int16(tmp_path):
+    data = np.random.default_rng(0).normal(loc=100.0, scale=20.0, size=(10, 11, 12))
+    nibabel.Nifti1Image(data, np.eye(4)).to_filename(str(tmp_path / 'in.nii'))
+    ExportFile(in_file=tmp_path / 'in.nii', out_file=tmp_path / 'out.nii', downcast='int16',
+               downcast_tolerance=0.01).run()
+    out = nibabel.load(str(tmp_path / 'out.nii'))
+    assert out.get_data_dtype() == np.dtype('int16')
+    assert np.max(np.abs(out.get_fdata() - data)) <= 0.01
+    with pytest.raises(ValueError):
+        ExportFile(in_file=tmp_path / 'in.nii', out_file=tmp_path / 'out2.nii', downcast='int16',
+                   downcast_tolerance=1e-5).run()
+
+
+def test_ExportFile_manifest_params(tmp_path):
+    # the manifest entry of a derived file only applies to the same parameters
+    data = np.random.default_rng(0).normal(loc=100.0, scale=20.0, size=(10, 11, 12))
+    nibabel.Nifti1Image(np.round(data), np.eye(4)).to_filename(str(tmp_path / 'in.nii'))
+    manifest = tmp_path / MANIFEST_NAME
+    kwargs = dict(in_file=tmp_path / 'in.nii', out_file=tmp_path / 'out.nii', manifest=manifest, clobber=True)
+    ExportFile(downcast='labels', **kwargs).run()
+    with pytest.raises(ValueError, match='A tolerance is required for int16'):
+        ExportFile(downcast='int16', **kwargs).run()
+    ExportFile(downcast='int16', downcast_tolerance=0.5, **kwargs).run()
+    assert nibabel.load(str(tmp_path / 'out.nii')).get_data_dtype() == np.dtype('int16')
+    entry = read_manifest(manifest)[str(tmp_path / 'out.nii')]
+    assert entry['params'] == {'downcast': 'int16', 'downcast_tolerance': 0.5, 'compress': None}
+    assert entry['hash'] == file_digest(tmp_path / 'out.nii', 'blake2b')
+
+
+def test_write_bids_downcast(cdtmppath):
+    nibabel.Nifti1Image(np.arange(60.0).reshape(3, 4, 5), np.eye(4)).to_filename('labels.nii')
+    outpath = (cdtmppath / 'out').resolve()
+    outpath.mkdir()
+    r = WriteBIDSFile(out_dir=str(outpath), bidsparams={'suffix': 'T1w', 'subject': '1'},
+                      in_file=str(Path('labels.nii').resolve()), compress=True, downcast='labels').run()
+    assert r.outputs.out_file == str(outpath / 'sub-1/anat/sub-1_T1w.nii.gz')
+    out = nibabel.load(r.outputs.out_file)
+    assert out.get_data_dtype() == np.dtype('uint8')
+    assert np.array_equal(np.asanyarray(out.dataobj), np.arange(60).reshape(3, 4, 5))
+
+
+def test_write_bids_manifest(cdtmppath):
+    Path('test.nii').write_bytes(b'testnii')
+    outpath = (cdtmppath / 'out').resolve()
+    outpath.mkdir()
+    r = WriteBIDSFile(out_dir=str(outpath),
+                      bidsparams={'subject': '1', 'suffix': 'dseg', 'space': 'T1w', 'desc': 'tissue'},
+                      in_file=str(Path('test.nii').resolve()), manifest=True,
+                      labelinfo=[OrderedDict([('index', 1), ('name', 'brain')])]).run()
+    entries = read_manifest(outpath / MANIFEST_NAME)
+    assert entries[r.outputs.out_file] == {'size': Path(r.outputs.out_file).stat().st_size,
+                                           'hash': file_digest(r.outputs.out_file, 'blake2b'),
+                                           'source': str(Path('test.nii').resolve()),
+                                           'params': {'downcast': 'none', 'downcast_tolerance': None, 'compress': None},
+                                           'mtime_ns': Path(r.outputs.out_file).stat().st_mtime_ns}
+    assert entries[r.outputs.out_labelfile]['hash'] == file_digest(r.outputs.out_labelfile, 'blake2b')
+    ExportFile(in_file='test.nii', out_file=str(outpath / 'exported.nii'),
+               manifest=str(outpath / MANIFEST_NAME)).run()
+    entries = read_manifest(outpath / MANIFEST_NAME)
+    assert entries[str(outpath / 'exported.nii')]['hash'] == file_digest(outpath / 'exported.nii', 'blake2b')
+
+
+def test_write_bids_on_exists(cdtmppath):
+    Path('test.nii').write_bytes(b'testnii')
+    Path('test2.nii').write_bytes(b'testni2')
+    outpath = (cdtmppath / 'out').resolve()
+    outpath.mkdir()
+
+    def write(in_file, on_exists, **kwargs):
+        return WriteBIDSFile(out_dir=str(outpath), bidsparams={'suffix': 'T1w', 'subject': '1'},
+                             in_file=str(Path(in_file).resolve()), on_exists=on_exists, **kwargs).run()
+
+    r = write('test.nii', 'error', manifest=True)
+    out_file = Path(r.outputs.out_file)
+    with pytest.raises(RuntimeError):
+        write('test.nii', 'error')
+    mtime = out_file.stat().st_mtime_ns
+    write('test.nii', 'skip')
+    assert out_file.stat().st_mtime_ns == mtime
+    with pytest.raises(FileExistsError):
+        write('test2.nii', 'skip')
+    assert out_file.read_bytes() == b'testnii'
+    write('test2.nii', 'replace', manifest=True)
+    assert out_file.read_bytes() == b'testni2'
+    assert read_manifest(outpath / MANIFEST_NAME)[str(out_file)]['hash'] == file_digest(out_file, 'blake2b')
+    # the hash in the manifest is used for a file of the same size and modification time
+    st = out_file.stat()
+    out_file.write_bytes(b'testnii')
+    os.utime(out_file, ns=(st.st_atime_ns, st.st_mtime_ns))
+    with pytest.raises(FileExistsError):
+        write('test.nii', 'skip')
+    # but not if the file was modified since
+    os.utime(out_file, ns=(st.st_atime_ns, st.st_mtime_ns + 1000))
+    write('test.nii', 'skip')
+    assert out_file.read_bytes() == b'testnii'
+    # temporary files are removed
+    assert sorted(p.name for p in outpath.iterdir()) == [MANIFEST_NAME, 'sub-1']
+    assert [p.name for p in out_file.parent.iterdir()] == [out_file.name]
+
+
+def test_write_bids_on_exists_without_writing(cdtmppath, monkeypatch):
+    from pndniworkflows.interfaces import io
+    nibabel.Nifti1Image(np.arange(24).reshape(2, 3, 4), np.eye(4)).to_filename('labels.nii')
+    Path('test.nii').write_bytes(b'testnii')
+    outpath = (cdtmppath / 'out').resolve()
+    outpath.mkdir()
+
+    def write(in_file, **kwargs):
+        return WriteBIDSFile(out_dir=str(outpath), in_file=str(Path(in_file).resolve()), on_exists='skip',
+                             **kwargs).run().outputs.out_file
+
+    copied = write('test.nii', bidsparams={'suffix': 'T1w', 'subject': '1'})
+    downcast = write('labels.nii', bidsparams={'suffix': 'T1w', 'subject': '2'}, downcast='labels', manifest=True)
+
+    def fail(*args, **kwargs):
+        raise AssertionError('the output should not be written')
+
+    monkeypatch.setattr(io, 'copy_file', fail)
+    monkeypatch.setattr(io, 'downcast_image', fail)
+    # an identical copy is found by hashing the input
+    write('test.nii', bidsparams={'suffix': 'T1w', 'subject': '1'})
+    # a derived file is current if the manifest records it as made from the unmodified input
+    write('labels.nii', bidsparams={'suffix': 'T1w', 'subject': '2'}, downcast='labels', manifest=True)
+    # a different copy is found without writing it
+    Path('test.nii').write_bytes(b'testni2')
+    with pytest.raises(FileExistsError):
+        write('test.nii', bidsparams={'suffix': 'T1w', 'subject': '1'})
+    assert Path(copied).read_bytes() == b'testnii'
+    # a modified input is written again to compare it
+    mtime = Path(downcast).stat().st_mtime_ns
+    os.utime('labels.nii', ns=(mtime + 10 ** 9, mtime + 10 ** 9))
+    with pytest.raises(AssertionError):
+        write('labels.nii', bidsparams={'suffix': 'T1w', 'subject': '2'}, downcast='labels', manifest=True)
+    monkeypatch.undo()
+    write('labels.nii', bidsparams={'suffix': 'T1w', 'subject': '2'}, downcast='labels', manifest=True)
+    assert Path(downcast).stat().st_mtime_ns == mtime
+
+
+def test_ExportFile_failed_write(tmp_path):
+    nibabel.Nifti1Image(np.full((2, 3, 4), 0.5), np.eye(4)).to_filename(str(tmp_path / 'in.nii'))
+    (tmp_path / 'out').mkdir()
+    with pytest.raises(ValueError):
+        ExportFile(in_file=tmp_path / 'in.nii', out_file=tmp_path / 'out' / 'out.nii', downcast='labels').run()
+    assert list((tmp_path / 'out').iterdir()) == []
+
+
+def test_write_bids_files(cdtmppath):
+    in_files = []
+    for i in range(6):
+        Path(f'test{i}.nii').write_bytes(f'testnii{i}'.encode())
+        in_files.append(str(Path(f'test{i}.nii').resolve()))
+    outpath = (cdtmppath / 'out').resolve()
+    outpath.mkdir()
+    bidsparams = [{'subject': '1', 'desc': f'd{i}', 'suffix': 'T1w'} for i in range(5)]
+    bidsparams.append({'subject': '1', 'suffix': 'dseg', 'space': 'T1w', 'desc': 'tissue'})
+    labelinfo = [None] * 5 + [[OrderedDict(index=1, name='GM')]]
+    w = WriteBIDSFiles(out_dir=str(outpath), in_files=in_files, bidsparams=bidsparams, labelinfo=labelinfo,
+                       manifest=True, num_threads=3)
+    r = w.run()
+    expected = [str(outpath / f'sub-1/anat/sub-1_desc-d{i}_T1w.nii') for i in range(5)]
+    expected.append(str(outpath / 'sub-1/anat/sub-1_space-T1w_desc-tissue_dseg.nii'))
+    assert r.outputs.out_files == expected
+    for i, out_file in enumerate(expected):
+        assert Path(out_file).read_bytes() == f'testnii{i}'.encode()
+    assert r.outputs.out_labelfiles == [None] * 5 + [expected[-1].replace('.nii', '_labels.tsv')]
+    assert Path(r.outputs.out_labelfiles[-1]).read_text() == 'index\tname\n1\tGM\n'
+    assert len(read_manifest(outpath / MANIFEST_NAME)) == 7
+    with pytest.raises(RuntimeError):
+        w.run()
+    w.inputs.on_exists = 'skip'
+    w.run()
+    # a node only reserves one processor unless asked for more
+    assert WriteBIDSFiles().inputs.num_threads == 1
+    with pytest.raises(ValueError):
+        WriteBIDSFiles(out_dir=str(outpath), in_files=in_files[:2], bidsparams=bidsparams[:1]).run()
+    with pytest.raises(ValueError):
+        WriteBIDSFiles(out_dir=str(outpath), in_files=in_files[:2], bidsparams=[bidsparams[0]] * 2,
+                       on_exists='replace').run()
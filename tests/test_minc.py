@@ -0,0 +1,52 @@
+import numpy as np
+import os
+import stat
+import pytest
+from nipype.utils.filemanip import indirectory
+from pndniworkflows.interfaces.minc import Classify
+from nipype.pipeline import engine as pe
+from traits.api import TraitError
+
+
+@pytest.fixture
+def fake_classify(tmp_path, monkeypatch):
+    bindir = tmp_path / 'bin'
+    bindir.mkdir()
+    script = bindir / 'classify'
+    script.write_text('#!/bin/sh\nprintf "1 2.5\\n3 4\\n\\n5 6e1\\n"\n')
+    script.chmod(script.stat().st_mode | stat.S_IEXEC)
+    monkeypatch.setenv('PATH', str(bindir) + os.pathsep + os.environ['PATH'])
+    for name in ['in.mnc', 'tags.tag']:
+        (tmp_path / name).write_text('')
+    return tmp_path
+
+
+def test_classify_dump_features(fake_classify):
+    i = Classify(in_file=fake_classify / 'in.mnc', tag_file=fake_classify / 'tags.tag',
+                 dump_features=True, features_npy=True)
+    with indirectory(fake_classify):
+        r = i.run()
+    assert r.runtime.stdout == ''
+    with open(r.outputs.features, 'r') as f:
+        assert f.read() == '1 2.5\n3 4\n\n5 6e1\n'
+    features = np.load(r.outputs.features_npy, mmap_mode='r')
+    assert np.all(features == [[1.0, 2.5], [3.0, 4.0], [5.0, 60.0]])
+
+
+def test_classify_threads(fake_classify, monkeypatch):
+    (fake_classify / 'bin' / 'classify').write_text(
+        '#!/bin/sh\necho "$ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS $OMP_NUM_THREADS"\n')
+    monkeypatch.setenv('OMP_NUM_THREADS', '64')
+    i = Classify(in_file=fake_classify / 'in.mnc', tag_file=fake_classify / 'tags.tag',
+                 dump_features=True)
+    node = pe.Node(i, name='classify')
+    assert node.n_procs == 1
+    node.n_procs = 4
+    with indirectory(fake_classify):
+        r = i.run()
+    with open(r.outputs.features, 'r') as f:
+        assert f.read() == '4 4\n'
+    # MultiProc would take a negative n_procs as freeing processors
+    with pytest.raises(TraitError):
+        i.inputs.num_threads = -1
+    assert i.inputs.environ['OMP_NUM_THREADS'] == '4'
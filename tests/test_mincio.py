@@ -0,0 +1,68 @@
+import numpy as np
+import nibabel
+import pytest
+from nipype.utils.filemanip import indirectory
+from pndniworkflows.interfaces.minc import Mnc2nii, Nii2mnc
+from pndniworkflows.interfaces.pndni_utils import MncLabel2NiiLabel
+
+
+pytest.importorskip('h5py')
+
+
+AFFINE = np.array([[0.0, 0.0, -1.5, 20.0],
+                   [2.0, 0.0, 0.0, -30.0],
+                   [0.0, 1.0, 0.0, -40.0],
+                   [0.0, 0.0, 0.0, 1.0]])
+
+
+@pytest.mark.parametrize('dtype', [np.uint8, np.int16, np.float32, np.float64])
+def test_roundtrip(tmp_path, dtype):
+    arr = (np.arange(4 * 5 * 6).reshape(4, 5, 6) % 200).astype(dtype)
+    nibabel.Nifti1Image(arr, AFFINE).to_filename(str(tmp_path / 'in.nii'))
+    with indirectory(tmp_path):
+        r = Nii2mnc(in_file=tmp_path / 'in.nii').run()
+        mnc = nibabel.load(r.outputs.out_file)
+        assert np.allclose(mnc.affine[:, [2, 1, 0, 3]], AFFINE)
+        assert np.all(mnc.get_fdata().transpose(2, 1, 0) == arr)
+        assert mnc.get_data_dtype() == dtype
+        r = Mnc2nii(in_file=r.outputs.out_file, out_file='out.nii').run()
+    nii = nibabel.load(r.outputs.out_file)
+    assert np.allclose(nii.affine, AFFINE)
+    assert np.all(np.asanyarray(nii.dataobj) == arr)
+    assert nii.get_data_dtype() == dtype
+
+
+def test_write_short(tmp_path):
+    arr = np.linspace(-1.0, 1.0, 4 * 5 * 6).reshape(4, 5, 6)
+    nibabel.Nifti1Image(arr, AFFINE).to_filename(str(tmp_path / 'in.nii'))
+    with indirectory(tmp_path):
+        r = Nii2mnc(in_file=tmp_path / 'in.nii', write_short=True).run()
+        mnc = nibabel.load(r.outputs.out_file)
+        assert mnc.get_data_dtype() == np.int16
+        # each slice is scaled separately
+        assert np.allclose(mnc.get_fdata().transpose(2, 1, 0), arr, atol=1e-4)
+        r = Mnc2nii(in_file=r.outputs.out_file, out_file='out.nii', write_byte=True, write_unsigned=True).run()
+    nii = nibabel.load(r.outputs.out_file)
+    assert nii.get_data_dtype() == np.uint8
+    assert np.allclose(nii.get_fdata(), arr, atol=1.0 / 255)
+
+
+def test_MncLabel2NiiLabel(tmp_path):
+    arr = np.arange(4 * 5 * 6).reshape(4, 5, 6).astype(np.float32) + 0.001
+    nibabel.Nifti1Image(arr, AFFINE).to_filename(str(tmp_path / 'in.nii'))
+    with indirectory(tmp_path):
+        r = Nii2mnc(in_file=tmp_path / 'in.nii').run()
+        r = MncLabel2NiiLabel(in_file=r.outputs.out_file).run()
+    nii = nibabel.load(r.outputs.out_file)
+    assert nii.get_data_dtype() == np.uint8
+    assert np.all(np.asanyarray(nii.dataobj) == np.rint(arr))
+
+
+def test_slabs(tmp_path):
+    from pndniworkflows.mincio import minc2nifti, nifti2minc
+    arr = np.random.default_rng(0).normal(size=(4, 5, 6))
+    nibabel.Nifti1Image(arr, AFFINE).to_filename(str(tmp_path / 'in.nii'))
+    nifti2minc(tmp_path / 'in.nii', tmp_path / 'out.mnc', dtype=np.int16, slab_bytes=1)
+    minc2nifti(tmp_path / 'out.mnc', tmp_path / 'out.nii.gz', dtype=np.float32, slab_bytes=1)
+    nii = nibabel.load(str(tmp_path / 'out.nii.gz'))
+    assert np.allclose(nii.get_fdata(), arr, atol=1e-3)
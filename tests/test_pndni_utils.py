@@ -1,7 +1,7 @@
 import numpy as np
 import nibabel
 import pytest
-from pndniworkflows.interfaces.pndni_utils import ForceQForm, ConvertPoints, Stats
+from pndniworkflows.interfaces.pndni_utils import ForceQForm, ConvertPoints, Stats, MncDefaultDircos, Labels2ProbMaps
 from nipype.utils.filemanip import indirectory
 import tempfile
 import os
@@ -48,6 +48,58 @@ def test_forceqform(tmp_path, testtype):
     assert nout.get_sform(coded=True)[1] == 0
 
 
+def test_forceqform_header_only(tmp_path):
+    affine = np.array([[0.0, 0.0, 1.0, -20.0],
+                       [-2.0, 0.0, 0.0, -30.0],
+                       [0.0, 4.0, 0.0, -40.0],
+                       [0.0, 0.0, 0.0, 1.0]])
+    img = np.arange(24, dtype=np.int16).reshape(2, 3, 4)
+    nii = nibabel.Nifti1Image(img, None)
+    nii.header.extensions.append(nibabel.nifti1.Nifti1Extension('comment', b'keep me'))
+    nii.set_sform(affine)
+    nii.to_filename(str(tmp_path / 'image1.nii.gz'))
+    with indirectory(tmp_path):
+        res = ForceQForm(in_file=tmp_path / 'image1.nii.gz').run()
+    assert res.outputs.out_file.endswith('image1_qform.nii.gz')
+    nout = nibabel.load(str(res.outputs.out_file))
+    assert np.allclose(nout.get_qform(), affine)
+    assert nout.get_sform(coded=True)[1] == 0
+    assert nout.header.extensions[0].get_content() == b'keep me'
+    assert np.all(np.asanyarray(nout.dataobj) == img)
+    i = ForceQForm(in_file=tmp_path / 'image1.nii.gz', use_cli=True)
+    with indirectory(tmp_path):
+        with pytest.raises(OSError):
+            i.run()
+    # maxangle is not implemented in-process, so the command line tool is used
+    i = ForceQForm(in_file=tmp_path / 'image1.nii.gz', maxangle=10.0)
+    with indirectory(tmp_path):
+        with pytest.raises(OSError):
+            i.run()
+
+
+@pytest.mark.parametrize('dircos', [None, [1.0, 1e-8, 0.0], [0.0, 1.0, 0.0]])
+def test_MncDefaultDircos(tmp_path, dircos):
+    h5py = pytest.importorskip('h5py')
+    in_file = tmp_path / 'in.mnc'
+    with h5py.File(in_file, 'w') as f:
+        dims = f.create_group('minc-2.0/dimensions')
+        for name in ['xspace', 'yspace', 'zspace']:
+            dims.create_dataset(name, data=0)
+        if dircos is not None:
+            dims['xspace'].attrs['direction_cosines'] = dircos
+    with indirectory(tmp_path):
+        i = MncDefaultDircos(in_file=in_file)
+        if dircos == [0.0, 1.0, 0.0]:
+            # not close to the default, needs the command line tool
+            with pytest.raises(OSError):
+                i.run()
+            return
+        res = i.run()
+    with h5py.File(res.outputs.out_file, 'r') as f:
+        for name, truth in [('xspace', [1, 0, 0]), ('yspace', [0, 1, 0]), ('zspace', [0, 0, 1])]:
+            assert np.all(f['minc-2.0/dimensions'][name].attrs['direction_cosines'] == truth)
+
+
 @pytest.fixture
 def cleandir():
     os.chdir(tempfile.mkdtemp())
@@ -102,3 +154,46 @@ def test_Stats(tmp_path):
     means = np.array([np.mean(input[mask == i]) for i in range(1, 5)])
     means[np.isnan(means)] = 0.0
     assert np.all(r.outputs.out_stat == np.repeat(means, 2))
+
+
+@pytest.fixture
+def label_files(tmp_path):
+    rng = np.random.default_rng(0)
+    affine = np.diag([2.0, 1.0, 1.5, 1.0])
+    files = []
+    for i in range(3):
+        fname = str(tmp_path / f'labels{i}.nii.gz')
+        nibabel.Nifti1Image(rng.integers(0, 4, size=(5, 6, 7)).astype(np.uint8), affine).to_filename(fname)
+        files.append(fname)
+    return files
+
+
+@pytest.mark.parametrize('out_dtype', ['float32', 'uint8', 'uint16'])
+def test_Labels2ProbMaps(tmp_path, label_files, out_dtype):
+    data = np.stack([np.asanyarray(nibabel.load(f).dataobj) for f in label_files])
+    with indirectory(tmp_path):
+        r = Labels2ProbMaps(input_files=label_files, labels=[1, 3], bids_labels=True,
+                            output_template='out_label-{label}_probseg.nii.gz', out_dtype=out_dtype).run()
+    assert [os.path.basename(f) for f in r.outputs.output_files] == ['out_label-GM_probseg.nii.gz',
+                                                                     'out_label-CSF_probseg.nii.gz']
+    for label, out_file in zip([1, 3], r.outputs.output_files):
+        out = nibabel.load(out_file)
+        assert out.get_data_dtype() == np.dtype(out_dtype)
+        assert np.allclose(out.affine, np.diag([2.0, 1.0, 1.5, 1.0]))
+        # k / 3 is stored as an integer k with slope 1 / 3 (in single precision)
+        assert np.allclose(out.get_fdata(), np.mean(data == label, axis=0), rtol=0, atol=1e-6)
+
+
+def test_Labels2ProbMaps_merged(tmp_path, label_files):
+    data = np.stack([np.asanyarray(nibabel.load(f).dataobj) for f in label_files])
+    with indirectory(tmp_path):
+        r = Labels2ProbMaps(input_files=label_files, labels=[0, 1, 2], merged_file='probseg.nii',
+                            out_dtype='uint8').run()
+    # OutputMultiPath collapses a single file to a string
+    assert r.outputs.output_files == str(tmp_path / 'probseg.nii')
+    out = nibabel.load(r.outputs.output_files)
+    assert out.shape == (5, 6, 7, 3)
+    expected = np.stack([np.mean(data == label, axis=0) for label in [0, 1, 2]], axis=-1)
+    assert np.allclose(out.get_fdata(), expected, rtol=0, atol=1e-6)
+    with pytest.raises(ValueError):
+        Labels2ProbMaps(input_files=label_files, labels=[0], merged_file='probseg.nii', use_cli=True).run()
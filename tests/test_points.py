@@ -0,0 +1,46 @@
+import numpy as np
+import pytest
+from pndni.convertpoints import Points, SinglePoint
+from pndniworkflows.points import PointArray
+
+
+@pytest.fixture
+def points():
+    rng = np.random.default_rng(0)
+    return PointArray(rng.normal(scale=50.0, size=(100, 3)), rng.integers(0, 4, size=100))
+
+
+@pytest.mark.parametrize('ext', ['.tsv', '.csv', '.tag'])
+def test_roundtrip(tmp_path, points, ext):
+    points.to_file(tmp_path / ('points' + ext))
+    out = PointArray.from_file(tmp_path / ('points' + ext))
+    assert np.allclose(out.coords, points.coords)
+    assert np.all(out.labels == points.labels)
+
+
+def test_tsv_compatible(tmp_path, points):
+    points.to_tsv(tmp_path / 'points.tsv')
+    points_obj = Points.from_tsv(tmp_path / 'points.tsv')
+    assert [sp.x for sp in points_obj.points] == points.coords[:, 0].tolist()
+    assert [sp.index for sp in points_obj.points] == points.labels.tolist()
+    Points([SinglePoint(1.5, 2, -3, 7)]).to_tsv(tmp_path / 'single.tsv')
+    single = PointArray.from_tsv(tmp_path / 'single.tsv')
+    assert single.coords.tolist() == [[1.5, 2, -3]]
+    assert single.labels.tolist() == [7]
+
+
+def test_transform(points):
+    affine = np.array([[0, 2.0, 0, 3], [-1.0, 0, 0, 4], [0, 0, 1.5, -5], [0, 0, 0, 1]])
+    out = points.transform(affine)
+    for p, q in zip(points.coords, out.coords):
+        assert np.allclose(affine @ np.append(p, 1), np.append(q, 1))
+    assert np.all(out.labels == points.labels)
+    assert np.allclose(out.voxel_coords(affine), points.coords)
+
+
+def test_invalid(tmp_path):
+    with pytest.raises(ValueError):
+        PointArray(np.zeros((3, 3)), [1, 2])
+    (tmp_path / 'bad.tsv').write_text('x\ty\tz\n1\t2\t3\n')
+    with pytest.raises(ValueError):
+        PointArray.from_tsv(tmp_path / 'bad.tsv')
@@ -1,13 +1,14 @@
 import nibabel
 import numpy as np
-from utils import cdtmppath
+from utils import cdtmppath, head_phantom
 from pndni.convertpoints import Points, SinglePoint
 from pndniworkflows.utils import cutimage
-from pndniworkflows.preprocessing import crop_wf, neck_removal_wf
+from pndniworkflows.preprocessing import crop_wf, neck_removal_wf, autocrop_wf
 from pndniworkflows.interfaces.io import ExportFile
 import pytest
 import os
 from nipype.pipeline import engine as pe
+from nipype.utils.functions import create_function_from_source
 
 
 CUTEXPS = [([[1, 5, 6], [5, 2, 9], [8, 3, 3]], (slice(1, 9), slice(2, 6), slice(3, 10))),
@@ -63,3 +64,121 @@ def test_cropneck(cdtmppath, inpoints, limits, truth):
     wfwrapper.run()
     niout2 = nibabel.load('out2.nii')
     assert np.all(niout2.get_fdata() == arr[:, :, truth])
+
+
+def test_cutimage_compress(cdtmppath):
+    arr = np.arange(10 * 11 * 12).reshape((10, 11, 12))
+    nibabel.Nifti1Image(arr, np.eye(4)).to_filename('in.nii.gz')
+    points = Points([SinglePoint(pt[0], pt[1], pt[2], 0) for pt in CUTEXPS[0][0]])
+    points.to_tsv('points.tsv')
+    outname = cutimage('in.nii.gz', 'points.tsv', False, compress=False)
+    assert outname.endswith('in_cropped.nii')
+    assert np.all(nibabel.load(outname).get_fdata() == arr[CUTEXPS[0][1]])
+    assert cutimage('in.nii.gz', 'points.tsv', False).endswith('in_cropped.nii.gz')
+
+
+def test_shared_transform(cdtmppath):
+    from scipy.io import savemat
+    from nipype import IdentityInterface
+    arr = np.arange(10 * 11 * 12).reshape((10, 11, 12))
+    nibabel.Nifti1Image(arr, np.eye(4)).to_filename('in.nii')
+    points = Points([SinglePoint(pt[0], pt[1], pt[2], 0) for pt in CUTEXPS[0][0]])
+    points.to_tsv('points.tsv')
+    # translate by 1 mm superiorly
+    savemat('shift.mat', {'AffineTransform_double_3_3': np.array([[1, 0, 0, 0, 1, 0, 0, 0, 1, 0, 0, 1.0]]).T,
+                          'fixed': np.zeros((3, 1))}, format='4')
+    wfwrapper = pe.Workflow('wrapper')
+    transforms = pe.Node(IdentityInterface(['transforms']), 'transforms')
+    transforms.inputs.transforms = [os.path.abspath('shift.mat')]
+    crop = crop_wf(True, external_transform=True)
+    crop.inputs.inputspec.T1 = os.path.abspath('in.nii')
+    crop.inputs.inputspec.points = os.path.abspath('points.tsv')
+    neck = neck_removal_wf(True, external_transform=True)
+    neck.inputs.inputspec.T1 = os.path.abspath('in.nii')
+    neck.inputs.inputspec.limits = NECKEXPS[0][1]
+    export = pe.Node(ExportFile(out_file=os.path.abspath('crop.nii'), clobber=True), 'exp')
+    export2 = pe.Node(ExportFile(out_file=os.path.abspath('neck.nii'), clobber=True), 'exp2')
+    wfwrapper.connect([(transforms, crop, [('transforms', 'inputspec.transforms')]),
+                       (transforms, neck, [('transforms', 'inputspec.transforms')]),
+                       (crop, export, [('outputspec.cropped', 'in_file')]),
+                       (neck, export2, [('outputspec.cropped', 'in_file')])])
+    wfwrapper.run()
+    assert np.all(nibabel.load('crop.nii').get_fdata() == arr[1:9, 2:6, 4:11])
+    assert np.all(nibabel.load('neck.nii').get_fdata() == arr[:, :, 4:])
+
+
+def test_template_preparation(cdtmppath):
+    from pndniworkflows.preprocessing import template_preparation_wf, model_registration_wf
+    arr = np.zeros((10, 11, 12))
+    arr[2:8, 2:9, 2:10] = 100
+    nibabel.Nifti1Image(arr, np.eye(4)).to_filename('model.nii')
+    wfwrapper = pe.Workflow('wrapper')
+    prep = template_preparation_wf(2)
+    prep.inputs.inputspec.model = os.path.abspath('model.nii')
+    prep.inputs.inputspec.limits = NECKEXPS[0][1]
+    neck = neck_removal_wf(False, prepared_points=True)
+    neck.inputs.inputspec.T1 = os.path.abspath('model.nii')
+    exports = [pe.Node(ExportFile(out_file=os.path.abspath(f), clobber=True), f'exp{i}')
+               for i, f in enumerate(['down.nii', 'mask.nii', 'neck.nii'])]
+    wfwrapper.connect([(prep, neck, [('outputspec.neck_points', 'inputspec.points')]),
+                       (prep, exports[0], [('outputspec.model', 'in_file')]),
+                       (prep, exports[1], [('outputspec.model_mask', 'in_file')]),
+                       (neck, exports[2], [('outputspec.cropped', 'in_file')])])
+    wfwrapper.run()
+    assert nibabel.load('down.nii').shape == (5, 5, 6)
+    assert np.all(nibabel.load('mask.nii').get_fdata()[1:4, 1:4, 1:5] == 1)
+    assert np.all(nibabel.load('neck.nii').get_fdata() == arr[:, :, NECKEXPS[0][2]])
+    reg = model_registration_wf(use_mask=True)
+    wfwrapper2 = pe.Workflow('wrapper2')
+    wfwrapper2.connect(prep, 'outputspec.model_mask', reg, 'inputspec.model_mask')
+    edges = {(u.fullname, v.fullname): d['connect'] for u, v, d in wfwrapper2._create_flat_graph().edges(data=True)}
+    assert edges['wrapper2.template_preparation.outputspec', 'wrapper2.model_registration.inputspec'] == \
+        [('model_mask', 'model_mask')]
+    # the mask is repeated for each stage of the registration
+    masks = [c for c in edges['wrapper2.model_registration.inputspec', 'wrapper2.model_registration.register']
+             if c[1] == 'fixed_image_masks']
+    assert len(masks) == 1
+    (field, func, args), _ = masks[0]
+    assert field == 'model_mask'
+    assert create_function_from_source(func)('mask.nii', *args) == ['mask.nii', 'mask.nii']
+
+
+def test_downsampled_registration():
+    wf = crop_wf(True, registration_voxel_size=3.0)
+    reg = wf.get_node('trpointswf.model_registration')
+    for field, regfield in [('T1', 'moving_image'), ('model', 'fixed_image')]:
+        downsample = reg.get_node(f'downsample_{field}')
+        assert downsample.inputs.voxel_size == 3.0
+        assert reg._graph.get_edge_data(downsample, reg.get_node('register'))['connect'] == [('out_file', regfield)]
+
+
+def test_neck_detection(cdtmppath):
+    head_phantom('in.nii')
+    wfwrapper = pe.Workflow('wrapper')
+    wf = neck_removal_wf(False, detect=True)
+    wf.inputs.inputspec.T1 = os.path.abspath('in.nii')
+    export = pe.Node(ExportFile(out_file=os.path.abspath('out.nii'), clobber=True), 'exp')
+    wfwrapper.connect(wf, 'outputspec.cropped', export, 'in_file')
+    wfwrapper.run()
+    out = nibabel.load('out.nii')
+    zmin = (out.affine @ [0, 0, 0, 1])[2]
+    assert 70 < zmin < 125
+    assert out.shape[:2] == (90, 100)
+    with pytest.raises(ValueError):
+        neck_removal_wf(True, detect=True)
+
+
+def test_autocrop(cdtmppath):
+    head_phantom('in.nii')
+    wf = autocrop_wf(margin=2.0)
+    wf.inputs.inputspec.T1 = os.path.abspath('in.nii')
+    wf.base_dir = os.path.abspath('work')
+    res = wf.run()
+    crop = [n for n in res.nodes() if n.name == 'crop'][0].result.outputs
+    out = nibabel.load(crop.out_file)
+    # the shoulders fill the field of view in x and are cut at the bottom,
+    # the head is 170 mm long in y and its top is at 290 mm
+    assert out.shape[0] == 90
+    assert out.shape[1] < 100
+    assert (out.affine @ [0, 0, 0, 1])[2] == 0
+    assert (out.affine @ [0, 0, out.shape[2] - 1, 1])[2] < 298
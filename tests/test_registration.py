@@ -0,0 +1,70 @@
+import pytest
+from nipype.interfaces.base import isdefined
+from pndniworkflows import registration
+
+
+@pytest.mark.parametrize('factory', [registration.ants_registration_affine_node,
+                                     registration.ants_registration_syn_node,
+                                     registration.ants_registration_syn_no_affine_node])
+def test_presets(factory):
+    default = factory()
+    for preset, levels in registration.REGISTRATION_PRESETS.items():
+        reg = factory(preset=preset)
+        for key in ['number_of_iterations', 'shrink_factors', 'smoothing_sigmas']:
+            assert getattr(reg.inputs, key) == [stage[:levels] for stage in getattr(default.inputs, key)]
+    # explicit arguments take precedence over the preset
+    assert factory(preset='preview', shrink_factors=default.inputs.shrink_factors).inputs.shrink_factors == \
+        default.inputs.shrink_factors
+    with pytest.raises(ValueError):
+        factory(preset='slow')
+
+
+@pytest.mark.parametrize('preset', ['default', 'preview'])
+def test_warm_start(tmp_path, preset):
+    (tmp_path / 'previous.mat').touch()
+    cold = registration.ants_registration_affine_node(preset=preset)
+    warm = registration.ants_registration_affine_node(preset=preset, warm_start=True,
+                                                      initial_moving_transform=[str(tmp_path / 'previous.mat')])
+    assert cold.inputs.initial_moving_transform_com == 1
+    assert not isdefined(warm.inputs.initial_moving_transform_com)
+    for key in ['shrink_factors', 'smoothing_sigmas']:
+        assert getattr(warm.inputs, key) == [stage[-registration.WARM_START_LEVELS:]
+                                             for stage in getattr(cold.inputs, key)]
+    assert warm.inputs.shrink_factors[0][-1] == cold.inputs.shrink_factors[0][-1]
+    assert warm.inputs.number_of_iterations == [[registration.WARM_START_ITERATIONS]] * 2
+    # the warm schedule must do less work than the cold one for every preset
+    assert len(warm.inputs.shrink_factors[0]) < len(cold.inputs.shrink_factors[0])
+
+
+def test_ants_registration_syn_wf(tmp_path, monkeypatch):
+    from nipype.interfaces.ants.registration import Registration
+    import nibabel
+    import numpy as np
+    calls = []
+
+    def fake_run(self, runtime, correct_return_codes=(0,)):
+        calls.append(self.inputs.transforms)
+        outputs = self._list_outputs()
+        for key in ['forward_transforms', 'composite_transform', 'inverse_composite_transform', 'warped_image']:
+            values = outputs[key] if isinstance(outputs[key], list) else [outputs[key]]
+            for v in values:
+                if isdefined(v):
+                    with open(v, 'w') as f:
+                        f.write(key)
+        runtime.returncode = 0
+        return runtime
+
+    monkeypatch.setattr(Registration, '_run_interface', fake_run)
+    for fname in ['fixed.nii', 'moving.nii']:
+        nibabel.Nifti1Image(np.zeros((2, 2, 2), dtype=np.float32), np.eye(4)).to_filename(str(tmp_path / fname))
+    wf = registration.ants_registration_syn_wf(preset='preview')
+    wf.base_dir = str(tmp_path)
+    wf.inputs.inputspec.fixed_image = str(tmp_path / 'fixed.nii')
+    wf.inputs.inputspec.moving_image = str(tmp_path / 'moving.nii')
+    result = wf.run()
+    assert calls == [['Rigid', 'Affine'], ['SyN']]
+    syn = [n for n in result.nodes() if n.name == 'syn'][0]
+    affine = [n for n in result.nodes() if n.name == 'affine'][0]
+    assert syn.inputs.initial_moving_transform == affine.result.outputs.forward_transforms
+    assert not isdefined(syn.inputs.initial_moving_transform_com)
+    assert syn.inputs.shrink_factors == [[8, 4]]
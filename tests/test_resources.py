@@ -0,0 +1,94 @@
+import numpy as np
+import nibabel
+import pytest
+from nipype.pipeline import engine as pe
+from nipype import IdentityInterface
+from nipype.utils.filemanip import loadpkl, savepkl
+from pndniworkflows import resources
+from pndniworkflows.preprocessing import crop_wf
+from pndniworkflows.registration import ants_registration_syn_wf
+from pndniworkflows.interfaces.utils import CutImage
+
+
+@pytest.fixture
+def image(tmp_path):
+    nibabel.Nifti1Image(np.zeros((64, 64, 32), dtype=np.int16), np.eye(4)).to_filename(str(tmp_path / 'T1.nii.gz'))
+    return tmp_path / 'T1.nii.gz'
+
+
+MODELS = {'registration_linear': resources.MemoryModel(0.3, 48, 1),
+          'registration_syn': resources.MemoryModel(0.5, 512, 1),
+          'CutImage': resources.MemoryModel(0.2, 0, 2)}
+
+
+def test_memory_estimates(image):
+    nvox = 64 * 64 * 32
+    default_mem_gb = pe.Node(IdentityInterface(['a']), 'a').mem_gb
+    wf = crop_wf(True, reference_image=image, memory_models=MODELS)
+    linear = MODELS['registration_linear']
+    # the image is compressed, so it takes one more copy of its int16 data
+    assert wf.get_node('trpointswf.model_registration.register').mem_gb == \
+        pytest.approx(linear.base_gb + (linear.bytes_per_voxel + 2 * (linear.input_copies + 1)) * nvox / 2 ** 30)
+    assert wf.get_node('cut').mem_gb == pytest.approx(resources.estimate_mem_gb(MODELS['CutImage'], nvox, 2, compressed=True))
+    wf = ants_registration_syn_wf(reference_image=image, memory_models=MODELS)
+    assert wf.get_node('syn').mem_gb == pytest.approx(resources.estimate_mem_gb(MODELS['registration_syn'], nvox, 2, compressed=True))
+    assert wf.get_node('syn').mem_gb > wf.get_node('affine').mem_gb
+    # no estimates without models
+    assert crop_wf(True).get_node('cut').mem_gb == default_mem_gb
+    assert crop_wf(True, reference_image=image).get_node('cut').mem_gb == default_mem_gb
+    wf = crop_wf(True, reference_image=image, memory_models={'CutImage': MODELS['CutImage']})
+    assert wf.get_node('trpointswf.model_registration.register').mem_gb == default_mem_gb
+    node = resources.estimated_node(CutImage(), 'cut', image, models={'CutImage': resources.MemoryModel(2.0, 0)})
+    assert node.mem_gb == pytest.approx(2.0 + 2 * nvox / 2 ** 30)
+    assert resources.memory_estimate(IdentityInterface(['a']), image, MODELS) is None
+
+
+def test_memory_estimate_dtype(tmp_path, image):
+    nibabel.Nifti1Image(np.zeros((64, 64, 32), dtype=np.float64), np.eye(4)).to_filename(str(tmp_path / 'T1f.nii.gz'))
+    nibabel.Nifti1Image(np.zeros((64, 64, 32), dtype=np.float64), np.eye(4)).to_filename(str(tmp_path / 'T1f.nii'))
+    assert resources.image_itemsize(image) == 2
+    assert resources.image_itemsize(tmp_path / 'T1f.nii.gz') == 8
+    model = MODELS['CutImage']
+    short = resources.memory_estimate(CutImage(), image, MODELS)
+    double = resources.memory_estimate(CutImage(), tmp_path / 'T1f.nii.gz', MODELS)
+    assert double - short == pytest.approx((model.input_copies + 1) * 6 * 64 * 64 * 32 / 2 ** 30)
+    uncompressed = resources.memory_estimate(CutImage(), tmp_path / 'T1f.nii', MODELS)
+    assert double - uncompressed == pytest.approx(resources.COMPRESSED_COPIES * 8 * 64 * 64 * 32 / 2 ** 30)
+
+
+def test_fit_memory_model():
+    nvoxels = np.array([1, 2, 4, 8]) * 2 ** 24
+    peak = 0.5 + 40 * nvoxels / 2 ** 30
+    model = resources.fit_memory_model(nvoxels, peak, margin=1.0)
+    assert model.base_gb == pytest.approx(0.5)
+    assert model.bytes_per_voxel == pytest.approx(40)
+    assert model.input_copies == 0
+    itemsize = np.array([2, 8, 2, 4])
+    model = resources.fit_memory_model(nvoxels, peak + 3 * itemsize * nvoxels / 2 ** 30, margin=1.0, itemsize=itemsize)
+    assert model == pytest.approx((0.5, 40, 3))
+    compressed = np.array([True, False, False, True])
+    model = resources.fit_memory_model(nvoxels, peak + (3 + compressed) * itemsize * nvoxels / 2 ** 30, margin=1.0,
+                                       itemsize=itemsize, compressed=compressed)
+    assert model == pytest.approx((0.5, 40, 3))
+    with pytest.raises(ValueError):
+        resources.fit_memory_model([10, 10], [1, 2])
+
+
+def test_memory_samples(tmp_path, image):
+    wf = crop_wf(False)
+    wf.base_dir = str(tmp_path / 'work')
+    (tmp_path / 'points.tsv').write_text('x\ty\tz\tindex\n1\t2\t3\t0\n10\t20\t30\t0\n')
+    wf.inputs.inputspec.T1 = str(image)
+    wf.inputs.inputspec.points = str(tmp_path / 'points.tsv')
+    wf.run()
+    # without the resource monitor there is nothing to collect
+    assert len(resources.memory_samples(tmp_path / 'work', 'cut')[0]) == 0
+    result_file = str(tmp_path / 'work' / 'crop' / 'cut' / 'result_cut.pklz')
+    result = loadpkl(result_file)
+    result.runtime.mem_peak_gb = 0.25
+    savepkl(result_file, result)
+    nvoxels, peak, itemsize, compressed = resources.memory_samples(tmp_path / 'work', 'cut')
+    assert list(nvoxels) == [64 * 64 * 32]
+    assert list(peak) == [0.25]
+    assert list(itemsize) == [2]
+    assert list(compressed) == [True]
@@ -1,13 +1,17 @@
 from pndniworkflows import utils
-from pndniworkflows.interfaces.utils import Gzip, Csv2Tsv, Zipper
+from pndniworkflows.interfaces.utils import Gzip, Csv2Tsv, Zipper, TransformPoints, AutoCrop, UncropImage
 from collections import OrderedDict
 import pytest
 from io import StringIO
 import csv
+import json
 import os
 import tempfile
 import gzip
 from pathlib import Path
+from nipype.utils.filemanip import indirectory
+import numpy as np
+import nibabel
 
 
 def test_combine_labels():
@@ -447,3 +451,214 @@ def test_Zipper():
     i = Zipper(chunksize1=3, chunksize2=2, list1=l1[:3], list2=l2)
     with pytest.raises(RuntimeError):
         i.run()
+
+
+@pytest.mark.parametrize('in_name,out_name', [('in.txt', 'out.txt'), ('in.txt', 'out.txt.gz'),
+                                              ('in.txt.gz', 'out.txt'), ('in.txt.gz', 'out.txt.gz')])
+def test_copy_file(tmp_path, in_name, out_name):
+    in_file = tmp_path / in_name
+    if in_name.endswith('.gz'):
+        in_file.write_bytes(gzip.compress(b'some text here'))
+    else:
+        in_file.write_bytes(b'some text here')
+    out_file = tmp_path / out_name
+    assert utils.copy_file(in_file, out_file, compress=out_name.endswith('.gz')) is None
+    if out_name.endswith('.gz'):
+        assert gzip.decompress(out_file.read_bytes()) == b'some text here'
+    else:
+        assert out_file.read_bytes() == b'some text here'
+    # by default the file is copied as is, whatever its name
+    utils.copy_file(in_file, tmp_path / 'plain')
+    assert (tmp_path / 'plain').read_bytes() == in_file.read_bytes()
+
+
+@pytest.mark.parametrize('in_name,out_name', [('in.txt', 'out.txt'), ('in.txt', 'out.txt.gz'),
+                                              ('in.txt.gz', 'out.txt'), ('in.txt.gz', 'out.txt.gz')])
+def test_copy_file_digest(tmp_path, in_name, out_name):
+    in_file = tmp_path / in_name
+    data = bytes(range(256)) * 10000
+    in_file.write_bytes(gzip.compress(data) if in_name.endswith('.gz') else data)
+    out_file = tmp_path / out_name
+    compress = out_name.endswith('.gz')
+    digest = utils.copy_file(in_file, out_file, algorithm='blake2b', compress=compress)
+    assert digest == utils.file_digest(out_file, 'blake2b')
+    # the same bytes as without hashing (gzip stores the file name)
+    (tmp_path / 'nohash').mkdir()
+    utils.copy_file(in_file, tmp_path / 'nohash' / out_name, compress=compress)
+    assert out_file.read_bytes() == (tmp_path / 'nohash' / out_name).read_bytes()
+
+
+def test_manifest(tmp_path):
+    from multiprocessing.pool import ThreadPool
+    manifest = tmp_path / utils.MANIFEST_NAME
+    (tmp_path / 'sub').mkdir()
+    for i in range(20):
+        (tmp_path / 'sub' / f'{i}.txt').write_text('x' * i)
+
+    def append(i):
+        fname = tmp_path / 'sub' / f'{i}.txt'
+        utils.append_manifest(manifest, fname, utils.file_digest(fname, 'blake2b'), source=f'/src/{i}')
+
+    with ThreadPool(8) as pool:
+        pool.map(append, range(20))
+    assert manifest.read_text().count('path\tsize') == 1
+    entries = utils.read_manifest(manifest)
+    assert len(entries) == 20
+    entry = entries[str(tmp_path / 'sub' / '3.txt')]
+    assert entry == {'size': 3, 'hash': utils.file_digest(tmp_path / 'sub' / '3.txt', 'blake2b'), 'source': '/src/3', 'params': None,
+                     'mtime_ns': (tmp_path / 'sub' / '3.txt').stat().st_mtime_ns}
+    assert 'sub/3.txt\t3\t' in manifest.read_text()
+    # later entries replace earlier ones
+    (tmp_path / 'sub' / '3.txt').write_text('y')
+    utils.append_manifest(manifest, tmp_path / 'sub' / '3.txt', 'abc', params={'level': 1, 'name': 'a b'})
+    assert utils.read_manifest(manifest)[str(tmp_path / 'sub' / '3.txt')] == {'size': 1, 'hash': 'abc', 'source': '',
+                                                                              'params': {'level': 1, 'name': 'a b'},
+                                                                              'mtime_ns': (tmp_path / 'sub' / '3.txt').stat().st_mtime_ns}
+    assert utils.read_manifest(tmp_path / 'missing.tsv') == {}
+
+
+def test_manifest_header_once(tmp_path, monkeypatch):
+    # two writers open the new manifest before either writes
+    import builtins
+    manifest = tmp_path / utils.MANIFEST_NAME
+    (tmp_path / 'a.txt').write_text('a')
+    first = open(manifest, 'a', newline='')
+    real_open = builtins.open
+    monkeypatch.setattr(builtins, 'open', lambda *args, **kwargs: first if args[0] == manifest.resolve() else real_open(*args, **kwargs))
+    second = real_open(manifest, 'a', newline='')
+    utils.append_manifest(manifest, tmp_path / 'a.txt', 'abc')
+    monkeypatch.setattr(builtins, 'open', lambda *args, **kwargs: second if args[0] == manifest.resolve() else real_open(*args, **kwargs))
+    utils.append_manifest(manifest, tmp_path / 'a.txt', 'def')
+    monkeypatch.undo()
+    assert manifest.read_text().count('path\tsize') == 1
+    assert utils.read_manifest(manifest)[str(tmp_path / 'a.txt')]['hash'] == 'def'
+
+
+def test_manifest_old_columns(tmp_path):
+    # entries from before the params and mtime_ns columns were added are read with them None
+    manifest = tmp_path / utils.MANIFEST_NAME
+    (tmp_path / 'a.txt').write_text('a')
+    manifest.write_text('path\tsize\thash\tsource\na.txt\t1\tabc\t/src/a\n')
+    assert utils.read_manifest(manifest)[str(tmp_path / 'a.txt')] == {'size': 1, 'hash': 'abc', 'source': '/src/a', 'params': None,
+                                                                      'mtime_ns': None}
+    utils.append_manifest(manifest, tmp_path / 'a.txt', 'def', params={'compress': True})
+    assert utils.read_manifest(manifest)[str(tmp_path / 'a.txt')]['params'] == {'compress': True}
+
+
+def test_chunk_partial():
+    assert list(utils.chunk(range(5), 2, partial=True)) == [[0, 1], [2, 3], [4]]
+
+
+def test_features2npy(tmp_path):
+    rng = np.random.default_rng(0)
+    features = rng.normal(size=(11, 3))
+    np.savetxt(tmp_path / 'features.txt', features)
+    utils.features2npy(tmp_path / 'features.txt', tmp_path / 'features.npy', chunksize=4)
+    assert np.all(np.load(tmp_path / 'features.npy') == features)
+    (tmp_path / 'bad.txt').write_text('1 2\n3\n')
+    with pytest.raises(ValueError):
+        utils.features2npy(tmp_path / 'bad.txt', tmp_path / 'bad.npy')
+
+
+def _itk_affine(A, t, c):
+    # apply an ITK transform (in LPS) to RAS points
+    def f(p):
+        p = np.array([-p[0], -p[1], p[2]])
+        q = A @ (p - c) + t + c
+        return np.array([-q[0], -q[1], q[2]])
+    return f
+
+
+def test_TransformPoints(tmp_path):
+    from scipy.io import savemat
+    rng = np.random.default_rng(0)
+    funcs = []
+    for name in ['first.mat', 'second.mat']:
+        A = np.eye(3) + rng.normal(scale=0.2, size=(3, 3))
+        t = rng.normal(scale=10, size=3)
+        c = rng.normal(scale=10, size=3)
+        savemat(str(tmp_path / name),
+                {'AffineTransform_double_3_3': np.concatenate([A.ravel(), t])[:, np.newaxis],
+                 'fixed': c[:, np.newaxis]},
+                format='4')
+        funcs.append(_itk_affine(A, t, c))
+    points = rng.normal(scale=50, size=(4, 3))
+    with open(tmp_path / 'points.tsv', 'w') as f:
+        f.write('x\ty\tz\tindex\n')
+        for i, p in enumerate(points):
+            f.write('{}\t{}\t{}\t{}\n'.format(*p, i))
+    i = TransformPoints(in_file=tmp_path / 'points.tsv',
+                        transforms=[tmp_path / 'first.mat', tmp_path / 'second.mat'],
+                        invert_transform_flags=[False, False])
+    with indirectory(tmp_path):
+        r = i.run()
+    out = np.loadtxt(r.outputs.out_file, skiprows=1)
+    # the last transform is applied first
+    expected = np.array([funcs[0](funcs[1](p)) for p in points])
+    assert np.allclose(out[:, :3], expected)
+    assert np.all(out[:, 3] == np.arange(4))
+    i.inputs.invert_transform_flags = [True, False]
+    with indirectory(tmp_path):
+        r = i.run()
+    out = np.loadtxt(r.outputs.out_file, skiprows=1)
+    assert np.allclose([funcs[0](p) for p in out[:, :3]], [funcs[1](p) for p in points])
+
+
+def test_AutoCrop(tmp_path):
+    rng = np.random.default_rng(0)
+    data = rng.normal(scale=2.0, size=(40, 42, 44)).astype(np.float32)
+    data[10:25, 12:30, 8:20] += 100
+    affine = np.array([[-1.0, 0, 0, 20], [0, 1.0, 0, -21], [0, 0, 1.0, -22], [0, 0, 0, 1]])
+    nibabel.Nifti1Image(data, affine).to_filename(str(tmp_path / 'in.nii.gz'))
+    with indirectory(tmp_path):
+        r = AutoCrop(in_file=tmp_path / 'in.nii.gz', voxel_size=4.0, margin=2.0).run()
+    assert r.outputs.out_file.endswith('in_cropped.nii.gz')
+    record = json.loads(Path(r.outputs.crop_file).read_text())
+    # 4 voxel blocks intersecting the foreground, and a 2 voxel margin
+    assert record['offset'] == [6, 10, 6]
+    assert record['cropped_shape'] == [24, 24, 16]
+    cropped = nibabel.load(r.outputs.out_file)
+    assert np.allclose(cropped.get_fdata(), data[6:30, 10:34, 6:22])
+    assert np.allclose(cropped.affine @ [0, 0, 0, 1], affine @ [6, 10, 6, 1])
+    with indirectory(tmp_path):
+        r2 = UncropImage(in_file=r.outputs.out_file, crop_file=r.outputs.crop_file, fill=-1).run()
+    assert r2.outputs.out_file.endswith('in_cropped_uncropped.nii.gz')
+    out = nibabel.load(r2.outputs.out_file)
+    assert np.allclose(out.affine, affine)
+    expected = np.full(data.shape, -1.0)
+    expected[6:30, 10:34, 6:22] = data[6:30, 10:34, 6:22]
+    assert np.allclose(out.get_fdata(), expected)
+    with pytest.raises(ValueError):
+        utils.uncropimage(str(tmp_path / 'in.nii.gz'), r.outputs.crop_file)
+
+
+def test_manifest_threads(tmp_path, monkeypatch):
+    # several threads append to a manifest which does not exist yet, all of them
+    # opening it before any takes the lock
+    import fcntl
+    from concurrent.futures import ThreadPoolExecutor
+    from threading import Barrier
+    manifest = tmp_path / utils.MANIFEST_NAME
+    nthreads = 8
+    barrier = Barrier(nthreads)
+    real_flock = fcntl.flock
+
+    def flock(f, op):
+        if op == fcntl.LOCK_EX:
+            barrier.wait()
+        real_flock(f, op)
+
+    monkeypatch.setattr(fcntl, 'flock', flock)
+    for i in range(nthreads):
+        (tmp_path / f'{i}.txt').write_text(str(i))
+
+    def append(i):
+        utils.append_manifest(manifest, tmp_path / f'{i}.txt', str(i))
+
+    with ThreadPoolExecutor(nthreads) as pool:
+        list(pool.map(append, range(nthreads)))
+    lines = manifest.read_text().splitlines()
+    assert lines[0] == 'path\tsize\thash\tsource\tparams\tmtime_ns'
+    assert len(lines) == nthreads + 1
+    entries = utils.read_manifest(manifest)
+    assert {k: v['hash'] for k, v in entries.items()} == {str(tmp_path / f'{i}.txt'): str(i) for i in range(nthreads)}
@@ -8,3 +8,25 @@ def cdtmppath(tmp_path):
     os.chdir(str(tmp_path))
     yield tmp_path
     os.chdir(curdir)
+
+
+def head_phantom(filename, flip=False):
+    """Write a 2 mm image of a head, neck and shoulders (z from 0 to 298 mm, head
+    centred at z=200, neck between z=70 and the bottom of the head). If flip, the
+    inferior-superior axis runs from superior to inferior.
+    """
+    import numpy as np
+    import nibabel
+    shape = (90, 100, 150)
+    affine = np.diag([2.0, 2.0, 2.0, 1.0])
+    affine[:3, 3] = [-89, -99, 0]
+    if flip:
+        affine[2, :] = [0, 0, -2.0, 298]
+    ijk = np.stack(np.meshgrid(*[np.arange(n) for n in shape], indexing='ij'), axis=-1)
+    x, y, z = np.moveaxis(ijk @ affine[:3, :3].T + affine[:3, 3], -1, 0)
+    head = (x / 70) ** 2 + (y / 85) ** 2 + ((z - 200) / 90) ** 2 < 1
+    neck = (x ** 2 + y ** 2 < 30 ** 2) & (z > 60) & (z < 160)
+    shoulders = (np.abs(y) < 50) & (z < 70)
+    data = 100.0 * (head | neck | shoulders)
+    data += np.random.default_rng(0).normal(scale=2.0, size=shape)
+    nibabel.Nifti1Image(data.astype(np.float32), affine).to_filename(str(filename))